@@ -118,6 +118,12 @@ try:
 except Exception:
     logger.error('Failed to find blacs version')
 
+# Time each phase of startup. Run with the 'profile_startup' command line
+# argument to also save cProfile and speedscope profiles of startup:
+from blacs import BLACS_DIR
+from blacs.startup_profiler import StartupProfiler
+startup_profiler = StartupProfiler(profile='profile_startup' in sys.argv, output_dir=BLACS_DIR)
+startup_profiler.begin_phase('Importing modules')
 
 # Connection Table Code
 from labscript_utils.connections import ConnectionTable
@@ -133,6 +139,8 @@ import qtutils.icons
 from blacs.analysis_submission import AnalysisSubmission
 # Queue Manager Code
 from blacs.experiment_queue import QueueManager, QueueTreeview
+from blacs.tab_base_classes import heartbeat_monitor
+from blacs.tracing import tracer
 # Module containing hardware compatibility:
 import labscript_devices
 # Save/restore frontpanel code
@@ -144,8 +152,6 @@ from labscript_utils.settings import Settings
 #import settings_pages
 import blacs.plugins as plugins
 
-from blacs import BLACS_DIR
-
 
 def set_win_appusermodel(window_id):
     from labscript_utils.winshell import set_appusermodel, appids, app_descriptions
@@ -186,6 +192,7 @@ class BLACSWindow(QMainWindow):
                         plugin.close()
                     except Exception as e:
                         logger.error('Could not close plugin %s. Error was: %s'%(module_name,str(e)))
+                    plugins.callback_registry.plugin_unloaded(module_name)
 
                 inmain_later(self.blacs.on_save_exit)
 
@@ -203,6 +210,7 @@ class BLACS(object):
         self.exit_complete = False
 
         logger.info('Loading BLACS ui')
+        startup_profiler.begin_phase('Loading main.ui')
         #self.ui = BLACSWindow(self).ui
         loader = UiLoader()
         loader.registerCustomWidget(QueueTreeview)
@@ -227,6 +235,7 @@ class BLACS(object):
 
         # Find which devices are connected to BLACS, and what their labscript class names are:
         logger.info('finding connected devices in connection table')
+        startup_profiler.begin_phase('Finding connected devices')
         self.attached_devices = self.connection_table.get_attached_devices()
 
         # Store the panes in a dictionary for easy access
@@ -237,6 +246,7 @@ class BLACS(object):
 
         # Get settings to restore
         logger.info('Loading front panel settings')
+        startup_profiler.begin_phase('Restoring front panel settings')
         self.front_panel_settings = FrontPanelSettings(self.settings_path, self.connection_table)
         self.front_panel_settings.setup(self)
         settings,question,error,tab_data = self.front_panel_settings.restore()
@@ -244,29 +254,113 @@ class BLACS(object):
         # TODO: handle question/error cases
 
         logger.info('restoring window data')
+        startup_profiler.begin_phase('Restoring window data')
         self.restore_window(tab_data)
 
         #splash.update_text('Creating the device tabs...')
         # Create the notebooks
         logger.info('Creating tab widgets')
+        startup_profiler.begin_phase('Creating tab widgets')
         for i in range(4):
             self.tab_widgets[i] = DragDropTabWidget(self.tab_widget_ids)
             self.tab_widgets[i].setElideMode(Qt.ElideRight)
             getattr(self.ui,'tab_container_%d'%i).addWidget(self.tab_widgets[i])
 
         logger.info('Instantiating devices')
+        # Tabs run their state machines in a thread each, unless configured to
+        # share one asyncio event loop:
+        if self.exp_config.has_option('BLACS', 'tab_runtime'):
+            tab_runtime = self.exp_config.get('BLACS', 'tab_runtime')
+            if tab_runtime == 'asyncio':
+                if PY2:
+                    logger.warning('The asyncio tab runtime requires Python 3, running tabs in threads')
+                else:
+                    from blacs.tab_async_runtime import AsyncTabRuntime
+                    from blacs.tab_base_classes import set_tab_runtime
+                    set_tab_runtime(AsyncTabRuntime())
+            elif tab_runtime != 'threads':
+                logger.warning('Unknown tab_runtime %s, running tabs in threads' % tab_runtime)
+        startup_profiler.begin_phase('Instantiating devices')
         self.failed_device_settings = {}
+        # Per-device timeouts, in seconds, after which tabs whose workers
+        # report no progress are restarted. Option names are lowercased by the
+        # config parser, so are matched case-insensitively:
+        hung_worker_timeouts = {}
+        if self.exp_config.has_section('BLACS/hung_worker_restart'):
+            for name, timeout in self.exp_config.items('BLACS/hung_worker_restart'):
+                try:
+                    hung_worker_timeouts[name.lower()] = float(timeout)
+                except ValueError:
+                    logger.error('Invalid hung worker restart timeout for %s: %s' % (name, timeout))
+        # Devices whose workers run on other computers, by a worker agent
+        # (see worker_agent.py) at host or host:port:
+        remote_worker_agents = {}
+        if self.exp_config.has_section('BLACS/remote_workers'):
+            from blacs.worker_agent import DEFAULT_AGENT_PORT
+            for name, value in self.exp_config.items('BLACS/remote_workers'):
+                try:
+                    if ':' in value:
+                        host, port = value.rsplit(':', 1)
+                        remote_worker_agents[name.lower()] = (host.strip(), int(port))
+                    else:
+                        remote_worker_agents[name.lower()] = (value.strip(), DEFAULT_AGENT_PORT)
+                except ValueError:
+                    logger.error('Invalid remote worker agent for %s: %s' % (name, value))
+            if remote_worker_agents:
+                # Remote workers send heartbeats and trace spans over the
+                # network. Listen for them only on the interfaces facing the
+                # agents, and only accept them from the agents' hosts:
+                from blacs.worker_agent import get_listen_addresses
+                agent_hosts = set(host for host, port in remote_worker_agents.values())
+                try:
+                    bind_addresses, allowed_addresses = get_listen_addresses(agent_hosts)
+                except socket.error:
+                    logger.exception('Could not find the addresses of worker agents %s' % ', '.join(sorted(agent_hosts)))
+                else:
+                    for listener in (heartbeat_monitor, tracer):
+                        listener.bind_addresses = bind_addresses
+                        listener.allowed_addresses = allowed_addresses
+        # Record spans of state functions, worker jobs and shot phases, and
+        # write a trace of each shot to trace_dir (see tracing.py):
+        if self.exp_config.has_option('BLACS', 'trace_dir'):
+            trace_dir = self.exp_config.get('BLACS', 'trace_dir')
+            try:
+                if not os.path.isdir(trace_dir):
+                    os.makedirs(trace_dir)
+                tracer.trace_dir = trace_dir
+                tracer.enable()
+                logger.info('Writing traces of shots to %s' % trace_dir)
+            except OSError:
+                logger.exception('Could not create trace directory %s, tracing disabled' % trace_dir)
+        # Where tabs write their workers' output whilst it is not shown, if anywhere:
+        output_spill_dir = None
+        if self.exp_config.has_option('BLACS', 'output_spill_dir'):
+            output_spill_dir = self.exp_config.get('BLACS', 'output_spill_dir')
+            try:
+                if not os.path.isdir(output_spill_dir):
+                    os.makedirs(output_spill_dir)
+            except OSError:
+                logger.exception('Could not create output spill directory %s' % output_spill_dir)
+                output_spill_dir = None
+        # Whether workers that support it should share a process:
+        co_host_workers = (self.exp_config.has_option('BLACS', 'co_host_workers') and
+                           self.exp_config.getboolean('BLACS', 'co_host_workers'))
         for device_name, labscript_device_class_name in list(self.attached_devices.items()):
             try:
-                self.settings_dict.setdefault(device_name,{"device_name":device_name})
-                # add common keys to settings:
-                self.settings_dict[device_name]["connection_table"] = self.connection_table
-                self.settings_dict[device_name]["front_panel_settings"] = settings[device_name] if device_name in settings else {}
-                self.settings_dict[device_name]["saved_data"] = tab_data[device_name]['data'] if device_name in tab_data else {}
-                # Instantiate the device
-                logger.info('instantiating %s'%device_name)
-                TabClass = labscript_devices.get_BLACS_tab(labscript_device_class_name)
-                self.tablist[device_name] = TabClass(self.tab_widgets[0],self.settings_dict[device_name])
+                with startup_profiler.timed(device_name):
+                    self.settings_dict.setdefault(device_name,{"device_name":device_name})
+                    # add common keys to settings:
+                    self.settings_dict[device_name]["connection_table"] = self.connection_table
+                    self.settings_dict[device_name]["hung_worker_timeout"] = hung_worker_timeouts.get(device_name.lower())
+                    self.settings_dict[device_name]["co_host_workers"] = co_host_workers
+                    self.settings_dict[device_name]["remote_worker_agent"] = remote_worker_agents.get(device_name.lower())
+                    self.settings_dict[device_name]["output_spill_dir"] = output_spill_dir
+                    self.settings_dict[device_name]["front_panel_settings"] = settings[device_name] if device_name in settings else {}
+                    self.settings_dict[device_name]["saved_data"] = tab_data[device_name]['data'] if device_name in tab_data else {}
+                    # Instantiate the device
+                    logger.info('instantiating %s'%device_name)
+                    TabClass = labscript_devices.get_BLACS_tab(labscript_device_class_name)
+                    self.tablist[device_name] = TabClass(self.tab_widgets[0],self.settings_dict[device_name])
             except Exception:
                 self.failed_device_settings[device_name] = {"front_panel": self.settings_dict[device_name]["front_panel_settings"], "save_data": self.settings_dict[device_name]["saved_data"]}
                 del self.settings_dict[device_name]
@@ -275,18 +369,24 @@ class BLACS(object):
                 raise_exception_in_thread(sys.exc_info())
 
         logger.info('instantiating plugins')
+        startup_profiler.begin_phase('Instantiating plugins')
         # setup the plugin system
         settings_pages = []
         self.plugins = {}
-        plugin_settings = eval(tab_data['BLACS settings']['plugin_data']) if 'plugin_data' in tab_data['BLACS settings'] else {}
-        for module_name, module in plugins.modules.items():
+        plugin_settings = tab_data['BLACS settings'].get('plugin_data', {})
+        plugin_modules = plugins.load_plugins(self.exp_config,
+                                              timer=lambda module_name: startup_profiler.timed(module_name, 'plugin import'))
+        for module_name, module in plugin_modules.items():
             try:
                 # instantiate the plugin
-                self.plugins[module_name] = module.Plugin(plugin_settings[module_name] if module_name in plugin_settings else {})
+                with startup_profiler.timed(module_name, 'plugin'):
+                    self.plugins[module_name] = module.Plugin(plugin_settings[module_name] if module_name in plugin_settings else {})
+                plugins.callback_registry.plugin_loaded(module_name, self.plugins[module_name])
             except Exception:
                 logger.exception('Could not instantiate plugin \'%s\'. Skipping' % module_name)
 
         logger.info('creating plugin tabs')
+        startup_profiler.begin_phase('Creating plugin tabs')
         # setup the plugin tabs
         for module_name, plugin in self.plugins.items():
             try:
@@ -309,29 +409,20 @@ class BLACS(object):
                 logger.exception('Could not instantiate tab for plugin \'%s\'. Skipping')
 
         logger.info('reordering tabs')
+        startup_profiler.begin_phase('Reordering tabs')
         self.order_tabs(tab_data)
 
         logger.info('starting analysis submission thread')
+        startup_profiler.begin_phase('Restoring analysis submission')
         # setup analysis submission
         self.analysis_submission = AnalysisSubmission(self,self.ui)
-        if 'analysis_data' not in tab_data['BLACS settings']:
-            tab_data['BLACS settings']['analysis_data'] = {}
-        else:
-            tab_data['BLACS settings']['analysis_data'] = eval(tab_data['BLACS settings']['analysis_data'])
-        self.analysis_submission.restore_save_data(tab_data['BLACS settings']["analysis_data"])
+        self.analysis_submission.restore_save_data(tab_data['BLACS settings'].get('analysis_data', {}))
 
         logger.info('starting queue manager thread')
+        startup_profiler.begin_phase('Restoring queue')
         # Setup the QueueManager
         self.queue = QueueManager(self,self.ui)
-        if 'queue_data' not in tab_data['BLACS settings']:
-            tab_data['BLACS settings']['queue_data'] = {}
-        else:
-            # quick fix for qt objects not loading that were saved before qtutil 2 changes
-            try:
-                tab_data['BLACS settings']['queue_data'] = eval(tab_data['BLACS settings']['queue_data'])
-            except NameError:
-                tab_data['BLACS settings']['queue_data'] = {}
-        self.queue.restore_save_data(tab_data['BLACS settings']['queue_data'])
+        self.queue.restore_save_data(tab_data['BLACS settings'].get('queue_data', {}))
 
         blacs_data = {'exp_config':self.exp_config,
                       'ui':self.ui,
@@ -362,6 +453,7 @@ class BLACS(object):
 
         # setup the Notification system
         logger.info('setting up notification system')
+        startup_profiler.begin_phase('Setting up plugin menus and notifications')
         self.notifications = Notifications(blacs_data)
 
         settings_callbacks = []
@@ -396,6 +488,7 @@ class BLACS(object):
 
         # setup the BLACS preferences system
         logger.info('setting up preferences system')
+        startup_profiler.begin_phase('Setting up preferences system')
         self.settings = Settings(file=self.settings_path, parent = self.ui, page_classes=settings_pages)
         for callback in settings_callbacks:
             self.settings.register_callback(callback)
@@ -403,6 +496,7 @@ class BLACS(object):
         # update the blacs_data dictionary with the settings system
         blacs_data['settings'] = self.settings
 
+        startup_profiler.begin_phase('Completing plugin setup')
         for module_name, plugin in self.plugins.items():
             try:
                 plugin.plugin_setup_complete(blacs_data)
@@ -415,6 +509,9 @@ class BLACS(object):
                 except Exception:
                     logger.exception('Plugin \'%s\' error. Plugin may not be functional.'%module_name)
 
+        # Plugins' callbacks may have changed now that they are set up:
+        plugins.callback_registry.invalidate()
+
         # Connect menu actions
         self.ui.actionOpenPreferences.triggered.connect(self.on_open_preferences)
         self.ui.actionSave.triggered.connect(self.on_save_front_panel)
@@ -426,6 +523,7 @@ class BLACS(object):
             self.ui.newWindow.connect(set_win_appusermodel)
 
         logger.info('showing UI')
+        startup_profiler.begin_phase('Showing UI')
         self.ui.show()
 
     def set_relaunch(self,value):
@@ -535,21 +633,9 @@ class BLACS(object):
                         self.update_all_tab_settings(settings,tab_data)
 
                         # restore queue data
-                        if 'queue_data' not in tab_data['BLACS settings']:
-                            tab_data['BLACS settings']['queue_data'] = {}
-                        else:
-                            # quick fix for qt objects not loading that were saved before qtutil 2 changes
-                            try:
-                                tab_data['BLACS settings']['queue_data'] = eval(tab_data['BLACS settings']['queue_data'])
-                            except NameError:
-                                tab_data['BLACS settings']['queue_data'] = {}
-                        self.queue.restore_save_data(tab_data['BLACS settings']['queue_data'])
+                        self.queue.restore_save_data(tab_data['BLACS settings'].get('queue_data', {}))
                         # restore analysis data
-                        if 'analysis_data' not in tab_data['BLACS settings']:
-                            tab_data['BLACS settings']['analysis_data'] = {}
-                        else:
-                            tab_data['BLACS settings']['analysis_data'] = eval(tab_data['BLACS settings']['analysis_data'])
-                        self.analysis_submission.restore_save_data(tab_data['BLACS settings']["analysis_data"])
+                        self.analysis_submission.restore_save_data(tab_data['BLACS settings'].get('analysis_data', {}))
                 except Exception as e:
                     logger.exception("Unable to load the front panel in %s."%(filepath))
                     message = QMessageBox()
@@ -682,6 +768,7 @@ if __name__ == '__main__':
         ##########
 
 
+    startup_profiler.begin_phase('Loading lab config')
     settings_path = os.path.join(config_prefix,'%s_BLACS.h5'%hostname)
     required_config_params = {"DEFAULT":["experiment_name"],
                               "programs":["text_editor",
@@ -697,22 +784,28 @@ if __name__ == '__main__':
 
     port = int(exp_config.get('ports','BLACS'))
 
+    startup_profiler.begin_phase('Starting experiment server')
     # Start experiment server
     experiment_server = ExperimentServer(port)
 
     # Create Connection Table object
     logger.info('About to load connection table: %s'%exp_config.get('paths','connection_table_h5'))
+    startup_profiler.begin_phase('Loading connection table')
     connection_table_h5_file = exp_config.get('paths','connection_table_h5')
     connection_table = ConnectionTable(connection_table_h5_file, logging_prefix='BLACS', exceptions_in_thread=True)
 
     logger.info('connection table loaded')
 
+    startup_profiler.begin_phase('Instantiating QApplication')
     qapplication = QApplication(sys.argv)
     qapplication.setAttribute(Qt.AA_DontShowIconsInMenus, False)
     logger.info('QApplication instantiated')
     app = BLACS(qapplication)
 
     logger.info('BLACS instantiated')
+    # Startup is complete once the event loop first runs and the window is drawn:
+    startup_profiler.begin_phase('Starting event loop')
+    QTimer.singleShot(0, startup_profiler.finish)
     def execute_program():
         qapplication.exec_()
 
@@ -23,27 +23,345 @@ import os
 import threading
 import time
 import sys
+import pickle
+import random
+import sqlite3
+from collections import deque
+
+import zmq
 
 from qtutils.qt.QtCore import *
 from qtutils.qt.QtGui import *
 from qtutils.qt.QtWidgets import *
 
 from qtutils import *
-from zprocess import zmq_get, TimeoutError, raise_exception_in_thread
-from socket import gaierror
+from zprocess import TimeoutError, raise_exception_in_thread
+from socket import gaierror, gethostbyname
 import labscript_utils.shared_drive
 from labscript_utils.qtwidgets.elide_label import elide_label
 from blacs import BLACS_DIR
 
+# The maximum number of submissions awaiting a response from lyse at once:
+MAX_IN_FLIGHT = 16
+# How long to wait for each response before deciding lyse is not responding:
+RESPONSE_TIMEOUT = 1
+# Bounds on the interval between connectivity checks whilst lyse is offline.
+# The interval doubles after each failed check, with random jitter:
+BACKOFF_MIN = 1
+BACKOFF_MAX = 60
+
+
+class PipelinedSubmitter(object):
+    """Sends requests to lyse over a persistent DEALER socket connected to its
+    REP socket, with up to max_in_flight requests outstanding at a time rather
+    than waiting for each response before sending the next request. lyse's REP
+    socket replies to requests in the order they were sent, so responses are
+    matched to requests in order.
+
+    If lyse stops responding, the connection is closed and reopened, so that
+    any late responses are discarded and the unacknowledged requests can be
+    resent. lyse may therefore receive a request more than once, but no
+    request is considered delivered until it has been acknowledged."""
+
+    def __init__(self, port, max_in_flight=MAX_IN_FLIGHT, timeout=RESPONSE_TIMEOUT):
+        self.port = port
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.context = zmq.Context.instance()
+        self.sock = None
+        self.host = None
+        self.logger = logging.getLogger('BLACS.AnalysisSubmission.submitter')
+
+    def _connect(self, host):
+        self.reset()
+        # Raises gaierror if the host cannot be resolved:
+        address = gethostbyname(host)
+        self.sock = self.context.socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.connect('tcp://%s:%d' % (address, self.port))
+        self.host = host
+
+    def reset(self):
+        """Close the connection, discarding any outstanding responses"""
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.host = None
+
+    def _send(self, request):
+        # DEALER sockets must send the empty delimiter frame that REQ sockets
+        # add automatically:
+        self.sock.send(b'', zmq.SNDMORE)
+        self.sock.send_pyobj(request, protocol=2)
+
+    def _recv(self):
+        """Return the next response, or raise TimeoutError if there is none
+        within the timeout"""
+        if not self.sock.poll(self.timeout * 1000):
+            raise TimeoutError('No response from %s:%d' % (self.host, self.port))
+        frames = self.sock.recv_multipart()
+        return pickle.loads(frames[-1])
+
+    def submit(self, host, requests, on_response):
+        """Send requests to lyse on host, in order. on_response(request,
+        response) is called with each response, in order, and should return
+        whether the response indicates success. Returns True if all requests
+        were successful. Otherwise, submission stops at the first failure or
+        timeout, the connection is reset, and False is returned. Requests
+        that on_response was not called for should be resubmitted later."""
+        try:
+            if self.sock is None or host != self.host:
+                self._connect(host)
+            requests = iter(requests)
+            in_flight = deque()
+            exhausted = False
+            while True:
+                while not exhausted and len(in_flight) < self.max_in_flight:
+                    try:
+                        request = next(requests)
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        self._send(request)
+                        in_flight.append(request)
+                if not in_flight:
+                    return True
+                response = self._recv()
+                if not on_response(in_flight.popleft(), response):
+                    self.reset()
+                    return False
+        except (TimeoutError, gaierror, zmq.ZMQError) as e:
+            self.logger.info('Submission to %s failed: %s' % (host, str(e)))
+            self.reset()
+            return False
+
+    def request(self, host, request):
+        """Send a single request and return the response, or None if there
+        was no response"""
+        responses = []
+        def on_response(request, response):
+            responses.append(response)
+            return True
+        if self.submit(host, [request], on_response):
+            return responses[0]
+        return None
+
+
+class AnnouncementListener(object):
+    """Subscribes to the announcements lyse publishes when it comes online,
+    calling callback() for each one. The host is set with set_host(), and the
+    subscription follows it if it changes."""
+
+    def __init__(self, port, callback):
+        self.port = port
+        self.callback = callback
+        self.host = None
+        self.context = zmq.Context.instance()
+        self.logger = logging.getLogger('BLACS.AnalysisSubmission.announcements')
+        self.mainloop_thread = threading.Thread(target=self.mainloop)
+        self.mainloop_thread.daemon = True
+        self.mainloop_thread.start()
+
+    def set_host(self, host):
+        self.host = host
+
+    def mainloop(self):
+        sock = None
+        host = None
+        while True:
+            try:
+                if self.host != host:
+                    if sock is not None:
+                        sock.close()
+                        sock = None
+                    host = self.host
+                    if host:
+                        sock = self.context.socket(zmq.SUB)
+                        sock.setsockopt(zmq.LINGER, 0)
+                        sock.setsockopt(zmq.SUBSCRIBE, b'')
+                        sock.connect('tcp://%s:%d' % (gethostbyname(host), self.port))
+                if sock is None:
+                    time.sleep(1)
+                    continue
+                if sock.poll(1000):
+                    sock.recv_multipart()
+                    self.logger.info('lyse on %s announced it is online' % host)
+                    self.callback()
+            except Exception:
+                # Most likely the host could not be resolved. Try again
+                # when it changes, or after a pause:
+                self.logger.exception('Error subscribing to announcements from %s' % host)
+                if sock is not None:
+                    sock.close()
+                    sock = None
+                time.sleep(1)
+
+
+class SubmissionSpool(object):
+    """The files waiting to be submitted for analysis, in order. These are
+    stored in an SQLite database as well as in memory, so that they survive
+    BLACS crashing, and are reloaded from the database on startup. Files are
+    added to the end of the spool and acknowledged from the front, so a deque
+    is used to keep this fast for large backlogs. created is True if the
+    database did not exist before, and False if it was reloaded."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.created = not self.db.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='pending'").fetchall()
+        self.db.execute('CREATE TABLE IF NOT EXISTS pending '
+                        '(id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL)')
+        # (id, path) of each pending file:
+        self._entries = deque((row_id, str(path)) for row_id, path in
+                              self.db.execute('SELECT id, path FROM pending ORDER BY id'))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __bool__(self):
+        return bool(self._entries)
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        with self.lock:
+            paths = [path for row_id, path in self._entries]
+        return iter(paths)
+
+    def append(self, path):
+        self.extend([path])
+
+    def extend(self, paths):
+        with self.lock:
+            self.db.execute('BEGIN')
+            try:
+                for path in paths:
+                    cursor = self.db.execute('INSERT INTO pending (path) VALUES (?)', (path,))
+                    self._entries.append((cursor.lastrowid, path))
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def acknowledge(self, path):
+        """Remove path from the front of the spool, if it is there. Returns
+        whether it was"""
+        with self.lock:
+            if not self._entries or self._entries[0][1] != path:
+                return False
+            row_id, path = self._entries.popleft()
+            self.db.execute('DELETE FROM pending WHERE id = ?', (row_id,))
+            return True
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self.db.execute('DELETE FROM pending')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class AnalysisSubmission(object):
+    """Submits completed shots to one or more analysis targets. The primary
+    target is lyse, on the port given by the 'lyse' option in the 'ports'
+    section of the lab config. Additional targets can be configured in the
+    'BLACS/analysis_targets' section, one per line, as either 'name = port'
+    or 'name = host:port'. Each target has its own spool, thread,
+    connectivity state and controls, so a slow or offline target does not
+    delay the others."""
+
+    TARGETS_SECTION = 'BLACS/analysis_targets'
 
-class AnalysisSubmission(object):        
     def __init__(self, BLACS, blacs_ui):
+        self.BLACS = BLACS
+        exp_config = self.BLACS.exp_config
+        announce_port = None
+        if exp_config.has_option('ports', 'lyse_announce'):
+            announce_port = int(exp_config.get('ports', 'lyse_announce'))
+        settings_prefix = os.path.splitext(self.BLACS.settings_path)[0]
+        self.primary = AnalysisTarget(BLACS, blacs_ui, 'lyse', int(exp_config.get('ports', 'lyse')),
+                                      settings_prefix + '_analysis_spool.db', announce_port=announce_port)
+        # Additional targets, in the order they are configured:
+        self.targets = []
+        if exp_config.has_section(self.TARGETS_SECTION):
+            for name, value in exp_config.items(self.TARGETS_SECTION):
+                if ':' in value:
+                    default_server, port = value.rsplit(':', 1)
+                else:
+                    default_server, port = '', value
+                try:
+                    target = AnalysisTarget(BLACS, blacs_ui, name, int(port),
+                                            settings_prefix + '_analysis_spool_%s.db' % name,
+                                            default_server=default_server.strip())
+                except Exception:
+                    logging.getLogger('BLACS.AnalysisSubmission').exception(
+                        'Could not set up analysis target \'%s\'. Skipping' % name)
+                else:
+                    self.targets.append(target)
+        self._queue = _FanOutQueue([target.get_queue() for target in self.all_targets])
+
+    @property
+    def all_targets(self):
+        return [self.primary] + self.targets
+
+    def restore_save_data(self, data):
+        self.primary.restore_save_data(data)
+        target_data = data.get('targets', {})
+        for target in self.targets:
+            target.restore_save_data(target_data.get(target.name, {}))
+
+    def get_save_data(self):
+        # The primary target's data is kept at the top level, for
+        # compatibility with settings saved before there were other targets:
+        data = self.primary.get_save_data()
+        data['targets'] = {target.name: target.get_save_data() for target in self.targets}
+        return data
+
+    def get_queue(self):
+        """Return a queue-like object whose put() method sends a message to
+        every target"""
+        return self._queue
+
+    def clear_waiting_files(self):
+        for target in self.all_targets:
+            target.clear_waiting_files()
+
+    def check_retry(self):
+        for target in self.all_targets:
+            target.check_retry()
+
+
+class _FanOutQueue(object):
+    """Puts each item into several queues"""
+    def __init__(self, queues):
+        self.queues = queues
+
+    def put(self, item):
+        for q in self.queues:
+            q.put(item)
+
+
+class AnalysisTarget(object):
+    """Submits completed shots to a single analysis server"""
+    def __init__(self, BLACS, blacs_ui, name, port, spool_path, default_server='', announce_port=None):
         self.inqueue = queue.Queue()
         self.BLACS = BLACS
-        self.port = int(self.BLACS.exp_config.get('ports', 'lyse'))
+        self.name = name
+        self.port = port
+        self.default_server = default_server
+        self.logger = logging.getLogger('BLACS.AnalysisSubmission.%s' % name)
         
         self._ui = UiLoader().load(os.path.join(BLACS_DIR, 'analysis_submission.ui'))
         blacs_ui.analysis.addWidget(self._ui)
+        if name != 'lyse':
+            self._ui.send_to_server.setText(name)
+            self._ui.send_to_server.setToolTip('Send completed shot files to %s' % name)
         self._ui.frame.setMinimumWidth(blacs_ui.queue_controls_frame.sizeHint().width())
         elide_label(self._ui.resend_shots_label, self._ui.failed_to_send_frame.layout(), Qt.ElideRight)
         # connect signals
@@ -52,11 +370,28 @@ class AnalysisSubmission(object):
         self._ui.clear_unsent_shots_button.clicked.connect(lambda _: self.clear_waiting_files())
         self._ui.retry_button.clicked.connect(lambda _: self.check_retry())
 
-        self._waiting_for_submission = []
+        # Optional subscription to announcements from lyse when it comes
+        # online, so that waiting files can be sent straight away:
+        self.announcements = None
+        if announce_port is not None:
+            self.announcements = AnnouncementListener(announce_port,
+                                                      lambda: self.inqueue.put(['server announced', None]))
+
+        # Placeholder until the spool is loaded, so that initialising
+        # send_to_server below does not clear the spool:
+        self._waiting_for_submission = deque()
         self.server_online = 'offline'
         self.send_to_server = False
-        self.server = ''
-        self.time_of_last_connectivity_check = 0
+        self.server = default_server
+        self._waiting_for_submission = SubmissionSpool(spool_path)
+        if self._waiting_for_submission:
+            self.logger.info(
+                'Reloaded %d shot(s) waiting to be sent for analysis' % len(self._waiting_for_submission))
+        self._backoff = BACKOFF_MIN
+        # When to next check connectivity and retry sending files, or None if
+        # not until a file arrives or a retry is requested:
+        self._next_check_time = None
+        self.submitter = PipelinedSubmitter(self.port)
 
         self.mainloop_thread = threading.Thread(target=self.mainloop)
         self.mainloop_thread.daemon = True
@@ -71,8 +406,11 @@ class AnalysisSubmission(object):
             self.server = data["server"]
         if "send_to_server" in data:
             self.send_to_server = data["send_to_server"]
-        if "waiting_for_submission" in data:
-            self._waiting_for_submission = list(data["waiting_for_submission"])
+        if "waiting_for_submission" in data and self._waiting_for_submission.created:
+            # Settings saved before the spool existed. Once the spool exists,
+            # it is the only record of the files waiting to be sent, as the
+            # settings may be older than it, for instance after a crash:
+            self._waiting_for_submission.extend([str(path) for path in data["waiting_for_submission"]])
         self.inqueue.put(['save data restored', None])
         self.check_retry()
             
@@ -118,6 +456,8 @@ class AnalysisSubmission(object):
     def server(self,value):
         self._server = value
         self._ui.server.setText(self.server)
+        if self.announcements is not None:
+            self.announcements.set_host(self.server)
 
     @property
     @inmain_decorator(True)
@@ -172,7 +512,7 @@ class AnalysisSubmission(object):
 
     @inmain_decorator(True)
     def clear_waiting_files(self):
-        self._waiting_for_submission = []
+        self._waiting_for_submission.clear()
         self.update_waiting_files_message()
 
     @inmain_decorator(True)
@@ -180,44 +520,45 @@ class AnalysisSubmission(object):
         self.inqueue.put(['check/retry', None])
 
     def mainloop(self):
-        self._mainloop_logger = logging.getLogger('BLACS.AnalysisSubmission.mainloop')
+        self._mainloop_logger = logging.getLogger('BLACS.AnalysisSubmission.%s.mainloop' % self.name)
         # Ignore signals until save data is restored:
         while self.inqueue.get()[0] != 'save data restored':
             pass
-        timeout = 10
         while True:
             try:
+                if self._next_check_time is None:
+                    timeout = None
+                else:
+                    timeout = max(0, self._next_check_time - time.time())
                 try:
                     signal, data = self.inqueue.get(timeout=timeout)
                 except queue.Empty:
-                    timeout = 10
-                    # Periodic checking of connectivity and resending of files.
-                    # Don't trigger a re-check if we already failed a connectivity
-                    # check within the last second:
-                    if (time.time() - self.time_of_last_connectivity_check) > 1:
-                        signal = 'check/retry'
-                    else:
-                        continue
-                if signal == 'check/retry':
-                    self.check_connectivity()
-                    if self.server_online == 'online':
-                        self.submit_waiting_files()
+                    # Scheduled check of connectivity and resending of files:
+                    signal = 'scheduled check/retry'
+                if signal in ('check/retry', 'server announced'):
+                    # Requested by the user, or lyse has just come online. Check
+                    # now, and start again from the shortest backoff interval
+                    # if the check fails:
+                    self._backoff = BACKOFF_MIN
+                    self.check_and_submit()
+                elif signal == 'scheduled check/retry':
+                    self.check_and_submit()
                 elif signal == 'file':
                     if self.send_to_server:
                         self._waiting_for_submission.append(data)
-                        if self.server_online != 'online':
-                            # Don't stack connectivity checks if many files are
-                            # arriving. If we failed a connectivity check less
-                            # than a second ago then don't check again.
-                            if (time.time() - self.time_of_last_connectivity_check) > 1:
-                                self.check_connectivity()
-                            else:
-                                # But do queue up a check for when we have
-                                # been idle for one second:
-                                timeout = 1
                         if self.server_online == 'online':
                             self.submit_waiting_files()
+                            self._schedule_next_check()
+                        else:
+                            # Don't check connectivity for every file that
+                            # arrives whilst lyse is offline. The file will
+                            # be sent after the next scheduled check succeeds:
+                            if self._next_check_time is None:
+                                self._next_check_time = time.time()
+                            self.update_waiting_files_message()
                 elif signal == 'close':
+                    self.submitter.reset()
+                    self._waiting_for_submission.close()
                     break
                 elif signal == 'save data restored':
                     continue
@@ -235,41 +576,55 @@ class AnalysisSubmission(object):
         send_to_server = self.send_to_server
         if host and send_to_server:       
             self.server_online = 'checking'         
-            try:
-                response = zmq_get(self.port, host, 'hello', timeout=1)
-            except (TimeoutError, gaierror):
-                success = False
-            else:
-                success = (response == 'hello')
+            response = self.submitter.request(host, 'hello')
+            success = (response == 'hello')
                 
             # update GUI
             self.server_online = 'online' if success else 'offline'
         else:
             self.server_online = ''
 
-        self.time_of_last_connectivity_check = time.time()
+    def check_and_submit(self):
+        self.check_connectivity()
+        if self.server_online == 'online':
+            self.submit_waiting_files()
+        self._schedule_next_check()
+
+    def _schedule_next_check(self):
+        """Schedule the next connectivity check based on the outcome of the
+        last one. Whilst lyse is offline, checks are made at exponentially
+        increasing intervals, with random jitter so that many BLACS instances do
+        not check in lockstep. Otherwise no check is scheduled; one will be made
+        when a file fails to send, a retry is requested, or lyse announces that
+        it is online."""
+        if self.server_online == 'offline':
+            delay = random.uniform(0.5, 1) * self._backoff
+            self._backoff = min(2 * self._backoff, BACKOFF_MAX)
+            self._next_check_time = time.time() + delay
+            self._mainloop_logger.debug('Server offline, next check in %.1fs' % delay)
+        else:
+            self._backoff = BACKOFF_MIN
+            self._next_check_time = None
 
     def submit_waiting_files(self):
-        success = True
-        while self._waiting_for_submission and success:
-            path = self._waiting_for_submission[0]
+        if not self._waiting_for_submission:
+            self.server_online = 'online'
+            return
+        self.server_online = 'checking'
+        paths = deque(self._waiting_for_submission)
+        requests = []
+        for path in paths:
             self._mainloop_logger.info('Submitting run file %s.\n'%os.path.basename(path))
-            data = {'filepath': labscript_utils.shared_drive.path_to_agnostic(path)}
-            self.server_online = 'checking'
-            try:
-                response = zmq_get(self.port, self.server, data, timeout=1)
-            except (TimeoutError, gaierror):
-                success = False
-            else:
-                success = (response == 'added successfully')
-                try:
-                    self._waiting_for_submission.pop(0) 
-                except IndexError:
-                    # Queue has been cleared
-                    pass
-            if not success:
-                break
+            requests.append({'filepath': labscript_utils.shared_drive.path_to_agnostic(path)})
+
+        def on_response(request, response):
+            path = paths.popleft()
+            # Files are submitted in order, so the acknowledged file is at
+            # the front of the spool, unless the spool has been cleared:
+            self._waiting_for_submission.acknowledge(path)
+            return response == 'added successfully'
+
+        success = self.submitter.submit(self.server, requests, on_response)
         # update GUI
         self.server_online = 'online' if success else 'offline'
-        self.time_of_last_connectivity_check = time.time()
         
@@ -0,0 +1,168 @@
+#####################################################################
+#                                                                   #
+# /buffered_outputbox.py                                            #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import logging
+import logging.handlers
+import threading
+import time
+from collections import deque
+
+import zmq
+
+from qtutils import inmain_later
+from qtutils.qt.QtCore import QObject, QEvent
+from qtutils.outputbox import OutputBox
+
+from labscript_utils import check_version
+# For OutputBox.add_text() taking a character format:
+check_version('qtutils', '2.1.0', '3.0.0')
+
+if PY2:
+    monotonic = time.time
+else:
+    monotonic = time.monotonic
+
+# The most often output is rendered, in seconds between renders:
+FLUSH_INTERVAL = 0.1
+# Lines of output kept, both in the text widget and waiting to be rendered:
+SCROLLBACK_LINES = 1000
+# Size and number of the rotating files output is spilled to:
+SPILL_MAX_BYTES = 10 * 1024**2
+SPILL_BACKUP_COUNT = 5
+
+# Spill file path: handler, shared by the output boxes of successive
+# instances of a restarted tab, so that only one handler rotates each file:
+_spill_handlers = {}
+_spill_handlers_lock = threading.Lock()
+
+
+def _get_spill_handler(path):
+    with _spill_handlers_lock:
+        if path not in _spill_handlers:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=SPILL_MAX_BYTES,
+                                                           backupCount=SPILL_BACKUP_COUNT, encoding='utf8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            _spill_handlers[path] = handler
+        return _spill_handlers[path]
+
+
+class VisibilityFilter(QObject):
+    """Tells an output box when its text widget is shown or hidden, including
+    by its tab being switched away from"""
+    def __init__(self, output_box):
+        QObject.__init__(self)
+        self.output_box = output_box
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Show:
+            self.output_box._set_visible(True)
+        elif event.type() == QEvent.Hide:
+            self.output_box._set_visible(False)
+        return False
+
+
+class BufferedOutputBox(OutputBox):
+    """An OutputBox for output that may arrive faster than it can usefully be
+    shown. Output is collected in a background thread into a buffer of at
+    most scrollback_lines lines, the oldest being dropped first, and the
+    buffer is rendered in the main thread at most once per flush_interval.
+    Nothing is rendered whilst the text widget is not visible, and the last
+    scrollback_lines lines are rendered when it is next shown. If spill_path
+    is given, output received whilst the widget is not visible is also
+    written to that file, which is rotated once it reaches SPILL_MAX_BYTES."""
+    def __init__(self, container, scrollback_lines=SCROLLBACK_LINES, flush_interval=FLUSH_INTERVAL,
+                 spill_path=None, **kwargs):
+        self.flush_interval = flush_interval
+        # (charformat_repr, line) tuples waiting to be rendered, each line
+        # keeping its line ending, if any:
+        self._lines = deque(maxlen=scrollback_lines)
+        self._lines_lock = threading.Lock()
+        self._render_requested = False
+        # Only changed in the main thread:
+        self._visible = False
+        self._spill_handler = None
+        if spill_path is not None:
+            try:
+                self._spill_handler = _get_spill_handler(spill_path)
+            except (IOError, OSError):
+                logging.getLogger('BLACS.output').exception('Could not open output spill file %s' % spill_path)
+        # Starts the thread running mainloop(), so our attributes must be set first:
+        OutputBox.__init__(self, container, scrollback_lines=scrollback_lines, **kwargs)
+        self._visibility_filter = VisibilityFilter(self)
+        self.output_textedit.installEventFilter(self._visibility_filter)
+
+    def mainloop(self, socket):
+        last_flush = 0
+        unflushed = False
+        while True:
+            if unflushed:
+                # Wait for more output until the next flush is due:
+                timeout = max(0, last_flush + self.flush_interval - monotonic())
+                ready = socket.poll(1000 * timeout)
+            else:
+                ready = socket.poll()
+            if ready:
+                while True:
+                    try:
+                        charformat_repr, text = socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self._buffer(charformat_repr.decode('utf8'), text.decode('utf8'))
+                    unflushed = True
+            if unflushed and monotonic() >= last_flush + self.flush_interval:
+                self._request_render()
+                last_flush = monotonic()
+                unflushed = False
+
+    def _buffer(self, charformat_repr, text):
+        lines = text.splitlines(True)
+        with self._lines_lock:
+            for line in lines:
+                self._lines.append((charformat_repr, line))
+        if self._spill_handler is not None and not self._visible:
+            for line in lines:
+                record = logging.LogRecord('BLACS.output', logging.INFO, __file__, 0, line.rstrip('\r\n'), None, None)
+                self._spill_handler.handle(record)
+
+    def _request_render(self):
+        with self._lines_lock:
+            if self._render_requested:
+                return
+            self._render_requested = True
+        inmain_later(self._render)
+
+    def _render(self):
+        with self._lines_lock:
+            self._render_requested = False
+            if not self._visible:
+                # Keep the output for when the widget is next shown:
+                return
+            lines = list(self._lines)
+            self._lines.clear()
+        # Render runs of lines with the same format together:
+        runs = []
+        for charformat_repr, line in lines:
+            if runs and runs[-1][0] == charformat_repr:
+                runs[-1][1].append(line)
+            else:
+                runs.append((charformat_repr, [line]))
+        for charformat_repr, run in runs:
+            # Called directly, as we are in the main thread:
+            self.add_text(''.join(run), charformat_repr)
+
+    def _set_visible(self, visible):
+        self._visible = visible
+        if visible:
+            self._request_render()
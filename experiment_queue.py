@@ -25,6 +25,7 @@ import threading
 import time
 import sys
 import shutil
+from collections import deque
 
 from qtutils.qt.QtCore import *
 from qtutils.qt.QtGui import *
@@ -41,9 +42,17 @@ from labscript_utils.connections import ConnectionTable
 
 from blacs.tab_base_classes import MODE_MANUAL, MODE_TRANSITION_TO_BUFFERED, MODE_TRANSITION_TO_MANUAL, MODE_BUFFERED  
 import blacs.plugins as plugins
+from blacs.resource_monitor import resource_monitor
+from blacs.tracing import tracer
 
 
 FILEPATH_COLUMN = 0
+# Item data role flagging files restored into the queue that have not yet been
+# checked against the connection table:
+UNVALIDATED_ROLE = Qt.UserRole + 1
+# How many times in a row a shot may be requeued after a hung device is
+# restarted automatically. After this, the queue is paused instead:
+MAX_AUTOMATIC_RESTARTS = 3
 
 class QueueTreeview(QTreeView):
     def __init__(self,*args,**kwargs):
@@ -111,6 +120,19 @@ class QueueManager(object):
         self.master_pseudoclock = self.BLACS.connection_table.master_pseudoclock
         
         self._logger = logging.getLogger('BLACS.QueueManager')   
+        # Shots requeued in a row after automatic restarts of hung devices:
+        self._automatic_restarts = 0
+
+        # Files restored into the queue at startup are validated lazily in a
+        # background thread, in queue order. The lock is held whilst a file is
+        # being validated, so that the manager does not take a file from the
+        # queue that is partway through validation:
+        self._unvalidated_items = deque()
+        self._validation_lock = threading.Lock()
+        self._validation_requests = queue.Queue()
+        self.validator = threading.Thread(target = self._validate_restored_files)
+        self.validator.daemon = True
+        self.validator.start()
         
         # Create listview model
         self._model = QStandardItemModel()
@@ -134,6 +156,15 @@ class QueueManager(object):
         # Set the elision of the status labels:
         elide_label(self._ui.queue_status, self._ui.queue_status_verticalLayout, Qt.ElideRight)
         elide_label(self._ui.running_shot_name, self._ui.queue_status_verticalLayout, Qt.ElideLeft)
+
+        # Shown when files restored into the queue are removed from it as
+        # they cannot be run, until dismissed. Lists them in its tooltip:
+        self._dropped_files = []
+        self._dropped_files_label = QLabel()
+        self._dropped_files_label.setWordWrap(True)
+        self._dropped_files_label.linkActivated.connect(lambda link: self._dismiss_dropped_files())
+        self._dropped_files_label.hide()
+        self._ui.queue_status_verticalLayout.addWidget(self._dropped_files_label)
         
         # Set up repeat mode button menu:
         self.repeat_mode_menu = QMenu(self._ui)
@@ -180,11 +211,13 @@ class QueueManager(object):
         if 'manager_repeat_mode' in data:
             self.manager_repeat_mode = data['manager_repeat_mode']
         if 'files_queued' in data:
-            file_list = list(data['files_queued'])
+            file_list = [str(file) for file in data['files_queued']]
             self._model.clear()
             self._create_headers()
-            for file in file_list:
-                self.process_request(str(file))
+            # Don't validate the files now, as this can take a long time for
+            # a long queue. They will be validated in the background, or just
+            # before they are run, whichever comes first:
+            self.append(file_list, validated=False)
         if 'last_opened_shots_folder' in data:
             self.last_opened_shots_folder = data['last_opened_shots_folder']
         
@@ -359,23 +392,112 @@ class QueueManager(object):
                 row += 1
     
     @inmain_decorator(True)
-    def append(self, h5files):
+    def append(self, h5files, validated=True):
         for file in h5files:
             item = QStandardItem(file)
-            item.setToolTip(file)
+            if validated:
+                item.setToolTip(file)
+            else:
+                item.setData(True, UNVALIDATED_ROLE)
+                item.setToolTip('%s\n(not yet validated)' % file)
+                item.setForeground(QBrush(Qt.gray))
+                self._unvalidated_items.append(item)
             self._model.appendRow(item)
+        if not validated:
+            self._validation_requests.put(None)
+
+    @inmain_decorator(True)
+    def _get_unvalidated_item_path(self, item):
+        """Return the path of an item awaiting validation, or None if it has
+        since been removed from the queue"""
+        try:
+            if item.model() is not self._model:
+                return None
+        except RuntimeError:
+            # The underlying C++ object has been deleted by clearing the queue
+            return None
+        return str(item.text())
+
+    @inmain_decorator(True)
+    def _finish_validation(self, item, path, message):
+        """Update an item in the queue with the results of validation. If path
+        is None, the file cannot be run and is removed from the queue."""
+        if self._get_unvalidated_item_path(item) is None:
+            return
+        if path is None:
+            self._model.removeRow(item.row())
+            self._report_dropped_file(str(item.text()), message)
+        else:
+            item.setText(path)
+            item.setToolTip(path)
+            item.setData(False, UNVALIDATED_ROLE)
+            item.setForeground(QBrush())
+
+    def _validate_restored_files(self):
+        logger = logging.getLogger('BLACS.QueueManager.validator')
+        # Silence spurious HDF5 errors in this thread, as in the manager thread:
+        h5py._errors.silence_errors()
+        while True:
+            self._validation_requests.get()
+            while self._unvalidated_items:
+                with self._validation_lock:
+                    try:
+                        item = self._unvalidated_items.popleft()
+                    except IndexError:
+                        break
+                    path = self._get_unvalidated_item_path(item)
+                    if path is None:
+                        continue
+                    try:
+                        new_path, message = self.prepare_file(path, queued_item=item)
+                    except Exception:
+                        logger.exception('Error validating %s' % path)
+                        new_path, message = None, 'Error validating file\n'
+                    self._finish_validation(item, new_path, message)
     
+    @inmain_decorator(True)
+    def _report_dropped_file(self, path, message):
+        """Tell the user that a file restored into the queue was removed from
+        it because it cannot be run"""
+        self._logger.warning('Removing %s from the queue: %s' % (path, message.strip()))
+        self._dropped_files.append('%s: %s' % (path, message.strip()))
+        self._dropped_files_label.setText(
+            '<span style="color: red">%d restored file(s) could not be run and were removed from the queue.</span> '
+            % len(self._dropped_files) + '<a href="dismiss">Dismiss</a>')
+        self._dropped_files_label.setToolTip('\n\n'.join(self._dropped_files))
+        self._dropped_files_label.show()
+
+    def _dismiss_dropped_files(self):
+        self._dropped_files = []
+        self._dropped_files_label.hide()
+
     @inmain_decorator(True)
     def prepend(self,h5file):
         if not self.is_in_queue(h5file):
             self._model.insertRow(0,QStandardItem(h5file))
     
     def process_request(self,h5_filepath):
+        path, message = self.prepare_file(h5_filepath)
+        if path is None:
+            return message
+        self.append([path])
+        if self.manager_paused:
+            message += "Warning: Queue is currently paused\n"
+        if not self.manager_running:
+            message = "Error: Queue is not running\n"
+        return message
+
+    def prepare_file(self, h5_filepath, check_queue=True, queued_item=None):
+        """Check a shot file can be run, creating a fresh copy of it to run if
+        it has already been run (or, if check_queue is True, if it is already
+        in the queue). If the file is already in the queue as queued_item, only
+        the items ahead of it are checked. Returns (path, message), where path
+        is the file to be queued, or None if the file cannot be run."""
         # check connection table
         try:
             new_conn = ConnectionTable(h5_filepath, logging_prefix='BLACS')
         except Exception:
-            return "H5 file not accessible to Control PC\n"
+            return None, "H5 file not accessible to Control PC\n"
         result,error = inmain(self.BLACS.connection_table.compare_to,new_conn)
         if result:
             # Has this run file been run already?
@@ -384,7 +506,7 @@ class QueueManager(object):
                     rerun = True
                 else:
                     rerun = False
-            if rerun or self.is_in_queue(h5_filepath):
+            if rerun or (check_queue and self.is_in_queue(h5_filepath, ahead_of=queued_item)):
                 self._logger.debug('Run file has already been run! Creating a fresh copy to rerun')
                 new_h5_filepath, repeat_number = self.new_rep_name(h5_filepath)
                 # Keep counting up until we get a filename that isn't in the filesystem:
@@ -392,17 +514,10 @@ class QueueManager(object):
                     new_h5_filepath, repeat_number = self.new_rep_name(new_h5_filepath)
                 success = self.clean_h5_file(h5_filepath, new_h5_filepath, repeat_number=repeat_number)
                 if not success:
-                   return 'Cannot create a re run of this experiment. Is it a valid run file?'
-                self.append([new_h5_filepath])
-                message = "Experiment added successfully: experiment to be re-run\n"
+                   return None, 'Cannot create a re run of this experiment. Is it a valid run file?'
+                return new_h5_filepath, "Experiment added successfully: experiment to be re-run\n"
             else:
-                self.append([h5_filepath])
-                message = "Experiment added successfully\n"
-            if self.manager_paused:
-                message += "Warning: Queue is currently paused\n"
-            if not self.manager_running:
-                message = "Error: Queue is not running\n"
-            return message
+                return h5_filepath, "Experiment added successfully\n"
         else:
             # TODO: Parse and display the contents of "error" in a more human readable format for analysis of what is wrong!
             message =  ("Connection table of your file is not a subset of the experimental control apparatus.\n"
@@ -414,7 +529,7 @@ class QueueManager(object):
                        "\n"
                        "Please verify your experiment script matches the current experiment configuration, and try again\n"
                        "The error was %s\n"%error)
-            return message
+            return None, message
             
     def new_rep_name(self, h5_filepath):
         basename, ext = os.path.splitext(h5_filepath)
@@ -449,8 +564,16 @@ class QueueManager(object):
         return True
     
     @inmain_decorator(wait_for_return=True)    
-    def is_in_queue(self,path):                
+    def is_in_queue(self,path,ahead_of=None):
         item = self._model.findItems(path,column=FILEPATH_COLUMN)
+        if ahead_of is not None:
+            # Only items ahead of the given one:
+            try:
+                row = ahead_of.row()
+            except RuntimeError:
+                # Deleted by clearing the queue
+                row = self._model.rowCount()
+            item = [other for other in item if other.row() < row]
         if item:
             return True
         else:
@@ -468,9 +591,16 @@ class QueueManager(object):
     def get_status(self):
         return self._ui.queue_status.text()
             
+    @inmain_decorator(wait_for_return=True)
+    def get_queue_length(self):
+        return self._model.rowCount()
+
     @inmain_decorator(wait_for_return=True)
     def get_next_file(self):
-        return str(self._model.takeRow(0)[0].text())
+        """Remove the file at the top of the queue, returning its path and
+        whether it has been validated"""
+        item = self._model.takeRow(0)[0]
+        return str(item.text()), not item.data(UNVALIDATED_ROLE)
     
     @inmain_decorator(wait_for_return=True)    
     def transition_device_to_buffered(self, name, transition_list, h5file, restart_receiver):
@@ -485,8 +615,46 @@ class QueueManager(object):
     @inmain_decorator(wait_for_return=True)
     def get_device_error_state(self,name,device_list):
         return device_list[name].error_message
-       
-     
+
+    def automatic_restart_allowed(self, device_name):
+        """Called when a hung device has been restarted automatically during
+        a shot. Returns whether the shot may be requeued without pausing the
+        queue, which is only allowed MAX_AUTOMATIC_RESTARTS times in a row, so
+        that a device that always hangs does not retry the shot forever"""
+        self._automatic_restarts += 1
+        if self._automatic_restarts <= MAX_AUTOMATIC_RESTARTS:
+            return True
+        self._logger.error('%s was restarted automatically %d times in a row. Pausing the queue' %
+                           (device_name, self._automatic_restarts))
+        self._automatic_restarts = 0
+        return False
+
+    def trace_shot(self, path, shot_timings):
+        """Record the phases of a shot as spans, and write a trace of the shot
+        to the trace directory, if there is one"""
+        track = tracer.track('Queue manager')
+        start = tracer.from_wall_time(shot_timings['start_time'])
+        shot_start = start
+        for phase in ['programming', 'run', 'save', 'submit']:
+            if phase not in shot_timings['phases']:
+                continue
+            end = start + shot_timings['phases'][phase]
+            args = {'path': path}
+            # Each device's transition times are shown with the phase they are part of:
+            if phase == 'programming':
+                args['transition_to_buffered'] = shot_timings['transition_to_buffered']
+            elif phase == 'save':
+                args['transition_to_manual'] = shot_timings['transition_to_manual']
+            tracer.complete(phase, 'shot', start, end, args, track)
+            start = end
+        if tracer.trace_dir is not None:
+            trace_path = os.path.join(tracer.trace_dir, os.path.splitext(os.path.basename(path))[0] + '.trace.json')
+            try:
+                tracer.export(trace_path, shot_start, start)
+            except Exception:
+                self._logger.exception('Could not write trace of shot to %s' % trace_path)
+
+
     def manage(self):
         logger = logging.getLogger('BLACS.queue_manager.thread')   
         # While the program is running!
@@ -519,7 +687,8 @@ class QueueManager(object):
             
             # Get the top file
             try:
-                path = self.get_next_file()
+                with self._validation_lock:
+                    path, validated = self.get_next_file()
                 self.set_status('Preparing shot...', path)
                 logger.info('Got a file: %s'%path)
             except:
@@ -527,11 +696,28 @@ class QueueManager(object):
                 self.set_status("Idle")
                 time.sleep(1)
                 continue
+
+            if not validated:
+                # A file restored into the queue that the validator thread
+                # has not got to yet. Validate it now, before running it. It
+                # has been taken from the queue, so any copies still in the
+                # queue are after it:
+                restored_path = path
+                path, message = self.prepare_file(path)
+                if path is None:
+                    self._report_dropped_file(restored_path, message)
+                    continue
             
             devices_in_use = {}
             transition_list = {}   
             start_time = time.time()
             self.current_queue = queue.Queue()
+            # Timing of each phase of the shot, and of each device's
+            # transitions, for plugins monitoring the shot cycle:
+            shot_timings = {'start_time': start_time,
+                            'phases': {},
+                            'transition_to_buffered': {},
+                            'transition_to_manual': {}}
 
             # Function to be run when abort button is clicked
             def abort_function():
@@ -542,9 +728,11 @@ class QueueManager(object):
                 except Exception:
                     logger.exception('Could not send abort message to the queue manager')
         
-            def restart_function(device_name):
+            def restart_function(device_name, automatic=False):
+                # Automatic restarts, of tabs with hung workers, requeue the
+                # shot without pausing the queue:
                 try:
-                    self.current_queue.put([device_name, 'restart'])
+                    self.current_queue.put([device_name, 'auto restart' if automatic else 'restart'])
                 except Exception:
                     logger.exception('Could not send restart message to the queue manager for device %s'%device_name)
         
@@ -559,6 +747,8 @@ class QueueManager(object):
                 error_condition = False
                 abort = False
                 restarted = False
+                auto_restarted = False
+                too_many_restarts = False
                 self.set_status("Transitioning to buffered...", path)
                 
                 # Enable abort button, and link in current_queue:
@@ -569,9 +759,13 @@ class QueueManager(object):
                 with h5py.File(path,'r') as hdf5_file:
                     h5_file_devices = list(hdf5_file['devices/'].keys())
 
+                # When each device was asked to transition, as each is timed
+                # from its own start:
+                transition_start_times = {}
                 for name in h5_file_devices:
                     try:
                         # Connect restart signal from tabs to current_queue and transition the device to buffered mode
+                        transition_start_times[name] = time.time()
                         success = self.transition_device_to_buffered(name,transition_list,path,restart_function)
                         if not success:
                             logger.error('%s has an error condition, aborting run' % name)
@@ -601,12 +795,16 @@ class QueueManager(object):
                             logger.info('abort signal received during transition to buffered of %s' % device_name)
                             error_condition = True
                             break
-                        elif result == 'restart':
+                        elif result in ('restart', 'auto restart'):
                             logger.info('Device %s was restarted, aborting shot.'%device_name)
                             restarted = True
+                            if result == 'auto restart':
+                                auto_restarted = self.automatic_restart_allowed(device_name)
+                                too_many_restarts = not auto_restarted
                             break
                             
                         logger.debug('%s finished transitioning to buffered mode' % device_name)
+                        shot_timings['transition_to_buffered'][device_name] = time.time() - transition_start_times[device_name]
                         
                         # The tab says it's done, but does it have an error condition?
                         if self.get_device_error_state(device_name,transition_list):
@@ -637,12 +835,17 @@ class QueueManager(object):
                     # Pause the queue, re add the path to the top of the queue, and set a status message!
                     # only if we aren't responding to an abort click
                     if not abort:
-                        self.manager_paused = True
+                        if not auto_restarted:
+                            self.manager_paused = True
                         self.prepend(path)                
                     if timed_out:
                         self.set_status("Programming timed out\nQueue paused")
                     elif abort:
                         self.set_status("Aborted")
+                    elif auto_restarted:
+                        self.set_status("Hung device restarted in transition\nto buffered. Shot requeued.")
+                    elif too_many_restarts:
+                        self.set_status("Hung device restarted %d times in a row.\nQueue paused." % (MAX_AUTOMATIC_RESTARTS + 1))
                     elif restarted:
                         self.set_status("Device restarted in transition to\nbuffered. Aborted. Queue paused.")
                     else:
@@ -675,9 +878,11 @@ class QueueManager(object):
                 #                                                             SCIENCE!                                                                   #
                 ##########################################################################################################################################
             
-                # Get front panel data, but don't save it to the h5 file until the experiment ends:
-                states,tab_positions,window_data,plugin_data = self.BLACS.front_panel_settings.get_save_data()
-                self.set_status("Running (program time: %.3fs)..."%(time.time() - start_time), path)
+                # Get a snapshot of the front panel data, but don't save it to the h5 file until the experiment ends:
+                states,tab_positions,window_data,plugin_data = self.BLACS.front_panel_settings.get_save_data_snapshot()
+                run_start_time = time.time()
+                shot_timings['phases']['programming'] = run_start_time - start_time
+                self.set_status("Running (program time: %.3fs)..."%(run_start_time - start_time), path)
                     
                 # A Queue for event-based notification of when the experiment has finished.
                 experiment_finished_queue = queue.Queue()
@@ -687,11 +892,7 @@ class QueueManager(object):
                 ##########################################################################################################################################
                 #                                                        Plugin callbacks                                                                #
                 ########################################################################################################################################## 
-                for callback in plugins.get_callbacks('science_starting'):
-                    try:
-                        callback(path)
-                    except Exception:
-                        logger.exception("Plugin callback raised an exception")
+                plugins.dispatch('science_starting', path)
 
                 #TODO: fix potential race condition if BLACS is closing when this line executes?
                 self.BLACS.tablist[self.master_pseudoclock].start_run(experiment_finished_queue)
@@ -700,6 +901,8 @@ class QueueManager(object):
                 # Wait for notification of the end of run:
                 abort = False
                 restarted = False
+                auto_restarted = False
+                too_many_restarts = False
                 done = False
                 while not (abort or restarted or done):
                     try:
@@ -711,8 +914,11 @@ class QueueManager(object):
                         device_name, result = self.current_queue.get_nowait()
                         if (device_name == 'Queue Manager' and result == 'abort'):
                             abort = True
-                        if result == 'restart':
+                        if result in ('restart', 'auto restart'):
                             restarted = True
+                            if result == 'auto restart':
+                                auto_restarted = self.automatic_restart_allowed(device_name)
+                                too_many_restarts = not auto_restarted
                         # Check for error states in tabs
                         for device_name, tab in devices_in_use.items():
                             if self.get_device_error_state(device_name,devices_in_use):
@@ -731,7 +937,14 @@ class QueueManager(object):
                 inmain(self._ui.queue_abort_button.clicked.disconnect,abort_function)
                 inmain(self._ui.queue_abort_button.setEnabled,False)
                 
-                if restarted:                    
+                if auto_restarted:
+                    self.prepend(path)
+                    self.set_status("Hung device restarted during run.\nShot requeued.")
+                elif too_many_restarts:
+                    self.manager_paused = True
+                    self.prepend(path)
+                    self.set_status("Hung device restarted %d times in a row.\nQueue paused." % (MAX_AUTOMATIC_RESTARTS + 1))
+                elif restarted:                    
                     self.manager_paused = True
                     self.prepend(path)  
                     self.set_status("Device restarted during run.\nAborted. Queue paused")
@@ -743,6 +956,9 @@ class QueueManager(object):
                     continue                
                 
                 logger.info('Run complete')
+                self._automatic_restarts = 0
+                save_start_time = time.time()
+                shot_timings['phases']['run'] = save_start_time - run_start_time
                 self.set_status("Saving data...", path)
             # End try/except block here
             except Exception:
@@ -795,24 +1011,23 @@ class QueueManager(object):
                 ##########################################################################################################################################
                 #                                                        Plugin callbacks                                                                #
                 ########################################################################################################################################## 
-                for callback in plugins.get_callbacks('science_over'):
-                    try:
-                        callback(path)
-                    except Exception:
-                        logger.exception("Plugin callback raised an exception")
+                plugins.dispatch('science_over', path)
 
             
             ##########################################################################################################################################
             #                                                       Transition to manual                                                             #
             ##########################################################################################################################################
             # start new try/except block here                   
+            front_panel_write = None
             try:
                 with h5py.File(path,'r+') as hdf5_file:
-                    self.BLACS.front_panel_settings.store_front_panel_in_h5(hdf5_file,states,tab_positions,window_data,plugin_data,save_conn_table=False, save_queue_data=False)
-
                     data_group = hdf5_file['/'].create_group('data')
                     # stamp with the run time of the experiment
                     hdf5_file.attrs['run time'] = time.strftime('%Y%m%dT%H%M%S',run_time)
+
+                # Serialise the front panel snapshot into the shot file in a
+                # background thread, overlapping with transition_to_manual:
+                front_panel_write = self.BLACS.front_panel_settings.store_front_panel_in_h5_async(path,states,tab_positions,window_data,plugin_data,save_conn_table=False, save_queue_data=False)
         
                 # A Queue for event-based notification of when the devices have transitioned to static mode:
                 # Shouldn't need to recreate the queue: self.current_queue = queue.Queue()
@@ -827,6 +1042,7 @@ class QueueManager(object):
                 response_list = {}
                 for device_name, tab in devices_in_use.items():
                     if device_name not in response_list:
+                        device_start_time = time.time()
                         tab.transition_to_manual(self.current_queue)               
                         while True:
                             # TODO: make the call to current_queue.get() timeout 
@@ -837,18 +1053,27 @@ class QueueManager(object):
                                 response_list[got_device_name] = result
                             else:
                                 break
+                        shot_timings['transition_to_manual'][device_name] = time.time() - device_start_time
                     else:
+                        # The device sent a message, such as that it was
+                        # restarted, before it was asked to transition, so it
+                        # has no transition time:
                         result = response_list[device_name]
                     # Check for abort signal from device restart
                     if result == 'fail':
                         error_condition = True
-                    if result == 'restart':
+                    if result in ('restart', 'auto restart'):
                         error_condition = True
                     if self.get_device_error_state(device_name,devices_in_use):
                         error_condition = True
                     # Once device has transitioned_to_manual, disconnect restart signal
                     inmain(tab.disconnect_restart_receiver,restart_function)
-                    
+
+                # The shot file must not be handed on until the front panel is in it:
+                if not front_panel_write.wait():
+                    logger.error('Failed to save the front panel to the shot file')
+                    error_condition = True
+
                 if error_condition:                
                     self.set_status("Error in transtion to manual\nQueue Paused")
                                        
@@ -861,6 +1086,9 @@ class QueueManager(object):
                 zprocess.raise_exception_in_thread(sys.exc_info())
                 
             if error_condition:                
+                # Don't clean the h5 file out from under a front panel write still in progress:
+                if front_panel_write is not None:
+                    front_panel_write.wait()
                 # clean up the h5 file
                 self.manager_paused = True
                 # is this a repeat?
@@ -899,16 +1127,11 @@ class QueueManager(object):
             #                                                        Analysis Submission                                                             #
             ########################################################################################################################################## 
             logger.info('All devices are back in static mode.')  
+            submit_start_time = time.time()
+            shot_timings['phases']['save'] = submit_start_time - save_start_time
 
             # check for analysis Filters in Plugins
-            send_to_analysis = True
-            for callback in plugins.get_callbacks('analysis_cancel_send'):
-                try:
-                    if callback(path):
-                        send_to_analysis = False
-                        break
-                except Exception:
-                    logger.exception("Plugin callback raised an exception")
+            send_to_analysis = not plugins.run_filters('analysis_cancel_send', path)
 
             # Submit to the analysis server
             if send_to_analysis:
@@ -917,24 +1140,23 @@ class QueueManager(object):
             ##########################################################################################################################################
             #                                                        Plugin callbacks                                                                #
             ########################################################################################################################################## 
-            for callback in plugins.get_callbacks('shot_complete'):
-                try:
-                    callback(path)
-                except Exception:
-                    logger.exception("Plugin callback raised an exception")
+            plugins.dispatch('shot_complete', path)
+
+            end_time = time.time()
+            shot_timings['phases']['submit'] = end_time - submit_start_time
+            shot_timings['end_time'] = end_time
+            shot_timings['queue_depth'] = self.get_queue_length()
+            plugins.dispatch('shot_timings', path, shot_timings)
+            # Check for workers leaking memory from shot to shot:
+            resource_monitor.record_shot(devices_in_use)
+            if tracer.enabled:
+                self.trace_shot(path, shot_timings)
 
             ##########################################################################################################################################
             #                                                        Repeat Experiment?                                                              #
             ##########################################################################################################################################
             # check for repeat Filters in Plugins
-            repeat_shot = self.manager_repeat
-            for callback in plugins.get_callbacks('shot_ignore_repeat'):
-                try:
-                    if callback(path):
-                        repeat_shot = False
-                        break
-                except Exception:
-                    logger.exception("Plugin callback raised an exception")
+            repeat_shot = self.manager_repeat and not plugins.run_filters('shot_ignore_repeat', path)
 
             if repeat_shot:
                 if ((self.manager_repeat_mode == self.REPEAT_ALL) or
@@ -15,9 +15,15 @@ from labscript_utils import PY2
 from labscript_utils.numpy_dtype_workaround import dtype_workaround
 if PY2:
     str = unicode
+    import Queue as queue
+else:
+    import queue
 
 import os
+import json
+import base64
 import logging
+import threading
 
 from qtutils.qt.QtCore import *
 from qtutils.qt.QtGui import *
@@ -36,10 +42,204 @@ def _ensure_str(s):
     """convert bytestrings and numpy strings to python strings"""
     return s.decode() if isinstance(s, bytes) else str(s)
 
+
+# Version of the layout of the /front_panel group, in both the settings file
+# and shot files, stored in its 'format_version' attribute. Files without the
+# attribute are version 1, in which tab, plugin, analysis and queue data are
+# repr() strings that have to be restored with eval(): each tab's data in the
+# fixed-width 'data' column of /front_panel/_notebook_data, and the others in
+# its 'plugin_data', 'analysis_data' and 'queue_data' attributes. In version
+# 2, these are all tagged JSON (see serialise()): the 'data' column is a
+# variable-length string, and the others are variable-length string datasets
+# in /front_panel/_blacs_settings. The front_panel dataset and the window and
+# pane attributes of _notebook_data are the same in both versions.
+FRONT_PANEL_FORMAT_VERSION = 2
+
+# Group within /front_panel holding the BLACS-wide save data (version 2+):
+BLACS_SETTINGS_GROUP = '_blacs_settings'
+BLACS_SETTINGS_DATASETS = ['plugin_data', 'analysis_data', 'queue_data']
+
+if PY2:
+    _text_types = (str, bytes)
+else:
+    _text_types = (str,)
+
+_TAGS = ('__tuple__', '__set__', '__dict__', '__bytes__', '__repr__')
+_NDARRAY_KEYS = {'__ndarray__', 'dtype'}
+
+# Names of types that have been saved as their repr(), so that each is only
+# warned about once:
+_repr_types_warned = set()
+
+def _is_tagged(obj):
+    """Return whether a dict is in the form _encode tags objects with"""
+    return (len(obj) == 1 and list(obj)[0] in _TAGS) or set(obj) == _NDARRAY_KEYS
+
+def _hashable(obj):
+    """Convert decoded lists and sets to tuples and frozensets, for use as
+    dict keys or set members"""
+    if isinstance(obj, list):
+        return tuple(_hashable(item) for item in obj)
+    elif isinstance(obj, set):
+        return frozenset(obj)
+    return obj
+
+_dtype_to_descr = numpy.lib.format.dtype_to_descr
+# Only in numpy >= 1.17. numpy.dtype() accepts descrs too, except those of
+# structured dtypes with padding between fields:
+_descr_to_dtype = getattr(numpy.lib.format, 'descr_to_dtype', numpy.dtype)
+
+def _encode(obj):
+    """Convert obj into something json can serialise, tagging types that json
+    would otherwise lose (tuples, sets, bytes, arrays and dicts whose keys are
+    not strings). Anything else is stored as its repr() for reference, with a
+    warning, and is restored as None."""
+    if obj is None or isinstance(obj, (bool, int, float) + _text_types):
+        if PY2 and isinstance(obj, bytes):
+            return obj.decode('utf8')
+        return obj
+    elif isinstance(obj, list):
+        return [_encode(item) for item in obj]
+    elif isinstance(obj, tuple):
+        return {'__tuple__': [_encode(item) for item in obj]}
+    elif isinstance(obj, (set, frozenset)):
+        return {'__set__': [_encode(item) for item in obj]}
+    elif isinstance(obj, dict):
+        if all(isinstance(key, _text_types) for key in obj) and not _is_tagged(obj):
+            return {key: _encode(value) for key, value in obj.items()}
+        return {'__dict__': [[_encode(key), _encode(value)] for key, value in obj.items()]}
+    elif isinstance(obj, bytes):
+        return {'__bytes__': base64.b64encode(obj).decode('ascii')}
+    elif isinstance(obj, numpy.ndarray):
+        # A descr rather than str(dtype), which numpy cannot parse back for
+        # structured arrays:
+        return {'__ndarray__': _encode(obj.tolist()), 'dtype': _encode(_dtype_to_descr(obj.dtype))}
+    elif isinstance(obj, numpy.generic):
+        return _encode(obj.item())
+    elif PY2 and isinstance(obj, long):
+        return obj
+    type_name = type(obj).__name__
+    if type_name not in _repr_types_warned:
+        _repr_types_warned.add(type_name)
+        logger.warning("Cannot save objects of type %s. " % type_name +
+                       "They are saved as their repr() and will be restored as None")
+    return {'__repr__': repr(obj)}
+
+
+def _decode(obj):
+    """json object_hook reversing the tagging done by _encode"""
+    if set(obj) == _NDARRAY_KEYS:
+        return numpy.array(obj['__ndarray__'], dtype=_descr_to_dtype(obj['dtype']))
+    elif len(obj) != 1:
+        return obj
+    tag, value = list(obj.items())[0]
+    if tag == '__tuple__':
+        return tuple(value)
+    elif tag == '__set__':
+        return set(_hashable(item) for item in value)
+    elif tag == '__dict__':
+        return {_hashable(key): item for key, item in value}
+    elif tag == '__bytes__':
+        return base64.b64decode(value)
+    elif tag == '__repr__':
+        # Never evaluated, as the file may not be trusted:
+        logger.warning("Not restoring %s, which was saved as its repr()" % value)
+        return None
+    return obj
+
+
+def _copy_plain(obj):
+    """Copy the containers in save data, so that the copy shares no mutable
+    containers with the tabs and plugins it came from. Much cheaper than
+    copy.deepcopy(), as immutable values such as strings and numbers are not
+    copied. numpy arrays are copied, and anything else is left as it is, as it
+    can only be saved as its repr() anyway."""
+    if isinstance(obj, dict):
+        return {key: _copy_plain(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [_copy_plain(item) for item in obj]
+    elif isinstance(obj, tuple):
+        return tuple(_copy_plain(item) for item in obj)
+    elif isinstance(obj, set):
+        return set(obj)
+    elif isinstance(obj, numpy.ndarray):
+        return obj.copy()
+    return obj
+
+
+def serialise(obj):
+    """Serialise BLACS save data to a string in the current format"""
+    return json.dumps(_encode(obj), separators=(',', ':'))
+
+
+def deserialise(data, format_version=FRONT_PANEL_FORMAT_VERSION):
+    """Deserialise a string of save data written in the given format version"""
+    data = _ensure_str(data)
+    if format_version < 2:
+        return eval(data)
+    return json.loads(data, object_hook=_decode)
+
+class FrontPanelWrite(object):
+    """Handle to a front panel write queued with FrontPanelWriter. Call wait()
+    to block until the write has completed. wait() returns whether the write
+    was successful."""
+    def __init__(self, path):
+        self.path = path
+        self.success = None
+        self._done = threading.Event()
+
+    def _set_result(self, success):
+        self.success = success
+        self._done.set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return bool(self.success)
+
+
+class FrontPanelWriter(object):
+    """Serialises front panel snapshots into shot files from a background
+    thread, so that the HDF5 write does not happen in the Qt main thread and
+    can overlap with devices transitioning to manual mode. Writes are
+    processed in the order they are queued."""
+    def __init__(self, front_panel_settings):
+        self.front_panel_settings = front_panel_settings
+        self.inqueue = queue.Queue()
+        self.mainloop_thread = threading.Thread(target=self.mainloop)
+        self.mainloop_thread.daemon = True
+        self.mainloop_thread.start()
+
+    def put(self, path, *args, **kwargs):
+        """Queue up a call to FrontPanelSettings.store_front_panel_in_h5 on
+        the file at path. The remaining arguments are passed through
+        unchanged. Returns a FrontPanelWrite handle."""
+        write = FrontPanelWrite(path)
+        self.inqueue.put((write, args, kwargs))
+        return write
+
+    def mainloop(self):
+        # HDF5 prints lots of errors by default, for things that aren't
+        # actually errors. These are silenced on a per thread basis:
+        h5py._errors.silence_errors()
+        while True:
+            write, args, kwargs = self.inqueue.get()
+            try:
+                # Opening the file acquires the h5 lock, which we hold until
+                # the whole front panel has been written:
+                with h5py.File(write.path, 'r+') as hdf5_file:
+                    self.front_panel_settings.store_front_panel_in_h5(hdf5_file, *args, **kwargs)
+            except Exception:
+                logger.exception('Could not save front panel to %s' % write.path)
+                write._set_result(False)
+            else:
+                write._set_result(True)
+
+
 class FrontPanelSettings(object):
     def __init__(self,settings_path,connection_table):
         self.settings_path = settings_path
         self.connection_table = connection_table
+        self._writer = None
         with h5py.File(settings_path,'a') as h5file:
             pass
         
@@ -80,6 +280,8 @@ class FrontPanelSettings(object):
             ct_match,error = self.connection_table.compare_to(saved_ct)
             
             with h5py.File(self.settings_path,'r') as hdf5_file:
+                format_version = int(hdf5_file['/front_panel'].attrs.get('format_version', 1))
+
                 # Get Tab Data
                 dataset = hdf5_file['/front_panel'].get('_notebook_data',[])
                 
@@ -87,26 +289,35 @@ class FrontPanelSettings(object):
                     tab_name = _ensure_str(row['tab_name'])
                     tab_data.setdefault(tab_name,{})
                     try:
-                        tab_data[tab_name] = {'notebook':row['notebook'], 'page':row['page'], 'visible':row['visible'], 'data':eval(_ensure_str(row['data']))}
-                    except:
-                        logger.info("Could not load tab data for %s"%tab_name)
+                        tab_data[tab_name] = {'notebook':row['notebook'], 'page':row['page'], 'visible':row['visible'], 'data':deserialise(row['data'], format_version)}
+                    except Exception:
+                        logger.exception("Could not load tab data for %s"%tab_name)
                 
                 #now get dataset attributes
                 tab_data['BLACS settings'] = dict(dataset.attrs)
+
+                # and the BLACS-wide save data, which is returned deserialised:
+                if format_version < 2:
+                    blacs_settings = tab_data['BLACS settings']
+                else:
+                    blacs_settings = {}
+                    group = hdf5_file['/front_panel'].get(BLACS_SETTINGS_GROUP, {})
+                    for name in group:
+                        blacs_settings[name] = group[name][()]
+                for name in BLACS_SETTINGS_DATASETS:
+                    if name in blacs_settings:
+                        try:
+                            tab_data['BLACS settings'][name] = deserialise(blacs_settings[name], format_version)
+                        except Exception:
+                            # Queue data saved before qtutils 2 may contain qt
+                            # objects that can no longer be loaded, for example
+                            logger.exception("Could not load %s" % name)
+                            tab_data['BLACS settings'][name] = {}
                 
                 # Get the front panel values
                 if 'front_panel' in hdf5_file["/front_panel"]:
                     dataset = hdf5_file["/front_panel"].get('front_panel', [])
-                    for row in dataset:
-                        result = self.check_row(row,ct_match,self.connection_table,saved_ct)
-                        columns = ['name', 'device_name', 'channel', 'base_value', 'locked', 'base_step_size', 'current_units']
-                        data_dict = {}
-                        for i in range(len(row)):
-                            if isinstance(row[i], bytes) or isinstance(row[i], str):
-                                data_dict[columns[i]] = _ensure_str(row[i])
-                            else:
-                                data_dict[columns[i]] = row[i]
-                        settings,question,error = self.handle_return_code(data_dict,result,settings,question,error)
+                    settings,question,error = self.restore_rows(dataset,ct_match,saved_ct,settings,question,error)
       
                 # Else Legacy restore from GTK save data!
                 else:
@@ -126,6 +337,80 @@ class FrontPanelSettings(object):
             logger.info(str(e))
         return settings,question,error,tab_data
     
+    def _index_connection_table(self,connection_table):
+        """Return dictionaries of every connection in a ConnectionTable, keyed
+        by name and by (parent name, parent port), equivalent to
+        find_by_name() and find_child() but built in a single pass"""
+        by_name = {}
+        by_port = {}
+        stack = list(connection_table.toplevel_children.values())
+        while stack:
+            connection = stack.pop()
+            by_name.setdefault(connection.name, connection)
+            if connection.parent is not None:
+                by_port.setdefault((connection.parent.name, connection.parent_port), connection)
+            stack.extend(connection.child_list.values())
+        return by_name, by_port
+
+    def restore_rows(self,dataset,ct_match,saved_ct,settings,question,error):
+        """Bulk equivalent of calling check_row() and handle_return_code() on
+        every row of a saved front_panel dataset. The dataset is read once,
+        and both connection tables are indexed once, rather than searched for
+        every row. Rows are interpreted exactly as check_row() does."""
+        columns = ['name', 'device_name', 'channel', 'base_value', 'locked', 'base_step_size', 'current_units']
+        data = dataset[()]
+        if not len(data):
+            return settings,question,error
+        columns = columns[:len(data.dtype.names)]
+        # Convert the dataset to a list of values per column, decoding strings:
+        column_values = {}
+        for column, field in zip(columns, data.dtype.names):
+            if data.dtype[field].kind in 'SUO':
+                column_values[column] = [_ensure_str(value) for value in data[field].tolist()]
+            else:
+                column_values[column] = list(data[field])
+        names = column_values['name']
+
+        try:
+            blacs_by_name, blacs_by_port = self._index_connection_table(self.connection_table)
+            if not ct_match:
+                saved_by_name, _ = self._index_connection_table(saved_ct)
+        except AttributeError:
+            # Not a connection table we know how to index. Fall back to
+            # looking up each row individually:
+            logger.warning('Could not index connection tables, restoring front panel row by row')
+            for i, row in enumerate(dataset):
+                result = self.check_row(row,ct_match,self.connection_table,saved_ct)
+                data_dict = {column: column_values[column][i] for column in columns}
+                settings,question,error = self.handle_return_code(data_dict,result,settings,question,error)
+            return settings,question,error
+        results = []
+        for name, device_name, channel in zip(names, column_values['device_name'], column_values['channel']):
+            if name != "-":
+                if ct_match:
+                    results.append(1)
+                    continue
+                connection = blacs_by_name.get(name)
+                if connection:
+                    result, conn_error = connection.compare_to(saved_by_name.get(name))
+                    allowed_length = 1 if "parent_port" in conn_error else 0
+                    if len(conn_error) > allowed_length:
+                        results.append(-2)
+                    elif conn_error == {} and connection.parent.name == saved_by_name[name].parent.name:
+                        results.append(1)
+                    else:
+                        results.append((2, connection))
+                else:
+                    results.append(-1)
+            else:
+                connection = blacs_by_port.get((device_name, channel))
+                results.append((3, connection) if connection else 1)
+
+        for i, result in enumerate(results):
+            data_dict = {column: column_values[column][i] for column in columns}
+            settings,question,error = self.handle_return_code(data_dict,result,settings,question,error)
+        return settings,question,error
+
     def handle_return_code(self,row,result,settings,question,error):
         # 1: Restore to existing device
         # 2: Send to new device
@@ -155,6 +440,9 @@ class FrontPanelSettings(object):
         return settings,question,error
     
     def check_row(self,row,ct_match,blacs_ct,saved_ct):            
+        # Names are bytes when read from HDF5 under Python 3, and would never
+        # compare equal to "-":
+        row = [_ensure_str(value) for value in row[:3]]
         # If it has a name
         if row[0] != "-":
             if ct_match:
@@ -198,7 +486,7 @@ class FrontPanelSettings(object):
                 return 1
     
     @inmain_decorator(wait_for_return=True)    
-    def get_save_data(self):
+    def get_save_data(self, include_queue=True):
         tab_data = {}
         notebook_data = {}
         window_data = {}
@@ -206,7 +494,12 @@ class FrontPanelSettings(object):
         
         # iterate over all tabs
         for device_name,tab in self.tablist.items():
-            tab_data[device_name] = {'front_panel':tab.settings['front_panel_settings'], 'save_data': tab.get_all_save_data()}
+            try:
+                save_data = tab.get_all_save_data()
+            except Exception as e:
+                logger.error('Could not save data for tab %s. Error was: %s'%(device_name,str(e)))
+                save_data = {}
+            tab_data[device_name] = {'front_panel':tab.settings['front_panel_settings'], 'save_data': save_data}
             
             # Find the notebook the tab is in
             #            
@@ -243,13 +536,40 @@ class FrontPanelSettings(object):
                                        "frame_height":abs(self.window.frameGeometry().height()-self.window.normalGeometry().height()),
                                        "frame_width":abs(self.window.frameGeometry().width()-self.window.normalGeometry().width()),
                                        "_analysis":self.blacs.analysis_submission.get_save_data(),
-                                       "_queue":self.blacs.queue.get_save_data(),
+                                       "_queue":self.blacs.queue.get_save_data() if include_queue else None,
                                       }
         # Pane positions
         for name,pane in self.panes.items():
             window_data[name] = pane.sizes()
         
         return tab_data,notebook_data,window_data,plugin_data
+
+    @inmain_decorator(wait_for_return=True)
+    def get_save_data_snapshot(self):
+        """The save data stored in each shot file. As get_save_data(), but
+        without the queue, which shot files do not store, and with the
+        containers in the data copied, so that it can be serialised from
+        another thread whilst the front panel continues to change. Data that
+        cannot be copied is logged and used as it is, rather than aborting the
+        shot."""
+        snapshot = []
+        for data in self.get_save_data(include_queue=False):
+            try:
+                snapshot.append(_copy_plain(data))
+            except Exception:
+                logger.exception('Could not copy front panel data for shot file, using it uncopied')
+                snapshot.append(data)
+        return tuple(snapshot)
+
+    def store_front_panel_in_h5_async(self, path, *args, **kwargs):
+        """Write a front panel snapshot (as returned by
+        get_save_data_snapshot) into the h5 file at path from a background
+        thread. Arguments are as for store_front_panel_in_h5, minus the open
+        h5 file. Returns a FrontPanelWrite handle whose wait() method blocks
+        until the write is complete."""
+        if self._writer is None:
+            self._writer = FrontPanelWriter(self)
+        return self._writer.put(path, *args, **kwargs)
     
     @inmain_decorator(wait_for_return=True)
     def save_front_panel_to_h5(self,current_file,states,tab_positions,window_data,plugin_data,silent = {}, force_new_conn_table = False):        
@@ -333,7 +653,6 @@ class FrontPanelSettings(object):
                 # save connection table, save front panel                    
                 self.store_front_panel_in_h5(hdf5_file,states,tab_positions,window_data,plugin_data,save_conn_table=True)
     
-    @inmain_decorator(wait_for_return=True)
     def store_front_panel_in_h5(self, hdf5_file,tab_data,notebook_data,window_data,plugin_data,save_conn_table=False,save_queue_data=True):
         if save_conn_table:
             if 'connection table' in hdf5_file:
@@ -341,11 +660,12 @@ class FrontPanelSettings(object):
             hdf5_file.create_dataset('connection table', data=self.connection_table.raw_table)
         
         data_group = hdf5_file['/'].create_group('front_panel')
+        data_group.attrs['format_version'] = FRONT_PANEL_FORMAT_VERSION
         
         front_panel_list = []
         other_data_list = []       
         front_panel_dtype = dtype_workaround([('name','a256'),('device_name','a256'),('channel','a256'),('base_value',float),('locked',bool),('base_step_size',float),('current_units','a256')])
-        max_od_length = 2 # empty dictionary
+        vlen_str = h5py.special_dtype(vlen=str)
             
         # Iterate over each device within a class
         for device_name, device_state in tab_data.items():
@@ -364,9 +684,7 @@ class FrontPanelSettings(object):
                                            )               
             
             # Save "other data"
-            od = repr(device_state["save_data"])
-            other_data_list.append(od)            
-            max_od_length = len(od) if len(od) > max_od_length else max_od_length            
+            other_data_list.append(serialise(device_state["save_data"]))
         
         # Create datasets
         if front_panel_list:
@@ -377,7 +695,7 @@ class FrontPanelSettings(object):
                 
         # Save tab data
         i = 0
-        tab_data = numpy.empty(len(notebook_data),dtype=dtype_workaround([('tab_name','a256'),('notebook','a2'),('page',int),('visible',bool),('data','a'+str(max_od_length))]))
+        tab_data = numpy.empty(len(notebook_data),dtype=dtype_workaround([('tab_name','a256'),('notebook','a2'),('page',int),('visible',bool),('data',vlen_str)]))
         for device_name,data in notebook_data.items():
             tab_data[i] = (device_name,data["notebook"],data["page"],data["visible"],other_data_list[i])
             i += 1
@@ -391,10 +709,13 @@ class FrontPanelSettings(object):
         dataset.attrs["window_maximized"] = window_data["_main_window"]["maximized"]
         dataset.attrs["window_frame_height"] = window_data["_main_window"]["frame_height"]
         dataset.attrs["window_frame_width"] = window_data["_main_window"]["frame_width"]
-        dataset.attrs['plugin_data'] = repr(plugin_data)
-        dataset.attrs['analysis_data'] = repr(window_data["_main_window"]["_analysis"])
+        # BLACS-wide save data. These can be large (e.g. a long queue), so are
+        # stored as datasets rather than attributes:
+        settings_group = data_group.create_group(BLACS_SETTINGS_GROUP)
+        settings_group.create_dataset('plugin_data', data=serialise(plugin_data), dtype=vlen_str)
+        settings_group.create_dataset('analysis_data', data=serialise(window_data["_main_window"]["_analysis"]), dtype=vlen_str)
         if save_queue_data:
-            dataset.attrs['queue_data'] = repr(window_data["_main_window"]["_queue"])
+            settings_group.create_dataset('queue_data', data=serialise(window_data["_main_window"]["_queue"]), dtype=vlen_str)
         for pane_name,pane_position in window_data.items():
             if pane_name != "_main_window":
                 dataset.attrs[pane_name] = pane_position
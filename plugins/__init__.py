@@ -11,14 +11,21 @@
 #                                                                   #
 #####################################################################
 from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    import Queue as queue
+else:
+    import queue
 
 import os
 import sys
+import time
 import logging
+import json
+import threading
 import importlib
 from types import MethodType
 from collections import defaultdict
-from labscript_utils.labconfig import LabConfig
 from blacs import BLACS_DIR
 PLUGINS_DIR = os.path.join(BLACS_DIR, 'plugins')
 
@@ -28,13 +35,28 @@ logger = logging.getLogger('BLACS.plugins')
 
 DEFAULT_PRIORITY = 10
 
+# Events that only notify plugins of something, and whose callbacks' return
+# values are ignored. Callbacks for these that are marked with run_async are
+# run in a thread per plugin, so that they do not hold up the queue manager.
+# All other callbacks, including all those for filters such as
+# 'analysis_cancel_send' and 'shot_ignore_repeat', are run synchronously:
+NOTIFICATION_EVENTS = ['science_starting', 'science_over', 'shot_complete', 'shot_timings']
+
+# How long in seconds a callback may take before a warning is logged. Can be
+# set with the 'plugin_callback_budget' option in the BLACS section of the lab
+# config:
+DEFAULT_CALLBACK_BUDGET = 0.1
+
 class Callback(object):
     """Class wrapping a callable. At present only differs from a regular
     function in that it has a "priority" attribute - lower numbers means
     higher priority. If there are multiple callbacks triggered by the same
-    event, they will be returned in order of priority by get_callbacks"""
-    def __init__(self, func, priority=DEFAULT_PRIORITY):
+    event, they will be returned in order of priority by get_callbacks.
+    Callbacks for notification events with run_async=True are run in their
+    plugin's thread rather than in the queue manager thread."""
+    def __init__(self, func, priority=DEFAULT_PRIORITY, run_async=False):
         self.priority = priority
+        self.run_async = run_async
         self.func = func
 
     def __get__(self, instance, class_):
@@ -52,51 +74,396 @@ class Callback(object):
 class callback(object):
     """Decorator to turn a function into a Callback object. Presently
     optional, and only required if the callback needs to have a non-default
-    priority set"""
+    priority set, or can be run asynchronously, with run_async=True"""
     # Instantiate the decorator:
-    def __init__(self, priority=DEFAULT_PRIORITY):
+    def __init__(self, priority=DEFAULT_PRIORITY, run_async=False):
         self.priority = priority
+        self.run_async = run_async
     # Call the decorator
     def __call__(self, func):
-        return Callback(func, self.priority)
+        return Callback(func, self.priority, self.run_async)
 
 
 def get_callbacks(name):
     """Return all the callbacks for a particular name, in order of priority"""
-    import __main__
-    BLACS = __main__.app
-    callbacks = []
-    for plugin in BLACS.plugins.values():
-        try:
-            plugin_callbacks = plugin.get_callbacks()
-            if plugin_callbacks is not None:
-                if name in plugin_callbacks:
-                    callbacks.append(plugin_callbacks[name])
-        except Exception as e:
-            logger.exception('Error getting callbacks from %s.' % str(plugin))
-            
-    # Sort all callbacks by priority:
-    callbacks.sort(key=lambda callback: getattr(callback, 'priority', DEFAULT_PRIORITY))
-    return callbacks
-
-
-exp_config = LabConfig()
-if not exp_config.has_section('BLACS/plugins'):
-    exp_config.add_section('BLACS/plugins')
+    return [callback for module_name, callback in callback_registry.lookup(name)]
 
-modules = {}
-for module_name in os.listdir(PLUGINS_DIR):
-    if os.path.isdir(os.path.join(PLUGINS_DIR, module_name)) and module_name != '__pycache__':
-        # is it a new plugin?
-        # If so lets add it to the config
-        if not module_name in [name for name, val in exp_config.items('BLACS/plugins')]:
-            exp_config.set('BLACS/plugins', module_name, str(module_name in default_plugins))
-
-        # only load activated plugins
-        if exp_config.getboolean('BLACS/plugins', module_name):
+
+class CallbackRegistry(object):
+    """The callbacks of all loaded plugins, by event name, in order of
+    priority. BLACS registers each plugin with plugin_loaded() once it is
+    instantiated, and unregisters it with plugin_unloaded() once it is
+    closed. The registry is built from each plugin's get_callbacks() the first
+    time it is needed, and only rebuilt if plugins are loaded or unloaded or
+    it is invalidated, so looking up the callbacks for an event is just a
+    dictionary lookup."""
+    def __init__(self):
+        # Module name: plugin instance:
+        self._plugins = {}
+        # Event name: list of (module_name, callback), sorted by priority.
+        # None if the registry needs to be (re)built:
+        self._by_event = None
+        self._lock = threading.Lock()
+
+    def plugin_loaded(self, module_name, plugin):
+        """Register a plugin, replacing any already registered under the same
+        module name"""
+        with self._lock:
+            self._plugins[module_name] = plugin
+            self._by_event = None
+
+    def plugin_unloaded(self, module_name):
+        with self._lock:
+            self._plugins.pop(module_name, None)
+            self._by_event = None
+
+    def invalidate(self):
+        """Rebuild the registry when next needed, for when plugins' callbacks
+        may have changed"""
+        with self._lock:
+            self._by_event = None
+
+    def _build(self, plugins):
+        by_event = defaultdict(list)
+        # Sorted so that callbacks of the same priority are always run in the
+        # same order:
+        for module_name, plugin in sorted(plugins.items()):
             try:
-                module = importlib.import_module('blacs.plugins.'+module_name)
+                plugin_callbacks = plugin.get_callbacks()
+                if plugin_callbacks is not None:
+                    for name, callback in plugin_callbacks.items():
+                        by_event[name].append((module_name, callback))
             except Exception:
-                logger.exception('Could not import plugin \'%s\'. Skipping.'%module_name)
+                logger.exception('Error getting callbacks from %s.' % str(plugin))
+        for callbacks in by_event.values():
+            callbacks.sort(key=lambda item: getattr(item[1], 'priority', DEFAULT_PRIORITY))
+        return dict(by_event)
+
+    def lookup(self, name):
+        """Return a list of (module_name, callback) for an event, in order of
+        priority"""
+        by_event = self._by_event
+        if by_event is None:
+            with self._lock:
+                if self._by_event is None:
+                    self._by_event = self._build(self._plugins)
+                by_event = self._by_event
+        return by_event.get(name, [])
+
+
+class PluginExecutor(object):
+    """A thread running a single plugin's asynchronous callbacks, in the order
+    they were dispatched"""
+    def __init__(self, module_name, dispatcher):
+        self.module_name = module_name
+        self.dispatcher = dispatcher
+        self.inqueue = queue.Queue()
+        self.mainloop_thread = threading.Thread(target=self.mainloop)
+        self.mainloop_thread.daemon = True
+        self.mainloop_thread.start()
+
+    def submit(self, event, callback, args):
+        self.inqueue.put((event, callback, args))
+
+    def mainloop(self):
+        while True:
+            event, callback, args = self.inqueue.get()
+            self.dispatcher.run_callback(self.module_name, event, callback, args)
+
+
+class CallbackDispatcher(object):
+    """Runs plugin callbacks for events, in order of priority, as looked up in
+    a CallbackRegistry. Callbacks for events in NOTIFICATION_EVENTS that are
+    marked with run_async are run in a thread per plugin, so a slow plugin
+    does not hold up the queue manager. The execution time of each callback
+    is recorded, and a warning logged if it exceeds the budget."""
+    def __init__(self, registry, budget=DEFAULT_CALLBACK_BUDGET):
+        self.registry = registry
+        self.budget = budget
+        self._executors = {}
+        # (module_name, event): [number of calls, total time, max time]
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def run_callback(self, module_name, event, callback, args):
+        """Call a callback, logging any exception and recording how long it
+        took. Returns the callback's return value, or None if it raised an
+        exception"""
+        start_time = time.time()
+        try:
+            result = callback(*args)
+        except Exception:
+            logger.exception("Plugin callback raised an exception")
+            result = None
+        duration = time.time() - start_time
+        with self._lock:
+            timing = self.timings.setdefault((module_name, event), [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += duration
+            timing[2] = max(timing[2], duration)
+        if duration > self.budget:
+            logger.warning("Plugin '%s' took %.3fs to handle '%s' (budget %.3fs)" %
+                           (module_name, duration, event, self.budget))
+        return result
+
+    def _get_executor(self, module_name):
+        with self._lock:
+            if module_name not in self._executors:
+                self._executors[module_name] = PluginExecutor(module_name, self)
+            return self._executors[module_name]
+
+    def dispatch(self, name, *args):
+        """Call all callbacks for an event with the given arguments"""
+        for module_name, callback in self.registry.lookup(name):
+            if name in NOTIFICATION_EVENTS and getattr(callback, 'run_async', False):
+                self._get_executor(module_name).submit(name, callback, args)
             else:
-                modules[module_name] = module
+                self.run_callback(module_name, name, callback, args)
+
+    def run_filters(self, name, *args):
+        """Call the callbacks for a filter event synchronously, in order,
+        until one returns True. Returns whether any did"""
+        for module_name, callback in self.registry.lookup(name):
+            if self.run_callback(module_name, name, callback, args):
+                return True
+        return False
+
+
+class LazyCallback(object):
+    """Stands in for a callback of a plugin that has not been imported yet,
+    importing it when first called"""
+    def __init__(self, lazy_plugin, event, priority=DEFAULT_PRIORITY, run_async=False):
+        self.lazy_plugin = lazy_plugin
+        self.event = event
+        self.priority = priority
+        self.run_async = run_async
+
+    def __call__(self, *args, **kwargs):
+        plugin = self.lazy_plugin.load()
+        return plugin.get_callbacks()[self.event](*args, **kwargs)
+
+
+def menu_with_actions(menu_parameters, get_action, path=()):
+    """Return a copy of a menu, as returned by get_menu_items() but without
+    actions, such as the menu in a plugin's manifest, with the action of each
+    item set to get_action(path). path is a tuple of the names of the menus
+    containing the item, starting with the top level menu, followed by the
+    name of the item."""
+    menu_parameters = dict(menu_parameters)
+    if 'name' in menu_parameters:
+        path = path + (menu_parameters['name'],)
+    if 'menu_items' in menu_parameters:
+        menu_parameters['menu_items'] = [menu_with_actions(item, get_action, path)
+                                         for item in menu_parameters['menu_items']]
+    elif 'name' in menu_parameters:
+        menu_parameters['action'] = get_action(path)
+    return menu_parameters
+
+
+def get_manifest_menu_items(module_name, actions):
+    """Return the menu in a plugin's manifest, with each item's action looked
+    up in the dict actions by the item's name. For the get_menu_items() method
+    of plugins with a manifest, so that their menu is only defined in one
+    place."""
+    return menu_with_actions(get_manifest(module_name)['menu'], lambda path: actions[path[-1]])
+
+
+class LazyMenu(object):
+    """Stands in for the menu of a plugin that has not been imported yet.
+    Menu items are created from the plugin's manifest, and triggering one
+    imports the plugin, creates its real menu, and calls the action of the
+    real menu item with the same name."""
+    def __init__(self, lazy_plugin, blacs_data):
+        self.lazy_plugin = lazy_plugin
+        self.BLACS = blacs_data
+
+    def _get_action(self, path):
+        return lambda *args, **kwargs: self.trigger(path)
+
+    def get_menu_items(self):
+        return menu_with_actions(self.lazy_plugin.manifest['menu'], self._get_action)
+
+    def trigger(self, path):
+        self.lazy_plugin.load()
+        item = self.lazy_plugin.menu.get_menu_items()
+        for name in path[1:]:
+            item = [child for child in item['menu_items'] if child.get('name') == name][0]
+        item['action']()
+
+
+class LazyPlugin(object):
+    """Stands in for a plugin whose module is only imported when it is first
+    needed: when one of its callbacks is called or one of its menu items is
+    triggered. Everything needed before then comes from the plugin's
+    manifest.json, which may contain:
+
+        name: the name of the plugin
+        lazy: whether the plugin may be loaded lazily. Plugins with settings
+            pages, notifications or tabs cannot be, as these are needed at
+            startup. Nor should plugins that do anything at startup that
+            matters before they are first used.
+        callbacks: a dict of event name: priority
+        run_async_callbacks: a list of events whose callbacks have
+            run_async set
+        menu: the menu, as returned by get_menu_items(), without actions.
+            The plugin's own menu can be created from this with
+            get_manifest_menu_items().
+    """
+    def __init__(self, module_name, manifest, initial_settings, timer=None):
+        self.module_name = module_name
+        self.manifest = manifest
+        self.initial_settings = initial_settings
+        self.timer = timer
+        self.plugin = None
+        self.menu = None
+        self.blacs_data = None
+
+    def load(self):
+        """Import the plugin and set it up, if not already done. Returns the
+        real plugin."""
+        plugin = self.plugin
+        if plugin is not None:
+            return plugin
+        from qtutils import inmain
+        # The plugin may create Qt objects, so it is set up in the main thread.
+        # This also means only one thread ever loads it, without a lock that
+        # the main thread might have to wait for whilst another thread waits
+        # for the main thread:
+        return inmain(self._load_in_main)
+
+    def _load_in_main(self):
+        if self.plugin is None:
+            self.plugin = self._load()
+            # Replace ourselves in the registry with the real plugin:
+            callback_registry.plugin_loaded(self.module_name, self.plugin)
+        return self.plugin
+
+    def _load(self):
+        start_time = time.time()
+        module = import_plugin(self.module_name, self.timer)
+        plugin = module.Plugin(self.initial_settings)
+        logger.info('Loaded plugin \'%s\' on first use in %.3fs' % (self.module_name, time.time() - start_time))
+        plugin.set_notification_instances({})
+        menu_class = plugin.get_menu_class()
+        if menu_class:
+            self.menu = menu_class(self.blacs_data)
+            plugin.set_menu_instance(self.menu)
+        if self.blacs_data is not None:
+            plugin.plugin_setup_complete(self.blacs_data)
+        return plugin
+
+    def get_menu_class(self):
+        if 'menu' in self.manifest:
+            return lambda blacs_data: LazyMenu(self, blacs_data)
+        return None
+
+    def get_notification_classes(self):
+        return []
+
+    def get_setting_classes(self):
+        return []
+
+    def get_callbacks(self):
+        if self.plugin is not None:
+            return self.plugin.get_callbacks()
+        run_async_callbacks = self.manifest.get('run_async_callbacks', [])
+        return {event: LazyCallback(self, event, priority, event in run_async_callbacks)
+                for event, priority in self.manifest.get('callbacks', {}).items()}
+
+    def set_menu_instance(self, menu):
+        pass
+
+    def set_notification_instances(self, notifications):
+        pass
+
+    def plugin_setup_complete(self, blacs_data):
+        self.blacs_data = blacs_data
+
+    def get_save_data(self):
+        if self.plugin is not None:
+            return self.plugin.get_save_data()
+        # Not loaded, so nothing has changed:
+        return self.initial_settings
+
+    def close(self):
+        if self.plugin is not None:
+            self.plugin.close()
+
+
+class LazyPluginModule(object):
+    """Stands in for the module of a lazily loaded plugin, with a Plugin
+    attribute that creates a LazyPlugin"""
+    def __init__(self, module_name, manifest, timer=None):
+        self.module_name = module_name
+        self.manifest = manifest
+        self.timer = timer
+        self.name = manifest.get('name', module_name)
+
+    def Plugin(self, initial_settings):
+        return LazyPlugin(self.module_name, self.manifest, initial_settings, self.timer)
+
+
+def get_manifest(module_name):
+    """Return the contents of a plugin's manifest.json, or None if it does not
+    have one"""
+    path = os.path.join(PLUGINS_DIR, module_name, 'manifest.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def import_plugin(module_name, timer=None):
+    """Import and return a plugin module. timer, if given, is called with the
+    module name and should return a context manager, which the import is
+    done within"""
+    if timer is None:
+        return importlib.import_module('blacs.plugins.' + module_name)
+    with timer(module_name):
+        return importlib.import_module('blacs.plugins.' + module_name)
+
+
+modules = {}
+
+def load_plugins(exp_config, timer=None):
+    """Find the plugins enabled in the lab config, adding any new plugins to
+    it. Plugins whose manifest allows it are not imported until they are first
+    needed. The others are imported now. Returns a dict of module name:
+    module, in which lazily loaded plugins are represented by a
+    LazyPluginModule."""
+    if not exp_config.has_section('BLACS/plugins'):
+        exp_config.add_section('BLACS/plugins')
+    if exp_config.has_option('BLACS', 'plugin_callback_budget'):
+        callback_dispatcher.budget = exp_config.getfloat('BLACS', 'plugin_callback_budget')
+
+    start_time = time.time()
+    modules.clear()
+    n_lazy = 0
+    for module_name in os.listdir(PLUGINS_DIR):
+        if os.path.isdir(os.path.join(PLUGINS_DIR, module_name)) and module_name != '__pycache__':
+            # is it a new plugin?
+            # If so lets add it to the config
+            if not module_name in [name for name, val in exp_config.items('BLACS/plugins')]:
+                exp_config.set('BLACS/plugins', module_name, str(module_name in default_plugins))
+
+            # only load activated plugins
+            if exp_config.getboolean('BLACS/plugins', module_name):
+                try:
+                    manifest = get_manifest(module_name)
+                    if manifest is not None and manifest.get('lazy', False):
+                        modules[module_name] = LazyPluginModule(module_name, manifest, timer)
+                        n_lazy += 1
+                    else:
+                        modules[module_name] = import_plugin(module_name, timer)
+                except Exception:
+                    logger.exception('Could not import plugin \'%s\'. Skipping.'%module_name)
+
+    logger.info('Imported %d plugin(s) in %.3fs, deferred importing %d plugin(s) until first use' %
+                (len(modules) - n_lazy, time.time() - start_time, n_lazy))
+    return modules
+
+
+callback_registry = CallbackRegistry()
+callback_dispatcher = CallbackDispatcher(callback_registry)
+dispatch = callback_dispatcher.dispatch
+run_filters = callback_dispatcher.run_filters
@@ -0,0 +1,271 @@
+#####################################################################
+#                                                                   #
+# /plugins/cycle_time/__init__.py                                   #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import logging
+import threading
+import time
+from collections import deque
+
+from qtutils.qt import QtGui, QtWidgets, QtCore
+
+from blacs.tab_base_classes import PluginTab
+
+name = "Cycle Time"
+module = "cycle_time" # should be folder name
+logger = logging.getLogger('BLACS.plugin.%s'%module)
+
+TAB_NAME = 'Cycle time'
+# How many shots to keep timings for:
+HISTORY_LENGTH = 2000
+# Shots per minute is computed over shots completed within this many seconds:
+RATE_WINDOW = 300
+# How often to redraw the tab, in milliseconds, if it is visible and there
+# is new data:
+REFRESH_INTERVAL = 1000
+# The phases of the shot cycle timed by the queue manager:
+PHASES = ['programming', 'run', 'save', 'submit']
+N_BINS = 20
+
+
+class CycleTimeHistory(object):
+    """Timings of the most recent shots, as passed to the 'shot_timings'
+    callback, in a fixed size ring buffer so that memory use is bounded on long
+    runs"""
+    def __init__(self, maxlen=HISTORY_LENGTH):
+        self.shots = deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+        # Incremented on each new shot, so readers can tell if anything changed:
+        self.version = 0
+
+    def add(self, shot_timings):
+        with self.lock:
+            self.shots.append(shot_timings)
+            self.version += 1
+
+    def snapshot(self):
+        """Return a list of the timings of each shot, and the version"""
+        with self.lock:
+            return list(self.shots), self.version
+
+
+class HistogramWidget(QtWidgets.QWidget):
+    """Histogram of durations"""
+    def __init__(self, title, parent=None):
+        QtWidgets.QWidget.__init__(self, parent)
+        self.title = title
+        self.values = []
+        self.setMinimumSize(200, 120)
+
+    def set_values(self, values):
+        self.values = list(values)
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        rect = self.rect().adjusted(4, 4, -4, -4)
+        text_height = painter.fontMetrics().height()
+        if self.values:
+            low, high = min(self.values), max(self.values)
+            mean = sum(self.values) / len(self.values)
+            title = '%s: mean %.3fs, range %.3f-%.3fs' % (self.title, mean, low, high)
+        else:
+            title = '%s: no data' % self.title
+        painter.drawText(rect.left(), rect.top() + text_height, title)
+        if not self.values:
+            return
+        plot = rect.adjusted(0, text_height + 4, 0, 0)
+        width = (high - low) or 1
+        counts = [0] * N_BINS
+        for value in self.values:
+            counts[min(int((value - low) / width * N_BINS), N_BINS - 1)] += 1
+        max_count = max(counts)
+        bar_width = plot.width() / N_BINS
+        painter.setPen(QtCore.Qt.NoPen)
+        painter.setBrush(self.palette().color(QtGui.QPalette.Highlight))
+        for i, count in enumerate(counts):
+            bar_height = plot.height() * count / max_count
+            painter.drawRect(QtCore.QRectF(plot.left() + i * bar_width, plot.bottom() - bar_height,
+                                           max(bar_width - 1, 1), bar_height))
+
+
+class TimeSeriesWidget(QtWidgets.QWidget):
+    """Line plot of a value against time"""
+    def __init__(self, title, parent=None):
+        QtWidgets.QWidget.__init__(self, parent)
+        self.title = title
+        self.points = []
+        self.setMinimumSize(200, 120)
+
+    def set_points(self, points):
+        self.points = list(points)
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        rect = self.rect().adjusted(4, 4, -4, -4)
+        text_height = painter.fontMetrics().height()
+        if self.points:
+            title = '%s: %s (max %s)' % (self.title, self.points[-1][1], max(y for x, y in self.points))
+        else:
+            title = '%s: no data' % self.title
+        painter.drawText(rect.left(), rect.top() + text_height, title)
+        if len(self.points) < 2:
+            return
+        plot = rect.adjusted(0, text_height + 4, 0, 0)
+        x_min, x_max = self.points[0][0], self.points[-1][0]
+        y_max = max(y for x, y in self.points) or 1
+        x_range = (x_max - x_min) or 1
+        polygon = QtGui.QPolygonF()
+        for x, y in self.points:
+            polygon.append(QtCore.QPointF(plot.left() + plot.width() * (x - x_min) / x_range,
+                                          plot.bottom() - plot.height() * y / y_max))
+        painter.setPen(self.palette().color(QtGui.QPalette.Highlight))
+        painter.drawPolyline(polygon)
+
+
+class CycleTimeTab(PluginTab):
+    def initialise_GUI(self):
+        self.history = None
+        self._drawn_version = None
+        layout = self.get_tab_layout()
+
+        self.rate_label = QtWidgets.QLabel()
+        layout.addWidget(self.rate_label)
+
+        grid = QtWidgets.QGridLayout()
+        self.histograms = {}
+        for i, phase in enumerate(PHASES):
+            self.histograms[phase] = HistogramWidget(phase.capitalize())
+            grid.addWidget(self.histograms[phase], i // 2, i % 2)
+        layout.addLayout(grid)
+
+        self.queue_depth_plot = TimeSeriesWidget('Queue depth')
+        layout.addWidget(self.queue_depth_plot)
+
+        self.device_table = QtWidgets.QTableWidget()
+        self.device_table.setColumnCount(5)
+        self.device_table.setHorizontalHeaderLabels(['Device',
+                                                     'transition_to_buffered mean (s)',
+                                                     'transition_to_buffered max (s)',
+                                                     'transition_to_manual mean (s)',
+                                                     'transition_to_manual max (s)'])
+        self.device_table.verticalHeader().hide()
+        self.device_table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        layout.addWidget(self.device_table)
+
+        self.refresh_timer = QtCore.QTimer()
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start(REFRESH_INTERVAL)
+
+    def set_history(self, history):
+        self.history = history
+        self.refresh()
+
+    def refresh(self):
+        """Redraw the tab if it is visible and there is new data"""
+        if self.history is None or not self._ui.isVisible():
+            return
+        shots, version = self.history.snapshot()
+        if version == self._drawn_version:
+            return
+        self._drawn_version = version
+
+        now = time.time()
+        recent = [shot['end_time'] for shot in shots if shot['end_time'] > now - RATE_WINDOW]
+        if len(recent) > 1 and recent[-1] > recent[0]:
+            rate = 60 * (len(recent) - 1) / (recent[-1] - recent[0])
+        else:
+            rate = 0
+        if shots:
+            last_cycle = shots[-1]['end_time'] - shots[-1]['start_time']
+            self.rate_label.setText('<b>%.1f shots/minute</b> over the last %d minutes. Last shot cycle: %.2fs. %d shots recorded.' %
+                                    (rate, RATE_WINDOW // 60, last_cycle, len(shots)))
+        else:
+            self.rate_label.setText('No shots recorded')
+
+        for phase, histogram in self.histograms.items():
+            histogram.set_values(shot['phases'][phase] for shot in shots if phase in shot['phases'])
+
+        self.queue_depth_plot.set_points((shot['end_time'], shot['queue_depth']) for shot in shots)
+
+        device_stats = {}
+        for shot in shots:
+            for column, transition in enumerate(['transition_to_buffered', 'transition_to_manual']):
+                for device_name, duration in shot[transition].items():
+                    durations = device_stats.setdefault(device_name, ([], []))[column]
+                    durations.append(duration)
+        self.device_table.setRowCount(len(device_stats))
+        for row, device_name in enumerate(sorted(device_stats)):
+            cells = [device_name]
+            for durations in device_stats[device_name]:
+                if durations:
+                    cells.extend(['%.3f' % (sum(durations) / len(durations)), '%.3f' % max(durations)])
+                else:
+                    cells.extend(['', ''])
+            for column, text in enumerate(cells):
+                self.device_table.setItem(row, column, QtWidgets.QTableWidgetItem(text))
+        self.device_table.resizeColumnsToContents()
+
+    def destroy(self):
+        self.refresh_timer.stop()
+        PluginTab.destroy(self)
+
+
+class Plugin(object):
+    def __init__(self, initial_settings):
+        self.menu = None
+        self.notifications = {}
+        self.initial_settings = initial_settings
+        self.BLACS = None
+        self.history = CycleTimeHistory(initial_settings.get('history_length', HISTORY_LENGTH))
+        self.tab = None
+
+    def get_tab_classes(self):
+        return {TAB_NAME: CycleTimeTab}
+
+    def tabs_created(self, tab_dict):
+        self.tab = tab_dict[TAB_NAME]
+        self.tab.set_history(self.history)
+
+    def get_callbacks(self):
+        return {'shot_timings': self.on_shot_timings}
+
+    def on_shot_timings(self, h5_filepath, shot_timings):
+        self.history.add(shot_timings)
+
+    def plugin_setup_complete(self, BLACS):
+        self.BLACS = BLACS
+
+    def get_save_data(self):
+        return {'history_length': self.history.shots.maxlen}
+
+    def close(self):
+        pass
+
+    # The rest of these are boilerplate:
+    def get_menu_class(self):
+        return None
+
+    def get_notification_classes(self):
+        return []
+
+    def get_setting_classes(self):
+        return []
+
+    def set_menu_instance(self, menu):
+        self.menu = menu
+
+    def set_notification_instances(self, notifications):
+        self.notifications = notifications
@@ -19,9 +19,11 @@ else:
 
 import logging
 import os
+import shutil
 import subprocess
 import threading
 import sys
+from collections import deque
 
 from qtutils import UiLoader
 
@@ -36,6 +38,38 @@ logger = logging.getLogger('BLACS.plugin.%s'%module)
 
 KEEP_ALL_SHOTS = 0
 
+# Number of threads deleting files in parallel. Acquiring the lock on each file
+# is a network round trip, so deleting several at once keeps up with fast
+# repeats on a networked drive:
+N_DELETION_THREADS = 4
+
+# If the fraction of free space on the disk the shots are on falls below this,
+# a warning is logged. Set with the 'min_free_disk_fraction' option in the
+# BLACS section of the lab config. None for no check:
+DEFAULT_MIN_FREE_DISK_FRACTION = None
+# Whilst free space is below min_free_disk_fraction, keep at most this many
+# repeated shots, even if the user has chosen to keep more. Set with the
+# 'low_disk_n_shots_to_keep' option in the BLACS section of the lab config.
+# None to always keep as many as the user has chosen:
+DEFAULT_LOW_DISK_N_SHOTS_TO_KEEP = None
+
+# Log a warning if more than this many files are waiting to be deleted:
+BACKLOG_WARNING_THRESHOLD = 20
+
+
+def free_disk_fraction(path):
+    """Return the fraction of the disk containing path that is free, or None
+    if it cannot be determined"""
+    try:
+        if hasattr(shutil, 'disk_usage'):
+            usage = shutil.disk_usage(path)
+            return usage.free / usage.total
+        stat = os.statvfs(path)
+        return stat.f_bavail / stat.f_blocks
+    except (OSError, AttributeError, ZeroDivisionError):
+        return None
+
+
 class Plugin(object):
     def __init__(self, initial_settings):
         self.menu = None
@@ -44,15 +78,32 @@ class Plugin(object):
         self.BLACS = None
         self.ui = None
         self.n_shots_to_keep = initial_settings.get('n_shots_to_keep', KEEP_ALL_SHOTS)
-        self.delete_queue = initial_settings.get('delete_queue', [])
+        self.delete_queue = deque(initial_settings.get('delete_queue', []))
+        self.min_free_disk_fraction = DEFAULT_MIN_FREE_DISK_FRACTION
+        self.low_disk_n_shots_to_keep = DEFAULT_LOW_DISK_N_SHOTS_TO_KEEP
+        self.disk_low = False
         self.event_queue = Queue()
         self.delete_queue_lock = threading.Lock()
+        # Files handed to the deletion threads that they have not finished with:
+        self.n_deleting = 0
+        self.deletion_jobs = Queue()
+        self.deletion_threads = []
+        for i in range(N_DELETION_THREADS):
+            thread = threading.Thread(target=self.deletion_worker)
+            thread.daemon = True
+            thread.start()
+            self.deletion_threads.append(thread)
         self.mainloop_thread = threading.Thread(target=self.mainloop)
         self.mainloop_thread.daemon = True
         self.mainloop_thread.start()
         
     def plugin_setup_complete(self, BLACS):
         self.BLACS = BLACS
+        exp_config = BLACS['exp_config']
+        if exp_config.has_option('BLACS', 'min_free_disk_fraction'):
+            self.min_free_disk_fraction = exp_config.getfloat('BLACS', 'min_free_disk_fraction')
+        if exp_config.has_option('BLACS', 'low_disk_n_shots_to_keep'):
+            self.low_disk_n_shots_to_keep = exp_config.getint('BLACS', 'low_disk_n_shots_to_keep')
 
         # Add our controls to the BLACS UI:
         self.ui = UiLoader().load(os.path.join(PLUGINS_DIR, module, 'controls.ui'))
@@ -81,14 +132,21 @@ class Plugin(object):
             # the 95 oldest shots in the queue. Rather it will only delete the
             # most recent 5 (and not immediately - over the next 5 shots).
             while len(self.delete_queue) > self.n_shots_to_keep:
-                self.delete_queue.pop(0)
+                self.delete_queue.popleft()
 
     def on_reset_button_clicked(self):
         self.ui.spinBox.setValue(KEEP_ALL_SHOTS)
 
     def get_save_data(self):
         return {'n_shots_to_keep': self.n_shots_to_keep,
-                'delete_queue': self.delete_queue}
+                'delete_queue': list(self.delete_queue)}
+
+    def get_backlog(self):
+        """Return the number of files that should have been deleted but have
+        not been yet"""
+        with self.delete_queue_lock:
+            excess = max(0, len(self.delete_queue) - self.n_shots_to_keep)
+            return excess + self.n_deleting
     
     def get_callbacks(self):
         return {'shot_complete': self.on_shot_complete}
@@ -114,34 +172,84 @@ class Plugin(object):
                 self.event_queue.put('shot complete')
 
     def mainloop(self):
-        # We delete shots in a separate thread so that we don't slow down the queue waiting on
-        # network communication to acquire the lock, 
+        # We delete shots in separate threads so that we don't slow down the queue waiting on
+        # network communication to acquire the lock. This thread decides which files to delete,
+        # and hands them to the deletion threads in batches.
         while True:
             try:
                 event = self.event_queue.get()
                 if event == 'close':
                     break
                 elif event == 'shot complete':
-                    while len(self.delete_queue) > self.n_shots_to_keep:
-                        with self.delete_queue_lock:
-                            h5_filepath = self.delete_queue.pop(0)
-                        # Acquire a lock on the file so that we don't
-                        # delete it whilst someone else has it open:
-                        with zprocess.locking.Lock(path_to_agnostic(h5_filepath)):
-                            try:
-                                os.unlink(h5_filepath)
-                                logger.info("Deleted repeated shot file %s" % h5_filepath)
-                            except OSError:
-                                logger.exception("Couldn't delete shot file %s" % h5_filepath)
+                    self.delete_excess_shots()
                 else:
                     raise ValueError(event)
             except Exception:
                 logger.exception("Exception in repeated shot deletion loop, ignoring.")
-    
+
+    def delete_excess_shots(self):
+        with self.delete_queue_lock:
+            if not self.delete_queue:
+                return
+            n_shots_to_keep = self.n_shots_to_keep
+            most_recent_shot = self.delete_queue[-1]
+        if self.check_disk_low(most_recent_shot) and self.low_disk_n_shots_to_keep is not None:
+            n_shots_to_keep = min(n_shots_to_keep, max(1, self.low_disk_n_shots_to_keep))
+        batch = []
+        with self.delete_queue_lock:
+            while len(self.delete_queue) > n_shots_to_keep:
+                batch.append(self.delete_queue.popleft())
+            self.n_deleting += len(batch)
+        for h5_filepath in batch:
+            self.deletion_jobs.put(h5_filepath)
+        backlog = self.get_backlog()
+        if backlog > BACKLOG_WARNING_THRESHOLD:
+            logger.warning("%d repeated shot files waiting to be deleted" % backlog)
+
+    def check_disk_low(self, h5_filepath):
+        """Return whether the fraction of free space on the disk containing
+        h5_filepath is below min_free_disk_fraction, logging a warning when it
+        first falls below it"""
+        if self.min_free_disk_fraction is None:
+            return False
+        free_fraction = free_disk_fraction(os.path.dirname(h5_filepath))
+        disk_low = free_fraction is not None and free_fraction < self.min_free_disk_fraction
+        if disk_low and not self.disk_low:
+            if self.low_disk_n_shots_to_keep is not None:
+                action = "Keeping only the last %d repeated shot(s)" % max(1, self.low_disk_n_shots_to_keep)
+            else:
+                action = "Repeated shots will still be kept as set"
+            logger.warning("Only %.1f%% of disk space free. %s" % (100 * free_fraction, action))
+        self.disk_low = disk_low
+        return disk_low
+
+    def deletion_worker(self):
+        while True:
+            h5_filepath = self.deletion_jobs.get()
+            if h5_filepath is None:
+                break
+            try:
+                # Acquire a lock on the file so that we don't
+                # delete it whilst someone else has it open:
+                with zprocess.locking.Lock(path_to_agnostic(h5_filepath)):
+                    try:
+                        os.unlink(h5_filepath)
+                        logger.info("Deleted repeated shot file %s" % h5_filepath)
+                    except OSError:
+                        logger.exception("Couldn't delete shot file %s" % h5_filepath)
+            except Exception:
+                logger.exception("Exception deleting shot file %s, ignoring." % h5_filepath)
+            finally:
+                with self.delete_queue_lock:
+                    self.n_deleting -= 1
 
     def close(self):
         self.event_queue.put('close')
         self.mainloop_thread.join()
+        for thread in self.deletion_threads:
+            self.deletion_jobs.put(None)
+        for thread in self.deletion_threads:
+            thread.join()
 
 
     # The rest of these are boilerplate:
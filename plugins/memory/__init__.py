@@ -19,6 +19,7 @@ import os
 import logging
 import gc
 from blacs import BLACS_DIR
+from blacs.plugins import get_manifest_menu_items
 from labscript_utils import memprof, check_version
 check_version('labscript_utils', '2.6.2', '3')
 
@@ -65,22 +66,33 @@ class Menu(object):
     def __init__(self,BLACS):
         self.BLACS = BLACS
         self.close_notification_func = None
-        memprof.start(filepath=os.path.join(BLACS_DIR, 'memprof.txt'))        
-        
+        # The plugin is loaded lazily, when its menu is first used, so the
+        # profiler is started then rather than at startup:
+        self.profiler_started = False
+        # The menu's names and icons are in manifest.json:
+        self.menu_items = get_manifest_menu_items(module, {'Garbage collect': self.garbage_collect,
+                                                           'Reset profiler': self.reset_profiler,
+                                                           'Diff memory usage': self.diff_memory_usage})
+
+    def start_profiler(self):
+        if not self.profiler_started:
+            memprof.start(filepath=os.path.join(BLACS_DIR, 'memprof.txt'))
+            self.profiler_started = True
+
+    def garbage_collect(self, *args):
+        self.start_profiler()
+        gc.collect()
+
+    def reset_profiler(self, *args):
+        if self.profiler_started:
+            memprof.start()
+        else:
+            self.start_profiler()
+
+    def diff_memory_usage(self, *args):
+        self.start_profiler()
+        memprof.check()
+
     def get_menu_items(self):
-        return {'name':name,        
-                'menu_items':[{'name':'Garbage collect',
-                               'action':gc.collect,
-                               'icon': ':/qtutils/fugue/memory'
-                              },
-                              {'name':'Reset profiler',
-                               'action':memprof.start,
-                               'icon': ':/qtutils/fugue/counter-reset'
-                              },
-                              {'name':'Diff memory usage',
-                               'action':memprof.check,
-                               'icon': ':/qtutils/fugue/tables'
-                              }
-                             ]                                
-               }
+        return self.menu_items
     
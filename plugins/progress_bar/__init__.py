@@ -41,10 +41,18 @@ name = "Progress Bar"
 module = "progress_bar" # should be folder name
 logger = logging.getLogger('BLACS.plugin.%s'%module)
 
-# The progress bar will update every UPDATE_INTERVAL seconds, or at the marker
-# times, whichever is soonest after the last update:
-UPDATE_INTERVAL = 0.02
+# How many times per second the progress bar is redrawn whilst a shot is
+# running. Faster than this looks no smoother, but wakes the GUI more often:
+REFRESH_RATE = 15
 BAR_MAX = 1000
+# If the wait monitor does not support wait completed events, waits are shown
+# as lasting this long:
+NO_EVENTS_WAIT_DURATION = 0.1
+# How often the wait completed event listener checks whether its shot is over,
+# in seconds:
+LISTENER_TIMEOUT = 0.1
+# How long the event listener pauses after an error, in seconds:
+LISTENER_ERROR_PAUSE = 1
 
 def _ensure_str(s):
     """convert bytestrings and numpy strings to python strings"""
@@ -87,7 +95,19 @@ class Plugin(object):
         self.bar_text_prefix = None
         self.h5_filepath = None
         self.wait_completed_events_supported = False
-        self.wait_completed = Event('wait_completed', type='wait')
+        self.in_wait = False
+        self.wait_start_time = None
+        # Labscript time to display whilst in a wait:
+        self.frozen_time = None
+        # Snapshot of (shot_start_time, time_spent_waiting, frozen_time,
+        # stop_time) read by the GUI when redrawing, or None if no shot is
+        # running:
+        self._timing = None
+        self._last_bar_value = None
+        self._last_bar_text = None
+        self.redraw_timer = None
+        # Set when the current shot ends, to stop its event listener:
+        self._shot_over = None
         self.mainloop_thread = threading.Thread(target=self.mainloop)
         self.mainloop_thread.daemon = True
         self.mainloop_thread.start()
@@ -106,6 +126,11 @@ class Plugin(object):
         self.bar.setStyle(self.style)
         self.bar.setMaximum(BAR_MAX)
         self.bar.setAlignment(QtCore.Qt.AlignCenter)
+        # Redraws are driven by a timer whilst a shot is running, rather than
+        # by the mainloop:
+        self.redraw_timer = QtCore.QTimer()
+        self.redraw_timer.setInterval(int(1000 / REFRESH_RATE))
+        self.redraw_timer.timeout.connect(self.redraw)
         # Add our controls to the BLACS gui:
         BLACS['ui'].queue_status_verticalLayout.insertWidget(0, self.ui)
         # We need to know the name of the master pseudoclock so we can look up
@@ -133,16 +158,36 @@ class Plugin(object):
         
     @callback(priority=100)
     def on_science_starting(self, h5_filepath):
-        # Tell the mainloop that we're starting a shot:
-        self.command_queue.put(('start', h5_filepath))
+        # Tell the mainloop that we're starting a shot. This is not
+        # asynchronous so that the shot's start time is taken as soon as
+        # possible:
+        self.command_queue.put(('start', (h5_filepath, time.time())))
 
     @callback(priority=5)
     def on_science_over(self, h5_filepath):
         # Tell the mainloop we're done with this shot:
         self.command_queue.put(('stop', None))
 
+    def listen(self, wait_completed, h5_filepath, shot_over):
+        """Pass wait completed events posted for a shot to the mainloop until
+        the shot is over. Run in a thread for each shot."""
+        while not shot_over.is_set():
+            try:
+                data = wait_completed.wait(h5_filepath, timeout=LISTENER_TIMEOUT)
+            except TimeoutError:
+                continue
+            except Exception:
+                logger.exception("Exception in wait_completed listener, ignoring.")
+                shot_over.wait(LISTENER_ERROR_PAUSE)
+                continue
+            self.command_queue.put(('wait_completed', (h5_filepath, data)))
+
     @inmain_decorator(True)
     def clear_bar(self):
+        if self.redraw_timer is not None:
+            self.redraw_timer.stop()
+        self._last_bar_value = None
+        self._last_bar_text = None
         self.bar.setEnabled(False)
         self.bar.setFormat('No shot running')
         self.bar.setValue(0)
@@ -150,11 +195,16 @@ class Plugin(object):
         self.ui.wait_warning.hide()
 
     def get_next_thing(self):
-        """Figure out what's going to happen next: a wait, a time marker, or a
-        regular update. Return a string saying which, and a float saying how
-        long from now it will occur. If the thing has already happened but not
-        been taken into account by our processing yet, then return zero for
-        the time."""
+        """Figure out what's going to happen next: a wait or a time marker, or
+        the end of a wait if wait completed events are not supported. Return a
+        string saying which, and a float saying how long from now it will
+        occur, or (None, None) if there is nothing to do until the next
+        command or event. If the thing has already happened but not been taken
+        into account by our processing yet, then return zero for the time."""
+        if self.in_wait:
+            if self.wait_completed_events_supported:
+                return None, None
+            return 'wait timeout', max(0, self.wait_start_time + NO_EVENTS_WAIT_DURATION - time.time())
         if self.waits is not None and self.next_wait_index < len(self.waits):
             next_wait_time = self.waits['time'][self.next_wait_index]
         else:
@@ -163,17 +213,56 @@ class Plugin(object):
             next_marker_time = self.markers['time'][self.next_marker_index]
         else:
             next_marker_time = np.inf
+        if next_wait_time == np.inf and next_marker_time == np.inf:
+            return None, None
         assert self.shot_start_time is not None
         assert self.time_spent_waiting is not None
         labscript_time = time.time() - self.shot_start_time - self.time_spent_waiting
-        next_update_time = labscript_time + UPDATE_INTERVAL
-        if next_update_time < next_wait_time and next_update_time < next_marker_time:
-            return 'update', UPDATE_INTERVAL
-        elif next_wait_time < next_marker_time:
+        if next_wait_time < next_marker_time:
             return 'wait', max(0, next_wait_time - labscript_time)
         else:
             return 'marker', max(0, next_marker_time - labscript_time)
 
+    def _publish_timing(self):
+        """Update the snapshot of the shot's timing that the GUI reads"""
+        self._timing = (self.shot_start_time, self.time_spent_waiting, self.frozen_time, self.stop_time)
+
+    def _begin_wait(self):
+        self.in_wait = True
+        self.wait_start_time = time.time()
+        self.update_bar_style(wait=True)
+        self.frozen_time = self.waits['time'][self.next_wait_index]
+        self.next_wait_index += 1
+        self._publish_timing()
+
+    def _end_wait(self):
+        wait_time = self.waits['time'][self.next_wait_index - 1]
+        # Resume from the time of the wait, correcting any drift between our
+        # estimate of the labscript time and the actual time:
+        self.time_spent_waiting = time.time() - self.shot_start_time - wait_time
+        self.in_wait = False
+        self.wait_start_time = None
+        self.frozen_time = None
+        # Set the bar style back to whatever the previous marker was, if any:
+        self.update_bar_style(marker=self.next_marker_index > 0, previous=True)
+        self._publish_timing()
+
+    @inmain_decorator(True)
+    def start_redraws(self):
+        self.redraw_timer.start()
+
+    def redraw(self):
+        """Called by the redraw timer in the main thread"""
+        timing = self._timing
+        if timing is None:
+            return
+        shot_start_time, time_spent_waiting, frozen_time, stop_time = timing
+        if frozen_time is not None:
+            labscript_time = frozen_time
+        else:
+            labscript_time = min(time.time() - shot_start_time - time_spent_waiting, stop_time)
+        self.update_bar_value(labscript_time, stop_time)
+
     @inmain_decorator(True)
     def update_bar_style(self, marker=False, wait=False, previous=False):
         """Update the bar's style to reflect the next marker or wait,
@@ -231,31 +320,25 @@ class Plugin(object):
             self.bar.setPalette(self.style.standardPalette())
 
     @inmain_decorator(True)
-    def update_bar_value(self, marker=False, wait=False):
-        """Update the progress bar with the current time elapsed. If marker or wait is
-        true, then use the exact time at which the next marker or wait is defined,
-        rather than the current time as returned by time.time()"""
+    def update_bar_value(self, labscript_time, stop_time):
+        """Update the progress bar to show the given labscript time. Only
+        updates the bar if what is shown would change."""
         thinspace = u'\u2009'
-        self.bar.setEnabled(True)
-        assert not (marker and wait)
-        if marker:
-            labscript_time = self.markers['time'][self.next_marker_index]
-        elif wait:
-            labscript_time = self.waits['time'][self.next_wait_index]
-        else:
-            labscript_time = time.time() - self.shot_start_time - self.time_spent_waiting
-        value = int(round(labscript_time / self.stop_time * BAR_MAX))
-        self.bar.setValue(value)
-
+        value = int(round(labscript_time / stop_time * BAR_MAX))
         text = u'%.2f%ss / %.2f%ss (%%p%s%%)'
-        text = text % (labscript_time, thinspace, self.stop_time, thinspace, thinspace)
+        text = text % (labscript_time, thinspace, stop_time, thinspace, thinspace)
         if self.bar_text_prefix is not None:
             text = self.bar_text_prefix + text
+        if value == self._last_bar_value and text == self._last_bar_text:
+            return
+        self._last_bar_value = value
+        self._last_bar_text = text
+        self.bar.setEnabled(True)
+        self.bar.setValue(value)
         self.bar.setFormat(text)
 
-    def _start(self, h5_filepath):
+    def _start(self, h5_filepath, start_time):
         """Called from the mainloop when starting a shot"""
-        self.h5_filepath = h5_filepath
         # Get the stop time, any waits and any markers from the shot:
         with h5py.File(h5_filepath, 'r') as f:
             props = properties.get(f, self.master_pseudoclock, 'device_properties')
@@ -270,13 +353,31 @@ class Plugin(object):
                 self.waits.sort(order=(bytes if PY2 else str)('time'))
             except KeyError:
                 self.waits = None
-        self.shot_start_time = time.time()
+        self.shot_start_time = start_time
         self.time_spent_waiting = 0
         self.next_marker_index = 0
         self.next_wait_index = 0
+        self.in_wait = False
+        self.frozen_time = None
+        self.h5_filepath = h5_filepath
+        self._publish_timing()
+        if self.wait_completed_events_supported and self.waits is not None and len(self.waits) > 0:
+            # Subscribed to for each shot, before the shot starts, so that no
+            # events are missed. Subscribing is confirmed by the event broker
+            # before this returns:
+            wait_completed = Event('wait_completed', type='wait')
+            self._shot_over = threading.Event()
+            listener_thread = threading.Thread(target=self.listen,
+                                               args=(wait_completed, h5_filepath, self._shot_over))
+            listener_thread.daemon = True
+            listener_thread.start()
 
     def _stop(self):
         """Called from the mainloop when ending a shot"""
+        if self._shot_over is not None:
+            self._shot_over.set()
+            self._shot_over = None
+        self._timing = None
         self.h5_filepath = None
         self.shot_start_time = None
         self.stop_time = None
@@ -286,6 +387,9 @@ class Plugin(object):
         self.next_wait_index = None
         self.next_marker_index = None
         self.bar_text_prefix = None
+        self.in_wait = False
+        self.wait_start_time = None
+        self.frozen_time = None
 
     def mainloop(self):
         running = False
@@ -294,57 +398,32 @@ class Plugin(object):
             try:
                 if running:
                     # How long until the next thing of interest occurs, and
-                    # what is it? It can be either a wait, a marker, or a
-                    # regular update.
+                    # what is it? It can be either a wait, a marker, or the
+                    # end of a wait. Redrawing in between is done by the GUI.
                     next_thing, timeout = self.get_next_thing()
                     try:
-                        command, _ = self.command_queue.get(timeout=timeout)
+                        command, data = self.command_queue.get(timeout=timeout)
                     except Empty:
-                        if next_thing == 'update':
-                            self.update_bar_value()
                         if next_thing == 'marker':
                             self.update_bar_style(marker=True)
-                            self.update_bar_value(marker=True)
                             self.next_marker_index += 1
                         elif next_thing == 'wait':
-                            wait_start_time = time.time()
-                            self.update_bar_style(wait=True)
-                            self.update_bar_value(wait=True)
-                            self.next_wait_index += 1
-                            # wait for the wait to complete, but abandon
-                            # processing if the command queue is non-empty,
-                            # i.e. if a stop command is sent.
-                            while self.command_queue.empty():
-                                try:
-                                    # Wait for only 0.1 sec at a time, so that
-                                    # we can check if the queue is empty in between:
-                                    self.wait_completed.wait(self.h5_filepath, timeout=0.1)
-                                except TimeoutError:
-                                    # Only wait for wait completed events if the wait
-                                    # monitor device supports them. Otherwise, skip
-                                    # after this first timeout, and it will just look
-                                    # like the wait had 0.1 sec duration.
-                                    if self.wait_completed_events_supported:
-                                        # The wait is still in progress:
-                                        continue
-                                # The wait completed (or completion events are not
-                                # supported):
-                                self.time_spent_waiting += time.time() - wait_start_time
-                                # Set the bar style back to whatever the
-                                # previous marker was, if any:
-                                self.update_bar_style(marker=True, previous=True)
-                                self.update_bar_value()
-                                break
+                            self._begin_wait()
+                        elif next_thing == 'wait timeout':
+                            # Wait completed events are not supported, so it
+                            # will just look like the wait had a short duration:
+                            self._end_wait()
                         continue
                 else:
-                    command, h5_filepath = self.command_queue.get()
+                    command, data = self.command_queue.get()
                 if command == 'close':
                     break
                 elif command == 'start':
                     assert not running
                     running = True
-                    self._start(h5_filepath)
-                    self.update_bar_value()
+                    h5_filepath, start_time = data
+                    self._start(h5_filepath, start_time)
+                    self.start_redraws()
                     if (
                         self.waits is not None
                         and len(self.waits) > 0
@@ -356,6 +435,18 @@ class Plugin(object):
                     self.clear_bar()
                     running = False
                     self._stop()
+                elif command == 'wait_completed':
+                    h5_filepath, _ = data
+                    if not running or h5_filepath != self.h5_filepath:
+                        # Event for a previous shot:
+                        continue
+                    if not self.in_wait:
+                        # Our estimate of the labscript time has not reached
+                        # the wait yet. Catch up to it:
+                        if self.waits is None or self.next_wait_index >= len(self.waits):
+                            continue
+                        self._begin_wait()
+                    self._end_wait()
                 else:
                     raise ValueError(command)
             except Exception:
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#####################################################################
+#                                                                   #
+# /resource_monitor.py                                              #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import logging
+import threading
+import time
+from collections import deque
+
+from qtutils import inmain_later
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Seconds between samples of each worker process:
+SAMPLE_INTERVAL = 2
+# Number of samples of each worker to keep:
+HISTORY_LENGTH = 300
+# Number of samples shown in the sparkline in each tab:
+SPARKLINE_LENGTH = 20
+SPARKLINE_CHARS = '▁▂▃▄▅▆▇█'
+# A worker whose memory use has grown after every one of this many shots, by
+# at least RSS_GROWTH_THRESHOLD bytes in total, is reported as possibly
+# leaking memory:
+RSS_GROWTH_SHOTS = 20
+RSS_GROWTH_THRESHOLD = 10 * 1024**2
+
+logger = logging.getLogger('BLACS.resource_monitor')
+
+
+def sparkline(values):
+    if not values:
+        return ''
+    low, high = min(values), max(values)
+    scale = (len(SPARKLINE_CHARS) - 1) / ((high - low) or 1)
+    return ''.join(SPARKLINE_CHARS[int(round((value - low) * scale))] for value in values)
+
+
+class WorkerResources(object):
+    """The resource usage of one worker process over time"""
+    def __init__(self, pid):
+        self.pid = pid
+        self.process = psutil.Process(pid)
+        # Tuples of (time, cpu_percent, rss, num_threads, num_handles):
+        self.samples = deque(maxlen=HISTORY_LENGTH)
+        # Memory use after each shot:
+        self.shot_rss = deque(maxlen=RSS_GROWTH_SHOTS + 1)
+        # The first call to cpu_percent() only starts the measurement:
+        self.process.cpu_percent(None)
+
+    def sample(self):
+        with self.process.oneshot():
+            cpu_percent = self.process.cpu_percent(None)
+            rss = self.process.memory_info().rss
+            num_threads = self.process.num_threads()
+            if hasattr(self.process, 'num_handles'):
+                num_handles = self.process.num_handles()
+            else:
+                num_handles = self.process.num_fds()
+        self.samples.append((time.time(), cpu_percent, rss, num_threads, num_handles))
+
+    def record_shot(self):
+        """Record memory use after a shot. Returns the growth in memory use if
+        it has grown after each of the last RSS_GROWTH_SHOTS shots by
+        RSS_GROWTH_THRESHOLD in total, otherwise None. Memory use is measured
+        now rather than taken from the last sample, as shots may be shorter
+        than SAMPLE_INTERVAL"""
+        self.shot_rss.append(self.process.memory_info().rss)
+        if len(self.shot_rss) < self.shot_rss.maxlen:
+            return None
+        rss = list(self.shot_rss)
+        growth = rss[-1] - rss[0]
+        if all(b > a for a, b in zip(rss, rss[1:])) and growth >= RSS_GROWTH_THRESHOLD:
+            # Only report again after another RSS_GROWTH_SHOTS shots of growth:
+            self.shot_rss.clear()
+            return growth
+        return None
+
+    def summary(self):
+        if not self.samples:
+            return None
+        _, cpu_percent, rss, num_threads, num_handles = self.samples[-1]
+        return {'pid': self.pid,
+                'cpu_percent': cpu_percent,
+                'rss': rss,
+                'num_threads': num_threads,
+                'num_handles': num_handles,
+                'samples': list(self.samples)}
+
+
+class ResourceMonitor(object):
+    """Samples the CPU use, memory use, thread count and open file handles of
+    the worker processes of all tabs, shows a summary in each tab, and logs
+    workers whose memory use grows steadily from shot to shot. Workers on
+    other computers are not monitored, and co-hosted workers show the usage of
+    the process they share. Requires psutil, and does nothing without it.
+    get_stats() returns the data, for dashboards."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        # tab: {worker_name: WorkerResources}
+        self._tabs = {}
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return psutil is not None
+
+    def register(self, tab):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._tabs[tab] = {}
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.mainloop)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def unregister(self, tab):
+        with self._lock:
+            self._tabs.pop(tab, None)
+
+    def mainloop(self):
+        logger.info('Monitoring worker resource usage')
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            try:
+                self.sample()
+            except Exception:
+                logger.exception('Error sampling worker resource usage')
+
+    def sample(self):
+        with self._lock:
+            tabs = list(self._tabs.items())
+        summaries = []
+        for tab, workers in tabs:
+            pids = tab.get_worker_pids()
+            for worker_name in list(workers):
+                if worker_name not in pids or workers[worker_name].pid != pids[worker_name]:
+                    del workers[worker_name]
+            for worker_name, pid in pids.items():
+                try:
+                    if worker_name not in workers:
+                        workers[worker_name] = WorkerResources(pid)
+                    workers[worker_name].sample()
+                except psutil.Error:
+                    # The process has exited, or is not ours to inspect:
+                    workers.pop(worker_name, None)
+            summaries.append((tab, self.describe(workers)))
+        inmain_later(self._update_tabs, summaries)
+
+    def describe(self, workers):
+        lines = []
+        for worker_name, resources in sorted(workers.items()):
+            if not resources.samples:
+                continue
+            _, cpu_percent, rss, num_threads, num_handles = resources.samples[-1]
+            history = [sample[2] for sample in list(resources.samples)[-SPARKLINE_LENGTH:]]
+            lines.append('%s: CPU %.0f%%, RSS %.0f MB %s, %d threads, %d handles' %
+                         (worker_name, cpu_percent, rss / 1024**2, sparkline(history), num_threads, num_handles))
+        return '\n'.join(lines)
+
+    def _update_tabs(self, summaries):
+        for tab, text in summaries:
+            # The tab's UI may have been destroyed in the meantime by a restart:
+            if getattr(tab, '_ui', None) is None:
+                continue
+            tab._ui.resource_label.setText(text)
+            tab._ui.resource_label.setVisible(bool(text))
+
+    def record_shot(self, device_names):
+        """Called after each shot with the devices used in it, to check their
+        workers for steadily growing memory use"""
+        with self._lock:
+            tabs = [(tab, workers) for tab, workers in self._tabs.items() if tab.device_name in device_names]
+        for tab, workers in tabs:
+            for worker_name, resources in list(workers.items()):
+                try:
+                    growth = resources.record_shot()
+                except psutil.Error:
+                    # The process has exited, and will be removed at the next sample:
+                    continue
+                if growth is not None:
+                    message = ('Memory use of worker %s has grown after each of the last %d shots, by %.0f MB in total. ' %
+                               (worker_name, RSS_GROWTH_SHOTS, growth / 1024**2) + 'It may have a memory leak.')
+                    logger.warning('%s: %s' % (tab.device_name, message))
+
+    def get_stats(self):
+        """The current and recent resource usage of each worker, as
+        {device_name: {worker_name: {'pid', 'cpu_percent', 'rss',
+        'num_threads', 'num_handles', 'samples'}}}, where samples is a list of
+        (time, cpu_percent, rss, num_threads, num_handles)"""
+        with self._lock:
+            tabs = list(self._tabs.items())
+        stats = {}
+        for tab, workers in tabs:
+            stats[tab.device_name] = {}
+            for worker_name, resources in list(workers.items()):
+                summary = resources.summary()
+                if summary is not None:
+                    stats[tab.device_name][worker_name] = summary
+        return stats
+
+resource_monitor = ResourceMonitor()
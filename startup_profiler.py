@@ -0,0 +1,156 @@
+#####################################################################
+#                                                                   #
+# /startup_profiler.py                                              #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import os
+import io
+import json
+import time
+import logging
+import cProfile
+from contextlib import contextmanager
+
+logger = logging.getLogger('BLACS.startup_profiler')
+
+# How many of the slowest devices to list in the summary:
+N_SLOWEST_DEVICES = 10
+
+
+class StartupProfiler(object):
+    """Records how long each phase of BLACS startup takes, and optionally
+    profiles it with cProfile.
+
+    Top level phases are sequential: begin_phase() ends the current phase, if
+    any, and starts a new one. Within a phase, individual items (such as
+    device tabs) can be timed with the timed() context manager. Call finish()
+    once startup is complete to log a summary and write out any profiles."""
+
+    def __init__(self, profile=False, output_dir=None):
+        self.start_time = time.time()
+        # Open and close events, in order, as (type, name, category, time):
+        self.events = []
+        self.current_phase = None
+        self.finished = False
+        self.output_dir = output_dir
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.profiler = None
+
+    def _open(self, name, category):
+        self.events.append(('O', name, category, time.time()))
+
+    def _close(self, name, category):
+        self.events.append(('C', name, category, time.time()))
+
+    def begin_phase(self, name):
+        """End the current phase, if any, and begin a new one"""
+        if self.finished:
+            return
+        self.end_phase()
+        self.current_phase = name
+        self._open(name, 'phase')
+
+    def end_phase(self):
+        if self.current_phase is not None:
+            self._close(self.current_phase, 'phase')
+            self.current_phase = None
+
+    @contextmanager
+    def timed(self, name, category='device'):
+        """Context manager timing an item within the current phase"""
+        if self.finished:
+            yield
+            return
+        self._open(name, category)
+        try:
+            yield
+        finally:
+            self._close(name, category)
+
+    def durations(self, category):
+        """Return a list of (name, duration) for all completed items of the
+        given category, in the order they began"""
+        open_times = {}
+        results = []
+        for event_type, name, event_category, t in self.events:
+            if event_category != category:
+                continue
+            if event_type == 'O':
+                open_times[name] = t
+            else:
+                results.append((name, t - open_times.pop(name)))
+        return results
+
+    def finish(self):
+        """End profiling, log a summary of startup time, and write out the
+        cProfile and speedscope profiles if profiling is enabled"""
+        if self.finished:
+            return
+        self.end_phase()
+        self.finished = True
+        total = time.time() - self.start_time
+        lines = ['BLACS startup took %.2fs:' % total]
+        for name, duration in self.durations('phase'):
+            lines.append('    %7.3fs  %s' % (duration, name))
+        devices = self.durations('device')
+        if devices:
+            lines.append('Slowest devices to start:')
+            for name, duration in sorted(devices, key=lambda item: -item[1])[:N_SLOWEST_DEVICES]:
+                lines.append('    %7.3fs  %s' % (duration, name))
+        for category in sorted(set(event[2] for event in self.events) - set(['phase', 'device'])):
+            lines.append('%s:' % category.capitalize())
+            for name, duration in self.durations(category):
+                lines.append('    %7.3fs  %s' % (duration, name))
+        logger.info('\n'.join(lines))
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            output_dir = self.output_dir if self.output_dir is not None else os.getcwd()
+            prof_path = os.path.join(output_dir, 'blacs_startup.prof')
+            speedscope_path = os.path.join(output_dir, 'blacs_startup.speedscope.json')
+            try:
+                self.profiler.dump_stats(prof_path)
+                self.write_speedscope(speedscope_path)
+            except Exception:
+                logger.exception('Could not write startup profile')
+            else:
+                logger.info('Startup profile saved to %s and %s' % (prof_path, speedscope_path))
+
+    def write_speedscope(self, path):
+        """Write the recorded phases as a speedscope evented profile (see
+        https://www.speedscope.app), which shows them as a flame chart"""
+        frames = []
+        frame_indices = {}
+        events = []
+        for event_type, name, category, t in self.events:
+            key = (name, category)
+            if key not in frame_indices:
+                frame_indices[key] = len(frames)
+                frames.append({'name': name, 'file': category})
+            events.append({'type': event_type, 'frame': frame_indices[key], 'at': t - self.start_time})
+        end_value = self.events[-1][3] - self.start_time if self.events else 0
+        data = {'$schema': 'https://www.speedscope.app/file-format-schema.json',
+                'shared': {'frames': frames},
+                'profiles': [{'type': 'evented',
+                              'name': 'BLACS startup',
+                              'unit': 'seconds',
+                              'startValue': 0,
+                              'endValue': end_value,
+                              'events': events}],
+                'name': 'BLACS startup',
+                'exporter': 'BLACS'}
+        with io.open(path, 'w', encoding='utf8') as f:
+            f.write(str(json.dumps(data)))
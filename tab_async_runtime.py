@@ -0,0 +1,213 @@
+#####################################################################
+#                                                                   #
+# /tab_async_runtime.py                                             #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+# Requires Python 3. Enabled by setting 'tab_runtime = asyncio' in the 'BLACS'
+# section of the lab config.
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import asyncio
+import logging
+import math
+import threading
+
+import zmq
+import zprocess
+from qtutils import inmain_later
+from qtutils.qt.QtCore import QTimer, QSocketNotifier
+
+
+class QtDrivenEventLoop(asyncio.SelectorEventLoop):
+    """An asyncio event loop run in steps by the Qt main loop. Whenever a
+    callback is scheduled, a step is requested, in which the Qt main thread
+    runs all callbacks that are ready and then returns to Qt. The loop never
+    blocks waiting for I/O, so sockets should be watched with QSocketNotifiers
+    rather than with the loop's own reader callbacks."""
+    def __init__(self):
+        asyncio.SelectorEventLoop.__init__(self)
+        self._step_lock = threading.Lock()
+        self._step_requested = False
+        # Whether a step was requested whilst the loop was already running,
+        # and so must be run once it returns:
+        self._step_deferred = False
+
+    def call_soon(self, *args, **kwargs):
+        handle = asyncio.SelectorEventLoop.call_soon(self, *args, **kwargs)
+        self._request_step()
+        return handle
+
+    def call_soon_threadsafe(self, *args, **kwargs):
+        handle = asyncio.SelectorEventLoop.call_soon_threadsafe(self, *args, **kwargs)
+        self._request_step()
+        return handle
+
+    def call_at(self, when, *args, **kwargs):
+        handle = asyncio.SelectorEventLoop.call_at(self, when, *args, **kwargs)
+        delay = int(math.ceil(1000 * max(0, when - self.time())))
+        inmain_later(QTimer.singleShot, delay, self._request_step)
+        return handle
+
+    def _request_step(self):
+        # May be called from any thread:
+        with self._step_lock:
+            if self._step_requested:
+                return
+            self._step_requested = True
+        inmain_later(self._step)
+
+    def _step(self):
+        with self._step_lock:
+            self._step_requested = False
+        if self.is_closed():
+            return
+        if self.is_running():
+            # A callback is running a nested Qt event loop, for example because
+            # a state function has opened a modal dialog. Step once it returns:
+            self._step_deferred = True
+            return
+        # Stop once the callbacks that are ready now have run. Any scheduled
+        # whilst running request another step:
+        asyncio.SelectorEventLoop.call_soon(self, self.stop)
+        try:
+            self.run_forever()
+        finally:
+            if self._step_deferred:
+                self._step_deferred = False
+                self._request_step()
+
+
+class TaskHandle(object):
+    """Stands in for a tab's mainloop thread, for code that checks whether a
+    tab's state machine is still running or waits for it to finish"""
+    def __init__(self):
+        self._finished = threading.Event()
+
+    def is_alive(self):
+        return not self._finished.is_set()
+
+    def join(self, timeout=None):
+        # Must not be called from the main thread, which runs the task:
+        self._finished.wait(timeout)
+
+
+class AsyncTabRuntime(object):
+    """Runs the state machines of all tabs as tasks on a single
+    QtDrivenEventLoop in the Qt main thread, instead of in a thread per tab.
+    Waiting for state functions to be queued is done without blocking, and
+    state functions are called directly rather than with inmain(). Messages
+    from workers are waited for by watching their sockets with
+    QSocketNotifiers, so no thread is used whilst waiting. Starting a worker
+    process blocks whilst it starts up, so is done in the loop's default
+    executor. State functions and the define_state API are the same as with
+    the threaded runtime."""
+    def __init__(self):
+        self.logger = logging.getLogger('BLACS.tab_async_runtime')
+        self.loop = QtDrivenEventLoop()
+
+    def start(self, tab):
+        """Start running the tab's state machine. Must be called from the
+        main thread."""
+        handle = TaskHandle()
+        self.loop.create_task(self._run(tab, handle))
+        return handle
+
+    async def _run(self, tab, handle):
+        machine = tab._state_machine()
+        result = None
+        exception = None
+        try:
+            while True:
+                try:
+                    if exception is None:
+                        operation = machine.send(result)
+                    else:
+                        operation = machine.throw(exception)
+                except StopIteration:
+                    break
+                result = None
+                exception = None
+                try:
+                    result = await self._perform(operation)
+                except Exception as e:
+                    exception = e
+        except Exception:
+            self.logger.exception('Error running state machine of %s' % tab.device_name)
+        finally:
+            handle._finished.set()
+
+    async def _perform(self, operation):
+        """Perform an operation requested by a tab's state machine. See
+        Tab._state_machine() for the operations"""
+        kind = operation[0]
+        if kind == 'get_event':
+            _, event_queue, mode = operation
+            return await self._get_event(event_queue, mode)
+        elif kind == 'call':
+            _, function, args = operation
+            return function(*args)
+        elif kind == 'start_worker':
+            _, worker, args = operation
+            return await self.loop.run_in_executor(None, lambda: worker.start(*args))
+        elif kind == 'get':
+            _, read_queue = operation
+            return await self._get_from_worker(read_queue)
+        raise ValueError(kind)
+
+    async def _get_from_worker(self, read_queue):
+        """The equivalent of read_queue.get(), waiting for a message from a
+        worker without blocking"""
+        while True:
+            try:
+                return read_queue.get(timeout=0)
+            except zprocess.TimeoutError:
+                await self._readable(read_queue.sock)
+
+    async def _readable(self, sock):
+        """Wait until a message can be received from a zmq socket"""
+        future = self.loop.create_future()
+        def check(*args):
+            # The socket's file descriptor only signals that its events may
+            # have changed, so whether a message is waiting must be checked:
+            if not future.done() and sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                future.set_result(None)
+        notifier = QSocketNotifier(sock.getsockopt(zmq.FD), QSocketNotifier.Read)
+        notifier.activated.connect(check)
+        try:
+            # The descriptor is edge triggered, so will not signal again for a
+            # message that arrived before the notifier was created:
+            check()
+            await future
+        finally:
+            notifier.setEnabled(False)
+            notifier.deleteLater()
+
+    async def _get_event(self, event_queue, mode):
+        """The equivalent of StateQueue.get(), waiting for a state function to
+        be queued without blocking"""
+        if event_queue.last_requested_state:
+            raise Exception('You have multiple tasks trying to get from this queue at the same time. I won\'t allow it!')
+        event_queue.last_requested_state = mode
+        try:
+            while True:
+                status, data = event_queue.check_for_next_item(mode)
+                if status:
+                    return data
+                # Both this and StateQueue.put() run in the main thread, so
+                # nothing can be queued between checking and setting the waiter:
+                future = self.loop.create_future()
+                def wake():
+                    if not future.done():
+                        future.set_result(None)
+                event_queue.waiter = wake
+                try:
+                    await future
+                finally:
+                    event_queue.waiter = None
+        finally:
+            event_queue.last_requested_state = None
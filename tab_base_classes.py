@@ -21,6 +21,7 @@ else:
     import pickle
 
 from zprocess import Process
+import zmq
 import time
 import sys
 import threading
@@ -30,17 +31,28 @@ import cgi
 import os
 from types import GeneratorType
 from bisect import insort
+from collections import deque
+import heapq
+import inspect
+import json
+import itertools
+import math
 
 from qtutils.qt.QtCore import *
 from qtutils.qt.QtGui import *
 from qtutils.qt.QtWidgets import *
 
 from qtutils import *
-from qtutils.outputbox import OutputBox
 import qtutils.icons
 
 from labscript_utils.qtwidgets.elide_label import elide_label
 from blacs import BLACS_DIR
+from blacs.worker_host import HostedWorker, co_hostable_name
+from blacs.worker_agent import (RemoteWorker, worker_class_fullname, bind_to_random_port, is_allowed_peer,
+                                 LOCALHOST)
+from blacs.resource_monitor import resource_monitor
+from blacs.buffered_outputbox import BufferedOutputBox
+from blacs.tracing import tracer, monotonic
 
 from labscript_utils import check_version
 
@@ -62,6 +74,469 @@ MODE_MANUAL = 1
 MODE_TRANSITION_TO_BUFFERED = 2
 MODE_TRANSITION_TO_MANUAL = 4
 MODE_BUFFERED = 8  
+
+# The maximum number of times per second that tab state labels, error messages
+# and icons are redrawn:
+STATUS_FRAME_RATE = 30
+
+
+class StatusRenderer(object):
+    """Redraws the state labels, error messages and icons of tabs in the main
+    thread, at most STATUS_FRAME_RATE times a second. Threads changing a tab's
+    state or mode mark the tab as needing a redraw, without waiting for the
+    main thread, and any number of changes to any number of tabs between
+    frames results in one redraw of each changed tab."""
+    LABEL = 1
+    ERROR = 2
+
+    def __init__(self, frame_rate=STATUS_FRAME_RATE):
+        self.interval = 1 / frame_rate
+        self.logger = logging.getLogger('BLACS.status_renderer')
+        # Tab: flags saying what needs redrawing
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._time_of_last_render = 0
+
+    def mark_dirty(self, tab, label=False, error=False):
+        """Schedule redrawing of a tab's state label and/or its error message
+        and icon. May be called from any thread, and does not block."""
+        flags = (self.LABEL if label else 0) | (self.ERROR if error else 0)
+        with self._lock:
+            self._dirty[tab] = self._dirty.get(tab, 0) | flags
+            if self._scheduled:
+                return
+            self._scheduled = True
+        inmain_later(self._schedule_render)
+
+    def _schedule_render(self):
+        delay = max(0, self._time_of_last_render + self.interval - time.time())
+        QTimer.singleShot(int(round(1000 * delay)), self._render)
+
+    def _render(self):
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+            self._scheduled = False
+        self._time_of_last_render = time.time()
+        for tab, flags in dirty.items():
+            # The tab's UI may have been destroyed in the meantime by a restart:
+            if getattr(tab, '_ui', None) is None:
+                continue
+            try:
+                if flags & self.LABEL:
+                    tab._update_state_label()
+                if flags & self.ERROR:
+                    tab._update_error_and_tab_icon()
+            except Exception:
+                self.logger.exception('Error redrawing status of %s' % str(tab))
+
+status_renderer = StatusRenderer()
+
+
+# How long, in seconds, a tab may be busy in one state before it is reported as
+# not responding:
+NOT_RESPONDING_TIMEOUT = 5
+
+
+class TabWatchdog(object):
+    """Checks whether tabs have stopped responding, using a single timer for
+    all tabs. Each tab has at most one deadline, the next time at which its
+    not responding status could change. Deadlines are kept in a min-heap and
+    the timer is only armed for the earliest one, so idle tabs cause no
+    wakeups at all. Superseded deadlines are left in the heap and discarded
+    when they reach the top."""
+    def __init__(self):
+        self.logger = logging.getLogger('BLACS.watchdog')
+        self._heap = []
+        # Tab: its current deadline
+        self._deadlines = {}
+        # Tie-breaker for equal deadlines, since tabs are not orderable:
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        # The deadline the timer is armed for, or None if not armed:
+        self._timer_deadline = None
+        self._timer = None
+
+    def reschedule(self, tab):
+        """Recompute when the tab next needs checking. Should be called
+        whenever anything that affects the tab's not responding status
+        changes. May be called from any thread."""
+        if self._push(tab, tab._next_watchdog_deadline()):
+            inmain_later(self._arm)
+
+    def unwatch(self, tab):
+        with self._lock:
+            self._deadlines.pop(tab, None)
+
+    def _push(self, tab, deadline):
+        # Returns whether the timer needs to be armed sooner:
+        with self._lock:
+            if deadline is None:
+                self._deadlines.pop(tab, None)
+                return False
+            if self._deadlines.get(tab) == deadline:
+                return False
+            self._deadlines[tab] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._counter), tab))
+            if len(self._heap) > 4 * len(self._deadlines) + 16:
+                # Too many superseded entries, rebuild the heap:
+                self._heap = [entry for entry in self._heap if self._deadlines.get(entry[2]) == entry[0]]
+                heapq.heapify(self._heap)
+            if self._timer_deadline is not None and self._timer_deadline <= deadline:
+                return False
+            self._timer_deadline = deadline
+            return True
+
+    def _arm(self):
+        if self._timer is None:
+            self._timer = QTimer()
+            self._timer.setSingleShot(True)
+            self._timer.setTimerType(Qt.PreciseTimer)
+            self._timer.timeout.connect(self._fire)
+        with self._lock:
+            if not self._heap:
+                self._timer_deadline = None
+                self._timer.stop()
+                return
+            deadline = self._heap[0][0]
+            self._timer_deadline = deadline
+        self._timer.start(max(0, int(math.ceil(1000 * (deadline - time.time())))))
+
+    def _fire(self):
+        now = time.time()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, tab = heapq.heappop(self._heap)
+                if self._deadlines.get(tab) == deadline:
+                    del self._deadlines[tab]
+                    due.append(tab)
+        for tab in due:
+            # The tab's UI may have been destroyed in the meantime by a restart:
+            if getattr(tab, '_ui', None) is None:
+                continue
+            try:
+                tab.check_time()
+                self._push(tab, tab._next_watchdog_deadline())
+            except Exception:
+                self.logger.exception('Error checking whether %s is responding' % str(tab))
+        self._arm()
+
+tab_watchdog = TabWatchdog()
+
+
+# Seconds between heartbeats sent by worker processes:
+HEARTBEAT_INTERVAL = 1
+# A worker that sends no heartbeats for this many seconds whilst running a job
+# is not responding, since its process is stopped or a job is holding the GIL,
+# for example whilst writing a large dataset:
+HEARTBEAT_TIMEOUT = 10
+
+
+class WorkerStatus(object):
+    """The most recent heartbeat received from a worker process"""
+    def __init__(self, pid):
+        self.pid = pid
+        self.job = None
+        self.job_number = None
+        self.job_start_time = None
+        self.progress = None
+        self.progress_time = None
+        self.received_time = None
+        # Whether the worker has been reported as hung, until it is no longer:
+        self.hung = False
+
+    def update(self, heartbeat, now):
+        if heartbeat['job_number'] != self.job_number:
+            self.hung = False
+        self.job = heartbeat['job']
+        self.job_number = heartbeat['job_number']
+        self.progress = heartbeat['progress']
+        # Ages rather than times are sent, so that the clocks of the worker
+        # and BLACS need not agree:
+        if self.job is not None:
+            self.job_start_time = now - heartbeat['job_age']
+            self.progress_time = now - heartbeat['progress_age']
+        self.received_time = now
+
+    def hung_reason(self, now, hung_worker_timeout):
+        """Why the worker appears to be hung, or None if it does not. With a
+        hung_worker_timeout, it is hung if it has reported no progress for
+        that long, which is also the case if it has sent no heartbeats.
+        Otherwise it is only noted as not responding if it has sent no
+        heartbeats for HEARTBEAT_TIMEOUT seconds, as it may just be busy."""
+        if self.job is None:
+            return None
+        if hung_worker_timeout is not None:
+            if now - self.progress_time > hung_worker_timeout:
+                return 'no progress reported for %d seconds' % (now - self.progress_time)
+        elif now - self.received_time > HEARTBEAT_TIMEOUT:
+            return 'no heartbeat received for %d seconds' % (now - self.received_time)
+        return None
+
+    def describe(self, now):
+        if self.job is None:
+            return 'idle'
+        description = 'running %s for %d seconds' % (self.job, now - self.job_start_time)
+        if self.progress is not None:
+            description += ', last progress (%s) %d seconds ago' % (self.progress, now - self.progress_time)
+        if now - self.received_time > 2 * HEARTBEAT_INTERVAL:
+            description += ', no heartbeat for %d seconds' % (now - self.received_time)
+        return description
+
+
+class HeartbeatMonitor(object):
+    """Receives heartbeats from the worker processes of all tabs, which report
+    what job each worker is running and when it last reported progress. Runs
+    its own thread so that heartbeats are received even when the main thread
+    is busy. If its tab has a hung_worker_timeout, a worker running a job is
+    hung if it has not reported progress for that long. Otherwise it is only
+    noted as not responding if it has not sent a heartbeat for
+    HEARTBEAT_TIMEOUT seconds. Tabs are told about hung workers in the main
+    thread."""
+    def __init__(self):
+        self.logger = logging.getLogger('BLACS.heartbeat_monitor')
+        self._lock = threading.Lock()
+        # device_name: tab
+        self._tabs = {}
+        # (device_name, worker_name): WorkerStatus
+        self._status = {}
+        self._socket = None
+        self._port = None
+        # The addresses to listen on, and of the hosts whose heartbeats are
+        # accepted, extended if there are workers on other computers (see
+        # worker_agent.get_listen_addresses). Must be set before the port is
+        # first accessed:
+        self.bind_addresses = [LOCALHOST]
+        self.allowed_addresses = set([LOCALHOST])
+
+    @property
+    def port(self):
+        """The port that workers send heartbeats to. The monitor is started
+        the first time this is accessed."""
+        with self._lock:
+            if self._port is None:
+                self._socket = zmq.Context.instance().socket(zmq.PULL)
+                self._socket.setsockopt(zmq.LINGER, 0)
+                self._port = bind_to_random_port(self._socket, self.bind_addresses)
+                self._thread = threading.Thread(target=self.mainloop)
+                self._thread.daemon = True
+                self._thread.start()
+            return self._port
+
+    def register(self, tab):
+        with self._lock:
+            self._tabs[tab.device_name] = tab
+
+    def unregister(self, tab):
+        with self._lock:
+            if self._tabs.get(tab.device_name) is tab:
+                del self._tabs[tab.device_name]
+            for key in list(self._status):
+                if key[0] == tab.device_name:
+                    del self._status[key]
+
+    def describe(self, device_name):
+        """A description of what each of the device's workers is doing"""
+        now = time.time()
+        with self._lock:
+            return ['%s: %s' % (worker_name, status.describe(now))
+                    for (name, worker_name), status in sorted(self._status.items()) if name == device_name]
+
+    def mainloop(self):
+        time_of_last_check = time.time()
+        while True:
+            try:
+                if self._socket.poll(int(1000 * HEARTBEAT_INTERVAL)):
+                    frame = self._socket.recv(copy=False)
+                    if is_allowed_peer(frame, self.allowed_addresses):
+                        self.receive(frame)
+                    else:
+                        self.logger.warning('Ignoring heartbeat from a host that is not running workers')
+                now = time.time()
+                if now - time_of_last_check >= HEARTBEAT_INTERVAL:
+                    time_of_last_check = now
+                    self.check(now)
+            except Exception:
+                self.logger.exception('Error processing worker heartbeat')
+
+    def receive(self, frame):
+        # JSON, so that nothing received is unpickled:
+        heartbeat = json.loads(frame.bytes.decode('utf8'))
+        now = time.time()
+        key = (heartbeat['device_name'], heartbeat['worker_name'])
+        with self._lock:
+            # Ignore workers of tabs that are closed or restarting:
+            if heartbeat['device_name'] in self._tabs:
+                status = self._status.get(key)
+                # A new process after a restart starts afresh:
+                if status is None or status.pid != heartbeat['pid']:
+                    status = self._status[key] = WorkerStatus(heartbeat['pid'])
+                status.update(heartbeat, now)
+
+    def check(self, now):
+        hung = []
+        with self._lock:
+            for (device_name, worker_name), status in self._status.items():
+                tab = self._tabs.get(device_name)
+                if tab is None:
+                    continue
+                reason = status.hung_reason(now, tab.hung_worker_timeout)
+                if reason is None:
+                    # Heartbeats or progress may resume within the same job:
+                    if status.hung:
+                        self.logger.info('Worker %s.%s is responding again' % (device_name, worker_name))
+                    status.hung = False
+                elif not status.hung:
+                    status.hung = True
+                    hung.append((tab, worker_name, status.job, reason))
+        for tab, worker_name, job, reason in hung:
+            inmain_later(tab._worker_hung, worker_name, job, reason)
+
+heartbeat_monitor = HeartbeatMonitor()
+
+
+# The number of distinct error messages each tab retains:
+ERROR_LOG_LENGTH = 100
+
+
+def _format_time(t, format='%a %b %d, %H:%M:%S'):
+    formatted = time.strftime(format, time.localtime(t))
+    if PY2:
+        formatted = formatted.decode('utf-8')
+    return formatted
+
+
+def _accepts_keyword(function, name):
+    """Return whether function can be called with the keyword argument name,
+    or False if this cannot be determined"""
+    try:
+        if PY2:
+            spec = inspect.getargspec(function)
+            return name in spec.args or spec.keywords is not None
+        parameters = inspect.signature(function).parameters
+    except (TypeError, ValueError):
+        return False
+    return name in parameters or any(parameter.kind == parameter.VAR_KEYWORD
+                                     for parameter in parameters.values())
+
+
+class ErrorRecord(object):
+    """An error shown in a tab, which may have occurred several times"""
+    def __init__(self, seq, title, message, html=None):
+        self.seq = seq
+        self.title = title
+        self.message = message
+        # Preformatted HTML, for messages added as HTML through
+        # Tab.error_message rather than with Tab.add_error():
+        self.html = html
+        self.first_time = self.last_time = time.time()
+        self.count = 1
+
+    @property
+    def key(self):
+        return (self.title, self.message, self.html)
+
+    def to_html(self):
+        if self.html is not None:
+            html = self.html
+        else:
+            now = _format_time(self.first_time)
+            html = ('%s - %s:<br />' % (cgi.escape(self.title), now) +
+                    '<FONT COLOR=\'#ff0000\'>%s</FONT><br />'%cgi.escape(self.message).replace(' ','&nbsp;').replace('\n','<br />'))
+        if self.count > 1:
+            last = _format_time(self.last_time)
+            html += '<i>(occurred %d times, most recently %s)</i><br />' % (self.count, last)
+        return html
+
+    def to_text(self):
+        first = _format_time(self.first_time, '%Y-%m-%d %H:%M:%S')
+        last = _format_time(self.last_time, '%Y-%m-%d %H:%M:%S')
+        text = self.message if self.html is None else self.html
+        return '%s - %s (occurred %d times, most recently %s):\n%s\n' % (self.title or 'Error', first, self.count, last, text)
+
+
+class ErrorLog(object):
+    """The errors of a tab, kept in a ring buffer of at most ERROR_LOG_LENGTH
+    records. A message identical to one already in the log increments its
+    count rather than adding a new record. Errors can be dismissed, which
+    hides them from display but keeps them in the log for export. Keeps track
+    of whether the displayed log has only had records appended since it was
+    last rendered, so that it can be rendered incrementally."""
+    def __init__(self, maxlen=ERROR_LOG_LENGTH):
+        self.records = deque(maxlen=maxlen)
+        self._by_key = {}
+        self._lock = threading.Lock()
+        self._next_seq = 0
+        # Records with seq lower than this have been dismissed:
+        self._visible_from = 0
+        self._needs_full_render = True
+        self._appended = []
+
+    def add(self, title, message, html=None):
+        with self._lock:
+            record = ErrorRecord(self._next_seq, title, message, html)
+            existing = self._by_key.get(record.key)
+            if existing is not None and existing.seq >= self._visible_from:
+                existing.count += 1
+                existing.last_time = record.last_time
+                self._needs_full_render = True
+                return
+            self._next_seq += 1
+            if len(self.records) == self.records.maxlen:
+                evicted = self.records.popleft()
+                if self._by_key.get(evicted.key) is evicted:
+                    del self._by_key[evicted.key]
+                if evicted.seq >= self._visible_from:
+                    self._needs_full_render = True
+            self.records.append(record)
+            self._by_key[record.key] = record
+            self._appended.append(record)
+
+    def dismiss(self):
+        with self._lock:
+            self._visible_from = self._next_seq
+            self._needs_full_render = True
+            self._appended = []
+
+    def _visible(self):
+        return [record for record in self.records if record.seq >= self._visible_from]
+
+    def __bool__(self):
+        with self._lock:
+            return bool(self.records) and self.records[-1].seq >= self._visible_from
+
+    __nonzero__ = __bool__
+
+    def to_html(self):
+        with self._lock:
+            return ''.join(record.to_html() for record in self._visible())
+
+    def to_text(self):
+        """All records, including dismissed ones, as plain text"""
+        with self._lock:
+            return '\n'.join(record.to_text() for record in self.records)
+
+    def take_changes(self):
+        """Return (full, html), where full is whether the log must be
+        rendered from scratch, in which case html is the whole log, otherwise
+        html is the records appended since the last call"""
+        with self._lock:
+            if self._needs_full_render:
+                html = ''.join(record.to_html() for record in self._visible())
+                full = True
+            else:
+                html = ''.join(record.to_html() for record in self._appended)
+                full = False
+            self._needs_full_render = False
+            self._appended = []
+            return full, html
+
+    def force_full_render(self):
+        with self._lock:
+            self._needs_full_render = True
+
             
 class StateQueue(object):
     # NOTE:
@@ -87,6 +562,9 @@ class StateQueue(object):
         self._last_requested_state = None
         # A queue that blocks the get(requested_state) method until an entry in the queue has a state that matches the requested_state
         self.get_blocking_queue = queue.Queue()
+        # Alternatively, a function called in the main thread when such an
+        # entry is added, for getting from the queue without blocking:
+        self.waiter = None
 
     @property
     @inmain_decorator(True)    
@@ -118,6 +596,8 @@ class StateQueue(object):
         # if this state is one the get command is waiting for, notify it!
         if self.last_requested_state is not None and allowed_states&self.last_requested_state:
             self.get_blocking_queue.put('new item')
+            if self.waiter is not None:
+                self.waiter()
         
         if self.logging_enabled:
             if not isinstance(data[0],str):
@@ -202,6 +682,16 @@ class StateQueue(object):
                 return data
 
 
+# The runtime running the state machines of tabs, if not a thread per tab:
+tab_runtime = None
+
+def set_tab_runtime(runtime):
+    """Set the runtime to run the state machines of tabs created from now on.
+    It must have a start(tab) method, which runs tab._state_machine() and
+    returns an object with is_alive() and join() methods like a thread."""
+    global tab_runtime
+    tab_runtime = runtime
+
 # A counter for uniqely numbering timeouts and numbering queued states monotinically,
 # such that sort order coresponds to the order the state was added to the queue:
 get_unique_id = Counter().get
@@ -244,16 +734,13 @@ class Tab(object):
         self.logger = logging.getLogger('BLACS.%s'%(self.device_name))   
         self.logger.debug('Started')          
         
-        # Setup the timer for updating that tab text label when the tab is not 
-        # actively part of a notebook
-        self._tab_icon_and_colour_timer = QTimer()
-        self._tab_icon_and_colour_timer.timeout.connect(self.set_tab_icon_and_colour)
         self._tab_icon = self.ICON_OK
         self._tab_text_colour = 'black'
 
         # Create instance variables
         self._not_responding_error_message = ''
-        self._error = ''
+        self._rendered_not_responding_error_message = None
+        self._error_log = ErrorLog()
         self._state = ''
         self._time_of_last_state_change = time.time()
         self.not_responding_for = 0
@@ -265,6 +752,9 @@ class Tab(object):
         self.workers = {}
         self._supports_smart_programming = False
         self._restart_receiver = []
+        # If not None, the tab is restarted if a worker does not report
+        # progress for this many seconds during a job:
+        self.hung_worker_timeout = self.settings.get('hung_worker_timeout', None)
         
         # Load the UI
         self._ui = UiLoader().load(os.path.join(BLACS_DIR, 'tab_frame.ui'))
@@ -278,8 +768,15 @@ class Tab(object):
         elide_label(self._ui.device_name, self._ui.horizontalLayout, Qt.ElideRight)
         elide_label(self._ui.state_label, self._ui.state_label_layout, Qt.ElideRight)
 
-        # Insert an OutputBox into the splitter, initially hidden:
-        self._output_box = OutputBox(self._ui.splitter)
+        # Insert an OutputBox into the splitter, initially hidden. Output is
+        # only rendered whilst it is visible, and may otherwise be spilled to a
+        # log file:
+        output_spill_dir = self.settings.get('output_spill_dir')
+        if output_spill_dir is not None:
+            spill_path = os.path.join(output_spill_dir, '%s.log' % self.device_name)
+        else:
+            spill_path = None
+        self._output_box = BufferedOutputBox(self._ui.splitter, spill_path=spill_path)
         self._ui.splitter.setCollapsible(self._ui.splitter.count() - 2, True)
         self._output_box.output_textedit.hide()
 
@@ -290,6 +787,8 @@ class Tab(object):
         self._ui.button_show_terminal.toggled.connect(self.set_terminal_visible)
         self._ui.button_close.clicked.connect(self.hide_error)
         self._ui.button_restart.clicked.connect(self.restart)        
+        self._ui.error_message.setContextMenuPolicy(Qt.CustomContextMenu)
+        self._ui.error_message.customContextMenuRequested.connect(self._on_error_message_context_menu)
         self._update_error_and_tab_icon()
         self.supports_smart_programming(False)
         
@@ -302,15 +801,20 @@ class Tab(object):
         self.mode = MODE_MANUAL
         self.state = 'idle'
         
-        # Setup the not responding timeout
-        self._timeout = QTimer()
-        self._timeout.timeout.connect(self.check_time)
-        self._timeout.start(1000)
+        # Register with the not responding watchdog, heartbeat monitor and
+        # resource monitor
+        tab_watchdog.reschedule(self)
+        heartbeat_monitor.register(self)
+        self._ui.resource_label.hide()
+        resource_monitor.register(self)
                 
         # Launch the mainloop
-        self._mainloop_thread = threading.Thread(target = self.mainloop)
-        self._mainloop_thread.daemon = True
-        self._mainloop_thread.start()
+        if tab_runtime is not None:
+            self._mainloop_thread = tab_runtime.start(self)
+        else:
+            self._mainloop_thread = threading.Thread(target = self.mainloop)
+            self._mainloop_thread.daemon = True
+            self._mainloop_thread.start()
                 
         # Add the tab to the notebook
         self.notebook.addTab(self._ui,self.device_name)
@@ -362,31 +866,77 @@ class Tab(object):
         self._ui.button_clear_smart_programming.setEnabled(not bool(value))
     
     @property
-    @inmain_decorator(True)
     def error_message(self):
-        return self._error
+        """The displayed errors as HTML. Errors should be added with
+        add_error(), but for compatibility, HTML appended to this with +=
+        is added to the log as a new error, and setting it to '' dismisses
+        all errors."""
+        return self._error_log.to_html()
     
     @error_message.setter
-    @inmain_decorator(True)
     def error_message(self,message):
-        #print message
-        #print self._error
-        if message != self._error:
-            self._error = message
-            self._update_error_and_tab_icon()
-    
+        current = self._error_log.to_html()
+        if message == current:
+            return
+        if not message:
+            self._error_log.dismiss()
+        elif message.startswith(current):
+            self._error_log.add('', '', html=message[len(current):])
+        else:
+            self._error_log.dismiss()
+            self._error_log.add('', '', html=message)
+        status_renderer.mark_dirty(self, error=True)
+
+    def add_error(self, title, message):
+        """Add an error to the tab's error log and display it. May be called
+        from any thread"""
+        self._error_log.add(title, message)
+        status_renderer.mark_dirty(self, error=True)
+
+    def export_error_log(self, filepath):
+        """Write all errors in the log, including dismissed ones, to a text
+        file"""
+        with open(filepath, 'w') as f:
+            f.write(self._error_log.to_text())
+
+    def _on_error_message_context_menu(self, position):
+        menu = self._ui.error_message.createStandardContextMenu()
+        menu.addSeparator()
+        export_action = menu.addAction('Export error log...')
+        if menu.exec_(self._ui.error_message.mapToGlobal(position)) is export_action:
+            filepath = QFileDialog.getSaveFileName(self._ui, 'Export error log',
+                                                   '%s_errors.txt' % self.device_name,
+                                                   'Text files (*.txt)')
+            if isinstance(filepath, tuple):
+                filepath, _ = filepath
+            if filepath:
+                try:
+                    self.export_error_log(filepath)
+                except Exception:
+                    self.logger.exception('Could not export error log')
+
     @inmain_decorator(True)
     def _update_error_and_tab_icon(self):
         """Udate and show the error message for the tab, and update the icon
         and text colour on the tab"""
         prefix = '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.0//EN" "http://www.w3.org/TR/REC-html40/strict.dtd">\n<html><head><meta name="qrichtext" content="1" /><style type="text/css">\np, li { white-space: pre-wrap; }\n</style></head><body style=" font-family:"MS Shell Dlg 2"; font-size:7.8pt; font-weight:400; font-style:normal;">'
         suffix = '</body></html>'
-        #print threading.current_thread().name
-        self._ui.error_message.setHtml(prefix+self._not_responding_error_message+self._error+suffix)
-        if self._error or self._not_responding_error_message:
+        if self._not_responding_error_message != self._rendered_not_responding_error_message:
+            self._error_log.force_full_render()
+            self._rendered_not_responding_error_message = self._not_responding_error_message
+        full, html = self._error_log.take_changes()
+        if full:
+            self._ui.error_message.setHtml(prefix+self._not_responding_error_message+html+suffix)
+        elif html:
+            # Only errors have been added, append them:
+            cursor = QTextCursor(self._ui.error_message.document())
+            cursor.movePosition(QTextCursor.End)
+            cursor.insertHtml(html)
+        has_error = bool(self._error_log)
+        if has_error or self._not_responding_error_message:
             self._ui.notresponding.show()
             self._tab_text_colour = 'red'
-            if self.error_message:
+            if has_error:
                 if self.state == 'fatal error':
                     self._tab_icon = self.ICON_FATAL_ERROR
                 else: 
@@ -430,8 +980,10 @@ class Tab(object):
     
     @mode.setter
     def mode(self,mode):
+        if mode not in (MODE_MANUAL, MODE_TRANSITION_TO_BUFFERED, MODE_TRANSITION_TO_MANUAL, MODE_BUFFERED):
+            raise RuntimeError('self.mode for device %s is invalid. It must be one of MODE_MANUAL, MODE_TRANSITION_TO_BUFFERED, MODE_TRANSITION_TO_MANUAL or MODE_BUFFERED'%(self.device_name))
         self._mode = mode
-        self._update_state_label()
+        status_renderer.mark_dirty(self, label=True)
         
     @property
     def state(self):
@@ -441,8 +993,9 @@ class Tab(object):
     def state(self,state):
         self._state = state        
         self._time_of_last_state_change = time.time()
-        self._update_state_label()
-        self._update_error_and_tab_icon()
+        # Redrawn later in the main thread, so as not to hold up the caller:
+        status_renderer.mark_dirty(self, label=True, error=True)
+        tab_watchdog.reschedule(self)
     
     @inmain_decorator(True)
     def _update_state_label(self):
@@ -467,8 +1020,8 @@ class Tab(object):
         useful if the worker class is in a separate file with global imports or other
         import-time behaviour that is undesirable to have run in the main process, for
         example if the imports may not be available to the main process (as may be the
-        case once remote worker processes are implemented and the worker may be on a
-        separate computer). The worker process will not be started immediately, it will
+        case for remote worker processes, where the worker is on a separate computer, see
+        worker_agent.py). The worker process will not be started immediately, it will
         be started once the state machine mainloop begins running. This way errors in
         startup will be handled using the normal state machine machinery."""
         if name in self.workers:
@@ -478,7 +1031,24 @@ class Tab(object):
             # not in a worker process named GUI
             raise Exception('You cannot call a worker process "GUI". Why would you want to? Your worker process cannot interact with the BLACS GUI directly, so you are just trying to confuse yourself!')
         
-        if isinstance(WorkerClass, type):
+        if self.settings.get('remote_worker_agent', None) is not None:
+            # Run the worker on another computer, by a worker agent there:
+            agent_host, agent_port = self.settings['remote_worker_agent']
+            worker = RemoteWorker(
+                worker_class_fullname(WorkerClass),
+                agent_host,
+                agent_port,
+                startup_timeout=30
+                )
+        elif self.settings.get('co_host_workers', False) and co_hostable_name(WorkerClass) is not None:
+            # Run the worker in a process shared with other devices' workers,
+            # or in its own process if it turns out not to be co-hostable:
+            worker = HostedWorker(
+                co_hostable_name(WorkerClass),
+                output_redirection_port=self._output_box.port,
+                startup_timeout=30
+                )
+        elif isinstance(WorkerClass, type):
             worker = WorkerClass(
                 output_redirection_port=self._output_box.port,
                 startup_timeout=30
@@ -497,6 +1067,16 @@ class Tab(object):
         self.workers[name] = (worker,None,None)
         self.event_queue.put(MODE_MANUAL|MODE_BUFFERED|MODE_TRANSITION_TO_BUFFERED|MODE_TRANSITION_TO_MANUAL,True,False,[Tab._initialise_worker,[(name, workerargs),{}]], priority=-1)
        
+    def get_worker_pids(self):
+        """The process ids of the tab's worker processes that have been
+        started and are on this computer, by worker name"""
+        pids = {}
+        for name, (worker, _, _) in list(self.workers.items()):
+            pid = getattr(worker.child, 'pid', None)
+            if pid is not None:
+                pids[name] = pid
+        return pids
+
     def _initialise_worker(self, worker_name, workerargs):
         yield (self.queue_work(worker_name, 'init', worker_name, self.device_name, workerargs))
         if self.error_message:
@@ -553,7 +1133,9 @@ class Tab(object):
     
     def close_tab(self,*args):
         self.logger.info('close_tab called')
-        self._timeout.stop()
+        tab_watchdog.unwatch(self)
+        heartbeat_monitor.unregister(self)
+        resource_monitor.unregister(self)
         for worker, to_worker, from_worker in self.workers.values():
             if worker.child is None:
                 # Worker was not started, it doesn't need to be terminated.
@@ -586,11 +1168,19 @@ class Tab(object):
         if function in self._restart_receiver:
             self._restart_receiver.remove(function)
     
-    def restart(self,*args):
+    def restart(self,*args,**kwargs):
+        # automatic=True means the restart was not requested by the user, and
+        # receivers may retry whatever the tab was doing. Only receivers that
+        # take an 'automatic' argument are told, others are notified as for
+        # any other restart:
+        automatic = kwargs.pop('automatic', False)
         # notify all connected receivers:
         for f in self._restart_receiver:
             try:
-                f(self.device_name)
+                if automatic and _accepts_keyword(f, 'automatic'):
+                    f(self.device_name, automatic=True)
+                else:
+                    f(self.device_name)
             except:
                 self.logger.exception('Could not notify a connected receiver function')
                 
@@ -650,16 +1240,58 @@ class Tab(object):
         self.error_message = ''
         self._tab_text_colour = 'black'
         self.set_tab_icon_and_colour()
-            
+        tab_watchdog.reschedule(self)
+
+    def _worker_hung(self, worker_name, job, reason):
+        # The tab may be partway through a restart:
+        if self._ui is None:
+            return
+        if self.hung_worker_timeout is not None:
+            # Not shown in the tab, since restarting clears its errors, and
+            # an error would make the queue manager pause the queue rather
+            # than requeue the shot:
+            self.logger.error('Worker %s appears to be hung running %s: %s. Restarting tab automatically.' %
+                              (worker_name, job, reason))
+            self.restart(automatic=True)
+        else:
+            # It may just be busy, so this is not an error. Whilst the tab is
+            # not responding, what the worker is doing is shown in the tab:
+            self.logger.warning('Worker %s is not responding whilst running %s: %s.' % (worker_name, job, reason))
+
+    def _next_watchdog_deadline(self):
+        """The time at which check_time() next needs to be called, or None if
+        the tab's not responding status cannot change without its state
+        changing first"""
+        if self.state in ['idle','fatal error']:
+            if self._not_responding_error_message:
+                # Needs clearing:
+                return time.time()
+            return None
+        start = self._time_of_last_state_change
+        threshold = start + NOT_RESPONDING_TIMEOUT + self.hide_not_responding_error_until
+        now = time.time()
+        if now <= threshold:
+            return threshold
+        # Already not responding, check again when the displayed duration
+        # next changes:
+        elapsed = now - start
+        if elapsed < 60:
+            unit = 1
+        elif elapsed < 3600:
+            unit = 60
+        else:
+            unit = 3600
+        return start + (elapsed // unit + 1) * unit
+
     def check_time(self):
         if self.state in ['idle','fatal error']:
             self.not_responding_for = 0
             if self._not_responding_error_message:
                 self._not_responding_error_message = ''
-                self._update_error_and_tab_icon()
+                status_renderer.mark_dirty(self, error=True)
         else:
             self.not_responding_for = time.time() - self._time_of_last_state_change
-        if self.not_responding_for > 5 + self.hide_not_responding_error_until:
+        if self.not_responding_for > NOT_RESPONDING_TIMEOUT + self.hide_not_responding_error_until:
             self.hide_not_responding_error_for = 0
             self._ui.notresponding.show()
             hours, remainder = divmod(int(self.not_responding_for), 3600)
@@ -670,44 +1302,105 @@ class Tab(object):
                 s = '%s minutes'%minutes
             else:
                 s = '%s seconds'%seconds
-            self._not_responding_error_message = 'The hardware process has not responded for %s.<br /><br />'%s
-            self._update_error_and_tab_icon()
+            self._not_responding_error_message = 'The hardware process has not responded for %s.<br />'%s
+            for description in heartbeat_monitor.describe(self.device_name):
+                self._not_responding_error_message += 'Worker %s.<br />' % cgi.escape(description)
+            self._not_responding_error_message += '<br />'
+            status_renderer.mark_dirty(self, error=True)
         return True
         
     def mainloop(self):
+        """Run the tab's state machine in the current thread, performing each
+        operation it requests, blocking until it completes"""
+        machine = self._state_machine()
+        result = None
+        exc_info = None
+        while True:
+            try:
+                if exc_info is None:
+                    operation = machine.send(result)
+                elif PY2:
+                    operation = machine.throw(*exc_info)
+                else:
+                    operation = machine.throw(exc_info[1])
+            except StopIteration:
+                break
+            result = None
+            exc_info = None
+            try:
+                result = self._perform_blocking(operation)
+            except Exception:
+                exc_info = sys.exc_info()
+
+    def _perform_blocking(self, operation):
+        """Perform an operation requested by the state machine. See
+        _state_machine() for the operations"""
+        kind = operation[0]
+        if kind == 'get_event':
+            _, event_queue, mode = operation
+            return event_queue.get(mode)
+        elif kind == 'call':
+            _, function, args = operation
+            return inmain(function, *args)
+        elif kind == 'start_worker':
+            _, worker, args = operation
+            return worker.start(*args)
+        elif kind == 'get':
+            _, read_queue = operation
+            return read_queue.get()
+        raise ValueError(kind)
+
+    def _state_machine(self):
+        """The tab's state machine, as a generator. Rather than blocking, it
+        yields the operations it needs performed, and is sent their results
+        or has their exceptions thrown into it. This way the same state
+        machine can be run by a thread per tab (mainloop()), or on an event
+        loop shared by all tabs (see tab_async_runtime). The operations are:
+            ('get_event', event_queue, mode): get the next state function
+                allowed in mode from the StateQueue
+            ('call', function, args): call function(*args) in the main thread
+            ('start_worker', worker, args): start a worker process, returning
+                (to_worker, from_worker)
+            ('get', read_queue): get the next message from a worker"""
         logger = logging.getLogger('BLACS.%s.mainloop'%(self.settings['device_name']))   
         logger.debug('Starting')
         
         # Store a reference to the state queue and workers, this way if the tab is restarted, we won't ever get access to the new state queue created then
         event_queue = self.event_queue
         workers = self.workers
+        # Spans of this tab's state functions and worker jobs are recorded on
+        # a track of their own, whichever thread the state machine runs in:
+        track = tracer.track('%s tab' % self.device_name) if tracer.enabled else None
         
         try:
             while True:
                 # Get the next task from the event queue:
                 logger.debug('Waiting for next event')
-                func, data = event_queue.get(self.mode)
+                func, data = yield ('get_event', event_queue, self.mode)
                 if func == '_quit':
                     # The user has requested a restart:
                     logger.debug('Received quit signal')
                     break
                 args,kwargs = data
                 logger.debug('Processing event %s' % func.__name__)
+                state_start = monotonic()
                 self.state = '%s (GUI)'%func.__name__
                 # Run the task with the GUI lock, catching any exceptions:
                 #func = getattr(self,funcname)
                 # run the function in the Qt main thread
-                generator = inmain(func,self,*args,**kwargs)
+                with tracer.span('%s (GUI)' % func.__name__, 'gui', tid=track):
+                    generator = yield ('call', lambda: func(self,*args,**kwargs), ())
                 # Do any work that was queued up:(we only talk to the worker if work has been queued up through the yield command)
                 if type(generator) == GeneratorType:
                     # We need to call next recursively, queue up work and send the results back until we get a StopIteration exception
                     generator_running = True
                     break_main_loop = False
                     # get the data from the first yield function
-                    if PY2:
-                        worker_process,worker_function,worker_args,worker_kwargs = inmain(generator.next)
-                    else:
-                        worker_process,worker_function,worker_args,worker_kwargs = inmain(generator.__next__)
+                    with tracer.span('%s (GUI)' % func.__name__, 'gui', tid=track):
+                        if PY2:
+                            worker_process,worker_function,worker_args,worker_kwargs = yield ('call', generator.next, ())
+                        else:
+                            worker_process,worker_function,worker_args,worker_kwargs = yield ('call', generator.__next__, ())
                     # Continue until we get a StopIteration exception, or the user requests a restart
                     while generator_running:
                         try:
@@ -716,7 +1409,14 @@ class Tab(object):
                                 # Start the worker process before running its init() method:
                                 self.state = '%s (%s)'%('Starting worker process', worker_process)
                                 worker, _, _ = self.workers[worker_process]
-                                to_worker, from_worker = worker.start(*worker_args)
+                                # Tell the worker where to send heartbeats:
+                                worker_name, device_name, extraargs = worker_args
+                                extraargs = dict(extraargs, _heartbeat_port=heartbeat_monitor.port)
+                                # And where to send trace spans:
+                                if tracer.enabled:
+                                    extraargs['_trace_port'] = tracer.collector_port
+                                with tracer.span('Starting worker %s' % worker_process, 'worker', tid=track):
+                                    to_worker, from_worker = yield ('start_worker', worker, (worker_name, device_name, extraargs))
                                 self.workers[worker_process] = (worker, to_worker, from_worker)
                                 worker_args = ()
                             worker_arg_list = (worker_function,worker_args,worker_kwargs)
@@ -724,16 +1424,17 @@ class Tab(object):
                             try:
                                 pickle.dumps(worker_arg_list)
                             except:
-                                self.error_message += 'Attempt to pass unserialisable object to child process:'
+                                self.add_error('Attempt to pass unserialisable object to child process', traceback.format_exc())
                                 raise
                             # Send the command to the worker
                             to_worker = workers[worker_process][1]
                             from_worker = workers[worker_process][2]
+                            job_sent = monotonic()
                             to_worker.put(worker_arg_list)
                             self.state = '%s (%s)'%(worker_function,worker_process)
                             # Confirm that the worker got the message:
                             logger.debug('Waiting for worker to acknowledge job request')
-                            success, message, results = from_worker.get()
+                            success, message, results = yield ('get', from_worker)
                             if not success:
                                 if message == 'quit':
                                     # The user has requested a restart:
@@ -743,9 +1444,14 @@ class Tab(object):
                                     break
                                 logger.info('Worker reported failure to start job')
                                 raise Exception(message)
+                            job_started = monotonic()
+                            tracer.complete('%s.%s (dispatch)' % (worker_process, worker_function), 'worker',
+                                            job_sent, job_started, tid=track)
                             # Wait for and get the results of the work:
                             logger.debug('Worker reported job started, waiting for completion')
-                            success,message,results = from_worker.get()
+                            success,message,results = yield ('get', from_worker)
+                            tracer.complete('%s.%s' % (worker_process, worker_function), 'worker',
+                                            job_started, monotonic(), {'success': success}, track)
                             if not success and message == 'quit':
                                 # The user has requested a restart:
                                 logger.debug('Received quit signal')
@@ -754,11 +1460,7 @@ class Tab(object):
                                 break
                             if not success:
                                 logger.info('Worker reported exception during job')
-                                now = time.strftime('%a %b %d, %H:%M:%S ',time.localtime())
-                                if PY2:
-                                    now = now.decode('utf-8')
-                                self.error_message += ('Exception in worker - %s:<br />' % now +
-                                               '<FONT COLOR=\'#ff0000\'>%s</FONT><br />'%cgi.escape(message).replace(' ','&nbsp;').replace('\n','<br />'))
+                                self.add_error('Exception in worker', message)
                             else:
                                 logger.debug('Job completed')
                             
@@ -768,7 +1470,8 @@ class Tab(object):
                             # Send the results back to the GUI function
                             logger.debug('returning worker results to function %s' % func.__name__)
                             self.state = '%s (GUI)'%func.__name__
-                            next_yield = inmain(generator.send,results) 
+                            with tracer.span('%s (GUI)' % func.__name__, 'gui', tid=track):
+                                next_yield = yield ('call', generator.send, (results,))
                             # If there is another yield command, put the data in the required variables for the next loop iteration
                             if next_yield:
                                 worker_process,worker_function,worker_args,worker_kwargs = next_yield
@@ -780,45 +1483,105 @@ class Tab(object):
                     if break_main_loop:
                         logger.debug('Breaking out of main loop')
                         break
+                tracer.complete(func.__name__, 'state', state_start, monotonic(), tid=track)
                 self.state = 'idle'
-        except:
+        except Exception:
+            # Not GeneratorExit, raised when the state machine is closed:
             # Some unhandled error happened. Inform the user, and give the option to restart
             message = traceback.format_exc()
             logger.critical('A fatal exception happened:\n %s'%message)
-            now = time.strftime('%a %b %d, %H:%M:%S ',time.localtime())
-            if PY2:
-                now = now.decode('utf-8')
-            self.error_message += ('Fatal exception in main process - %s:<br /> '%now +
-                           '<FONT COLOR=\'#ff0000\'>%s</FONT><br />'%cgi.escape(message).replace(' ','&nbsp;').replace('\n','<br />'))
+            self.add_error('Fatal exception in main process', message)
                             
             self.state = 'fatal error'
             # do this in the main thread
-            inmain(self._ui.button_close.setEnabled,False)
+            yield ('call', self._ui.button_close.setEnabled, (False,))
         logger.info('Exiting')
         
         
 class Worker(Process):
+    # Subclasses may set this to True if they can share a process with the
+    # workers of other devices (see worker_host.py). They must then not rely
+    # on process-wide state, such as global variables, the working directory
+    # or signal handlers, and their output is not shown in their tab.
+    co_hostable = False
+
     def init(self):
         # To be overridden by subclasses
         pass
     
     def run(self, worker_name, device_name, extraargs):
-        self.worker_name = worker_name
-        self.device_name = device_name
-        for argname in extraargs:
-            setattr(self,argname,extraargs[argname])
         from labscript_utils.setup_logging import setup_logging
         setup_logging('BLACS')
-        log_name = 'BLACS.%s_%s.worker'%(self.device_name,self.worker_name)
-        self.logger = logging.getLogger(log_name)
-        self.logger.debug('Starting')
+        self.setup_worker(worker_name, device_name, extraargs)
         import labscript_utils.excepthook
         labscript_utils.excepthook.set_logger(self.logger)
         import zprocess.locking, labscript_utils.h5_lock
-        zprocess.locking.set_client_process_name(log_name)
+        zprocess.locking.set_client_process_name(self.logger.name)
         #self.init()
         self.mainloop()
 
+    def setup_worker(self, worker_name, device_name, extraargs):
+        """Set the worker's attributes and start its heartbeat. Called in the
+        worker's process before mainloop(), which may be a process shared with
+        other workers"""
+        self.worker_name = worker_name
+        self.device_name = device_name
+        heartbeat_port = extraargs.pop('_heartbeat_port', None)
+        # Only set for workers on a different computer to BLACS:
+        heartbeat_host = extraargs.pop('_heartbeat_host', '127.0.0.1')
+        # Only set if tracing is enabled:
+        trace_port = extraargs.pop('_trace_port', None)
+        for argname in extraargs:
+            setattr(self,argname,extraargs[argname])
+        log_name = 'BLACS.%s_%s.worker'%(self.device_name,self.worker_name)
+        self.logger = logging.getLogger(log_name)
+        self.logger.debug('Starting')
+        # (job, job_number, job_start_time, progress, progress_time), replaced
+        # as a whole so that the heartbeat thread sees a consistent snapshot:
+        self._job_status = (None, 0, None, None, None)
+        if heartbeat_port is not None:
+            self._start_heartbeat(heartbeat_host, heartbeat_port)
+        if trace_port is not None:
+            tracer.connect(heartbeat_host, trace_port)
+            # Co-hosted workers share a process, but each has its own thread:
+            tracer.set_thread_name('%s.%s worker' % (self.device_name, self.worker_name))
+
+    def _start_heartbeat(self, host, port):
+        sock = zmq.Context.instance().socket(zmq.PUSH)
+        sock.setsockopt(zmq.LINGER, 0)
+        # Old heartbeats are of no use, don't queue them up if BLACS is busy:
+        sock.setsockopt(zmq.SNDHWM, 1)
+        sock.connect('tcp://%s:%d' % (host, port))
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, args=(sock,))
+        self._heartbeat_thread.daemon = True
+        self._heartbeat_thread.start()
+
+    def _heartbeat_loop(self, sock):
+        pid = os.getpid()
+        while True:
+            job, job_number, job_start_time, progress, progress_time = self._job_status
+            now = time.time()
+            heartbeat = {'device_name': self.device_name, 'worker_name': self.worker_name, 'pid': pid,
+                         'job': job, 'job_number': job_number, 'progress': progress,
+                         'job_age': None if job is None else now - job_start_time,
+                         'progress_age': None if job is None else now - progress_time}
+            try:
+                # Progress may be any object, and is only shown as a string:
+                sock.send_json(heartbeat, flags=zmq.NOBLOCK, default=str)
+            except zmq.Again:
+                pass
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def report_progress(self, progress=None):
+        """Tell BLACS that the current job is making progress, so that it is
+        not considered hung. Long running jobs, for example ones writing large
+        datasets, should call this periodically. progress, if given, is shown
+        in the tab if it is not responding, and should be short, for example
+        a string or a fraction complete."""
+        job, job_number, job_start_time, _, _ = self._job_status
+        if job is not None:
+            self._job_status = (job, job_number, job_start_time, progress, time.time())
+
     def mainloop(self):
         while True:
             # Get the next task to be done:
@@ -839,6 +1602,9 @@ class Worker(Process):
             if success:
                 # Try to do the requested work:
                 self.logger.debug('Starting job %s'%funcname)
+                now = time.time()
+                self._job_status = (funcname, self._job_status[1] + 1, now, None, now)
+                job_start = monotonic()
                 try:
                     results = func(*args,**kwargs)
                     success = True
@@ -851,6 +1617,9 @@ class Worker(Process):
                     del traceback_lines[1]
                     message = ''.join(traceback_lines)
                     self.logger.error('Exception in job:\n%s'%message)
+                finally:
+                    self._job_status = (None,) + self._job_status[1:]
+                    tracer.complete(funcname, 'job', job_start, monotonic())
                 # Check if results object is serialisable:
                 try:
                     pickle.dumps(results)
@@ -863,6 +1632,8 @@ class Worker(Process):
                 # Report to the parent whether work was successful or not,
                 # and what the results were:
                 self.to_parent.put((success,message,results))
+                # Send the job's span to BLACS now that it is no longer waiting on us:
+                tracer.flush()
 
 
 class PluginTab(object):
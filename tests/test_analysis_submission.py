@@ -0,0 +1,187 @@
+#####################################################################
+#                                                                   #
+# /tests/test_analysis_submission.py                                #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+# Tests of PipelinedSubmitter against a stand-in for lyse's server, run with:
+#     python -m pytest tests
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import pickle
+import threading
+import unittest
+
+import zmq
+
+from blacs.analysis_submission import PipelinedSubmitter, MAX_IN_FLIGHT
+
+HOST = '127.0.0.1'
+# How long the stand-in waits for more requests before replying to those it
+# has, in milliseconds:
+QUIET_PERIOD = 100
+
+
+def accept_all(request):
+    if request == 'hello':
+        return 'hello'
+    return 'added successfully'
+
+
+class StandInLyse(object):
+    """A stand-in for lyse's REP server. It uses a ROUTER socket, so that it
+    can hold on to requests rather than replying to each in turn. Requests are
+    replied to, in order, once MAX_IN_FLIGHT of them are waiting or once no
+    more arrive within QUIET_PERIOD, so the number waiting shows how many
+    requests the submitter has in flight. handler(request) returns the
+    response to each request, or None to never reply, as if lyse had gone
+    away."""
+    def __init__(self, handler=accept_all, port=None):
+        self.handler = handler
+        self.requests = []
+        self.max_outstanding = 0
+        self.context = zmq.Context.instance()
+        self.sock = self.context.socket(zmq.ROUTER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        if port is None:
+            self.port = self.sock.bind_to_random_port('tcp://%s' % HOST)
+        else:
+            self.port = port
+            self.sock.bind('tcp://%s:%d' % (HOST, port))
+        self._stopping = threading.Event()
+        self.mainloop_thread = threading.Thread(target=self.mainloop)
+        self.mainloop_thread.daemon = True
+        self.mainloop_thread.start()
+
+    def mainloop(self):
+        waiting = []
+        while not self._stopping.is_set():
+            if self.sock.poll(QUIET_PERIOD):
+                identity, delimiter, data = self.sock.recv_multipart()
+                request = pickle.loads(data)
+                self.requests.append(request)
+                waiting.append((identity, request))
+                self.max_outstanding = max(self.max_outstanding, len(waiting))
+                if len(waiting) < MAX_IN_FLIGHT:
+                    continue
+            for identity, request in waiting:
+                response = self.handler(request)
+                if response is None:
+                    continue
+                self.sock.send_multipart([identity, b'', pickle.dumps(response, protocol=2)])
+            waiting = []
+        self.sock.close()
+
+    def close(self):
+        self._stopping.set()
+        self.mainloop_thread.join()
+
+
+class PipelinedSubmitterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+        self.submitter = None
+
+    def tearDown(self):
+        if self.submitter is not None:
+            self.submitter.reset()
+        for server in self.servers:
+            server.close()
+
+    def start_server(self, *args, **kwargs):
+        server = StandInLyse(*args, **kwargs)
+        self.servers.append(server)
+        return server
+
+    def submit(self, requests):
+        """Submit the requests, returning whether all succeeded and the
+        (request, response) pairs on_response was called with"""
+        responses = []
+        def on_response(request, response):
+            responses.append((request, response))
+            return response == 'added successfully'
+        return self.submitter.submit(HOST, requests, on_response), responses
+
+    def test_hello(self):
+        server = self.start_server()
+        self.submitter = PipelinedSubmitter(server.port)
+        self.assertEqual(self.submitter.request(HOST, 'hello'), 'hello')
+
+    def test_pipelined_in_order(self):
+        server = self.start_server()
+        self.submitter = PipelinedSubmitter(server.port)
+        requests = [{'filepath': 'shot_%d.h5' % i} for i in range(3 * MAX_IN_FLIGHT + 5)]
+        success, responses = self.submit(requests)
+        self.assertTrue(success)
+        # Every request was acknowledged, in order:
+        self.assertEqual(responses, [(request, 'added successfully') for request in requests])
+        self.assertEqual(server.requests, requests)
+        # Requests were pipelined, with no more than MAX_IN_FLIGHT in flight:
+        self.assertEqual(server.max_outstanding, MAX_IN_FLIGHT)
+
+    def test_fewer_than_max_in_flight(self):
+        server = self.start_server()
+        self.submitter = PipelinedSubmitter(server.port)
+        requests = [{'filepath': 'shot_%d.h5' % i} for i in range(3)]
+        success, responses = self.submit(requests)
+        self.assertTrue(success)
+        self.assertEqual([request for request, response in responses], requests)
+        self.assertEqual(server.max_outstanding, 3)
+
+    def test_failure_response_stops_submission(self):
+        failing = {'filepath': 'shot_5.h5'}
+        def handler(request):
+            if request == failing:
+                return 'error: could not add shot'
+            return 'added successfully'
+        server = self.start_server(handler)
+        self.submitter = PipelinedSubmitter(server.port)
+        requests = [{'filepath': 'shot_%d.h5' % i} for i in range(10)]
+        success, responses = self.submit(requests)
+        self.assertFalse(success)
+        # on_response was called up to and including the failure, and not
+        # for any later request, even if it was sent and answered:
+        self.assertEqual([request for request, response in responses], requests[:6])
+        self.assertEqual(responses[-1], (failing, 'error: could not add shot'))
+        # The connection was reset, so late responses are discarded:
+        self.assertIsNone(self.submitter.sock)
+
+    def test_resubmission_after_server_goes_away(self):
+        delivered = 2 * MAX_IN_FLIGHT
+        requests = [{'filepath': 'shot_%d.h5' % i} for i in range(3 * MAX_IN_FLIGHT)]
+        # Stops replying part way through, as if lyse had been closed:
+        def handler(request):
+            if requests.index(request) < delivered:
+                return 'added successfully'
+            return None
+        server = self.start_server(handler)
+        self.submitter = PipelinedSubmitter(server.port, timeout=0.5)
+        success, responses = self.submit(requests)
+        self.assertFalse(success)
+        self.assertEqual([request for request, response in responses], requests[:delivered])
+        self.assertIsNone(self.submitter.sock)
+
+        # Submission fails whilst nothing is listening:
+        server.close()
+        self.servers.remove(server)
+        unacknowledged = requests[delivered:]
+        success, responses = self.submit(unacknowledged)
+        self.assertFalse(success)
+        self.assertEqual(responses, [])
+
+        # lyse comes back on the same port. The unacknowledged requests are
+        # resent and acknowledged, in order:
+        server = self.start_server(port=server.port)
+        success, responses = self.submit(unacknowledged)
+        self.assertTrue(success)
+        self.assertEqual([request for request, response in responses], unacknowledged)
+        self.assertEqual(server.requests, unacknowledged)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#####################################################################
+#                                                                   #
+# /tests/test_front_panel_settings.py                               #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+# Tests of the tagged JSON that BLACS save data is stored as, run with:
+#     python -m pytest tests
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import json
+import unittest
+
+import numpy
+
+from blacs.front_panel_settings import serialise, deserialise
+
+
+class TaggedJSONTests(unittest.TestCase):
+
+    def round_trip(self, obj):
+        data = serialise(obj)
+        # Always valid JSON, readable without BLACS:
+        json.loads(data)
+        return deserialise(data)
+
+    def assertArrayEqual(self, result, expected):
+        self.assertIsInstance(result, numpy.ndarray)
+        self.assertEqual(result.dtype, expected.dtype)
+        self.assertEqual(result.shape, expected.shape)
+        self.assertTrue((result == expected).all())
+
+    def test_plain(self):
+        for obj in [None, True, 0, -7, 2.5, '', 'text', '\u00fcn\u00efcode', [], [1, 'a', None], {}, {'a': 1, 'b': [2.5]}]:
+            self.assertEqual(self.round_trip(obj), obj)
+
+    def test_tuples_and_sets(self):
+        obj = [(1, 2), set([3, 4]), frozenset([5]), ()]
+        self.assertEqual(self.round_trip(obj), [(1, 2), set([3, 4]), set([5]), ()])
+        self.assertIsInstance(self.round_trip((1, [2])), tuple)
+
+    def test_non_string_keys(self):
+        obj = {1: 'a', 2.5: 'b', (1, 'c'): 'd', None: 'e', frozenset([1]): 'f'}
+        self.assertEqual(self.round_trip(obj), obj)
+
+    def test_dicts_that_look_tagged(self):
+        for obj in [{'__tuple__': [1, 2]}, {'__bytes__': 'YQ=='}, {'__repr__': 'os.system("")'},
+                    {'__ndarray__': [1], 'dtype': '<f8'}]:
+            self.assertEqual(self.round_trip(obj), obj)
+
+    def test_bytes(self):
+        obj = [b'', b'abc', b'\x00\xff\x80', {b'key': b'value'}]
+        self.assertEqual(self.round_trip(obj), obj)
+
+    def test_arrays(self):
+        for array in [numpy.arange(5.0), numpy.zeros((2, 3), dtype=numpy.int16), numpy.array([True, False]),
+                      numpy.array(['ab', 'c']), numpy.array([b'ab', b'c'])]:
+            self.assertArrayEqual(self.round_trip(array), array)
+
+    def test_structured_arrays(self):
+        structured = numpy.array([(1, 2.5, b'ab', [1, 2, 3]), (3, 4.5, b'c', [4, 5, 6])],
+                                 dtype=[('a', '<i4'), ('b', '<f8'), ('c', 'S3'), ('d', '<i2', (3,))])
+        self.assertArrayEqual(self.round_trip(structured), structured)
+        nested = numpy.zeros(2, dtype=[('x', [('y', '<f4'), ('z', 'u1')]), ('w', '<U4')])
+        nested['w'] = ['one', 'two']
+        self.assertArrayEqual(self.round_trip(nested), nested)
+
+    def test_numpy_scalars(self):
+        result = self.round_trip([numpy.float64(2.5), numpy.int32(3), numpy.bool_(True)])
+        self.assertEqual(result, [2.5, 3, True])
+
+    def test_nested(self):
+        array = numpy.array([(1, 2.0)], dtype=[('a', '<i4'), ('b', '<f8')])
+        obj = {'a': [{'b': (1, b'x', {2: set(['y'])})}], 'array': array, 'list': [array, (array,)]}
+        result = self.round_trip(obj)
+        self.assertEqual(result['a'], obj['a'])
+        self.assertArrayEqual(result['array'], array)
+        self.assertArrayEqual(result['list'][0], array)
+        self.assertIsInstance(result['list'][1], tuple)
+        self.assertArrayEqual(result['list'][1][0], array)
+
+    def test_unsupported_types_are_not_evaluated(self):
+        class Unsupported(object):
+            pass
+        self.assertEqual(self.round_trip({'a': Unsupported(), 'b': 1}), {'a': None, 'b': 1})
+
+    def test_version_1(self):
+        self.assertEqual(deserialise(repr({'a': (1, 2)}), format_version=1), {'a': (1, 2)})
+
+
+if __name__ == '__main__':
+    unittest.main()
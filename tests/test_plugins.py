@@ -0,0 +1,275 @@
+#####################################################################
+#                                                                   #
+# /tests/test_plugins.py                                            #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+# Tests of plugin callback dispatch and lazy loading, run with:
+#     python -m pytest tests
+from __future__ import division, unicode_literals, print_function, absolute_import
+
+import threading
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import blacs.plugins
+from blacs.plugins import (CallbackRegistry, CallbackDispatcher, callback, callback_registry, get_manifest,
+                           LazyPluginModule)
+
+# How long to wait for asynchronous callbacks, in seconds:
+TIMEOUT = 5
+
+
+class StandInPlugin(object):
+    def __init__(self, callbacks):
+        self.callbacks = callbacks
+
+    def get_callbacks(self):
+        return self.callbacks
+
+
+class DispatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = CallbackRegistry()
+        self.dispatcher = CallbackDispatcher(self.registry)
+        # (name, path, thread) of each call:
+        self.calls = []
+
+    def recorder(self, name, result=None):
+        def record(path):
+            self.calls.append((name, path, threading.current_thread()))
+            return result
+        return record
+
+    def register(self, plugins):
+        for module_name, plugin in plugins.items():
+            self.registry.plugin_loaded(module_name, plugin)
+
+    def names(self):
+        return [(name, path) for name, path, thread in self.calls]
+
+    def test_priority_order(self):
+        self.register({
+            'b': StandInPlugin({'shot_complete': callback(priority=20)(self.recorder('b'))}),
+            'c': StandInPlugin({'shot_complete': self.recorder('c')}),
+            'a': StandInPlugin({'shot_complete': self.recorder('a')}),
+        })
+        self.dispatcher.dispatch('shot_complete', 'shot.h5')
+        # By priority, then by module name:
+        self.assertEqual(self.names(), [('a', 'shot.h5'), ('c', 'shot.h5'), ('b', 'shot.h5')])
+
+    def test_async_callback_order(self):
+        may_finish = threading.Event()
+        finished = threading.Event()
+        record_start = self.recorder('b start')
+        record_end = self.recorder('b end')
+        @callback(run_async=True)
+        def slow(path):
+            record_start(path)
+            # Does not hold up the callbacks after it:
+            may_finish.wait(TIMEOUT)
+            record_end(path)
+            if path == 'shot_2.h5':
+                finished.set()
+        self.register({
+            'a': StandInPlugin({'shot_complete': self.recorder('a')}),
+            'b': StandInPlugin({'shot_complete': slow}),
+            'c': StandInPlugin({'shot_complete': self.recorder('c')}),
+        })
+        self.dispatcher.dispatch('shot_complete', 'shot_1.h5')
+        self.dispatcher.dispatch('shot_complete', 'shot_2.h5')
+        # The synchronous callbacks have run, in order, without waiting for
+        # the asynchronous one:
+        synchronous = [(name, path) for name, path in self.names() if name in ['a', 'c']]
+        self.assertEqual(synchronous, [('a', 'shot_1.h5'), ('c', 'shot_1.h5'),
+                                       ('a', 'shot_2.h5'), ('c', 'shot_2.h5')])
+        self.assertNotIn(('b end', 'shot_1.h5'), self.names())
+        may_finish.set()
+        self.assertTrue(finished.wait(TIMEOUT))
+        names = self.names()
+        # The asynchronous callback was started after the synchronous
+        # callbacks before it, and ran in its own thread, once per event, in
+        # the order the events were dispatched:
+        self.assertLess(names.index(('a', 'shot_1.h5')), names.index(('b start', 'shot_1.h5')))
+        self.assertLess(names.index(('a', 'shot_2.h5')), names.index(('b start', 'shot_2.h5')))
+        self.assertEqual([(name, path) for name, path in names if name.startswith('b')],
+                         [('b start', 'shot_1.h5'), ('b end', 'shot_1.h5'),
+                          ('b start', 'shot_2.h5'), ('b end', 'shot_2.h5')])
+        main_thread = threading.current_thread()
+        for name, path, thread in self.calls:
+            self.assertEqual(thread is main_thread, not name.startswith('b'))
+
+    def test_filters_are_synchronous(self):
+        self.register({
+            'a': StandInPlugin({'shot_ignore_repeat': callback(run_async=True)(self.recorder('a', True))}),
+            'b': StandInPlugin({'shot_ignore_repeat': self.recorder('b')}),
+        })
+        # run_async is ignored for events whose return values are used:
+        self.assertTrue(self.dispatcher.run_filters('shot_ignore_repeat', 'shot.h5'))
+        self.assertEqual(self.names(), [('a', 'shot.h5')])
+        self.assertIs(self.calls[0][2], threading.current_thread())
+
+    def test_loading_and_unloading(self):
+        # Nothing is registered until plugins are loaded:
+        self.dispatcher.dispatch('shot_complete', 'shot_1.h5')
+        self.registry.plugin_loaded('a', StandInPlugin({'shot_complete': self.recorder('a')}))
+        self.dispatcher.dispatch('shot_complete', 'shot_2.h5')
+        # Replacing a plugin, as a lazily loaded plugin does when loaded:
+        self.registry.plugin_loaded('a', StandInPlugin({'shot_complete': self.recorder('a2')}))
+        self.registry.plugin_loaded('b', StandInPlugin({'shot_complete': self.recorder('b')}))
+        self.dispatcher.dispatch('shot_complete', 'shot_3.h5')
+        self.registry.plugin_unloaded('a')
+        self.dispatcher.dispatch('shot_complete', 'shot_4.h5')
+        self.assertEqual(self.names(), [('a', 'shot_2.h5'), ('a2', 'shot_3.h5'), ('b', 'shot_3.h5'),
+                                        ('b', 'shot_4.h5')])
+
+    def test_exceptions_are_caught(self):
+        def fails(path):
+            raise ValueError(path)
+        self.register({
+            'a': StandInPlugin({'shot_complete': fails}),
+            'b': StandInPlugin({'shot_complete': self.recorder('b')}),
+        })
+        self.dispatcher.dispatch('shot_complete', 'shot.h5')
+        self.assertEqual(self.names(), [('b', 'shot.h5')])
+        self.assertEqual(self.dispatcher.timings[('a', 'shot_complete')][0], 1)
+
+
+class StandInMenu(object):
+    def __init__(self, blacs_data):
+        self.blacs_data = blacs_data
+        self.triggered = []
+
+    def get_menu_items(self):
+        return {'name': 'Stand-in', 'menu_items': [
+            {'name': 'Top', 'action': lambda: self.triggered.append('Top')},
+            {'name': 'Sub', 'menu_items': [{'name': 'Inner', 'action': lambda: self.triggered.append('Inner')}]}]}
+
+
+class StandInLazyPlugin(object):
+    instances = []
+
+    def __init__(self, initial_settings):
+        self.initial_settings = initial_settings
+        self.menu = None
+        self.blacs_data = None
+        self.calls = []
+        self.instances.append(self)
+
+    def get_menu_class(self):
+        return StandInMenu
+
+    def set_menu_instance(self, menu):
+        self.menu = menu
+
+    def set_notification_instances(self, notifications):
+        pass
+
+    def plugin_setup_complete(self, blacs_data):
+        self.blacs_data = blacs_data
+
+    def get_callbacks(self):
+        return {'shot_complete': self.calls.append}
+
+    def get_save_data(self):
+        return {'loaded': True}
+
+
+class StandInLazyModule(object):
+    Plugin = StandInLazyPlugin
+
+
+MANIFEST = {
+    'name': 'Stand-in',
+    'lazy': True,
+    'callbacks': {'shot_complete': 20},
+    'run_async_callbacks': ['shot_complete'],
+    'menu': {'name': 'Stand-in', 'menu_items': [{'name': 'Top'}, {'name': 'Sub', 'menu_items': [{'name': 'Inner'}]}]}
+}
+
+
+def call_directly(function, *args, **kwargs):
+    return function(*args, **kwargs)
+
+
+class LazyPluginTests(unittest.TestCase):
+
+    def setUp(self):
+        StandInLazyPlugin.instances = []
+        patches = [mock.patch.object(blacs.plugins, 'import_plugin', return_value=StandInLazyModule),
+                   # Loading is done in the main thread, which this is:
+                   mock.patch('qtutils.inmain', call_directly)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(callback_registry.plugin_unloaded, 'stand_in')
+        self.lazy_plugin = LazyPluginModule('stand_in', MANIFEST).Plugin({'saved': 1})
+        callback_registry.plugin_loaded('stand_in', self.lazy_plugin)
+        self.menu = self.lazy_plugin.get_menu_class()('blacs_data')
+        self.lazy_plugin.set_menu_instance(self.menu)
+        self.lazy_plugin.plugin_setup_complete('blacs_data')
+
+    def test_not_loaded_until_used(self):
+        self.assertEqual(self.lazy_plugin.get_save_data(), {'saved': 1})
+        callbacks = self.lazy_plugin.get_callbacks()
+        self.assertEqual(list(callbacks), ['shot_complete'])
+        self.assertEqual(callbacks['shot_complete'].priority, 20)
+        self.assertTrue(callbacks['shot_complete'].run_async)
+        items = self.menu.get_menu_items()
+        self.assertEqual([item['name'] for item in items['menu_items']], ['Top', 'Sub'])
+        self.assertEqual(StandInLazyPlugin.instances, [])
+        self.assertIsNone(self.lazy_plugin.plugin)
+
+    def test_loaded_by_callback(self):
+        [(module_name, lazy_callback)] = callback_registry.lookup('shot_complete')
+        lazy_callback('shot.h5')
+        [plugin] = StandInLazyPlugin.instances
+        self.assertIs(self.lazy_plugin.plugin, plugin)
+        self.assertEqual(plugin.initial_settings, {'saved': 1})
+        self.assertEqual(plugin.blacs_data, 'blacs_data')
+        self.assertEqual(plugin.calls, ['shot.h5'])
+        # The real plugin has replaced the stand-in in the registry:
+        self.assertEqual([name for name, cb in callback_registry.lookup('shot_complete')], ['stand_in'])
+        callback_registry.lookup('shot_complete')[0][1]('shot_2.h5')
+        self.assertEqual(plugin.calls, ['shot.h5', 'shot_2.h5'])
+        self.assertEqual(self.lazy_plugin.get_save_data(), {'loaded': True})
+
+    def test_loaded_by_menu(self):
+        items = self.menu.get_menu_items()
+        items['menu_items'][1]['menu_items'][0]['action']()
+        items['menu_items'][0]['action']()
+        # Loaded once, with the real menu's actions run:
+        [plugin] = StandInLazyPlugin.instances
+        self.assertEqual(plugin.menu.triggered, ['Inner', 'Top'])
+        self.assertEqual(plugin.menu.blacs_data, 'blacs_data')
+
+
+class MemoryPluginTests(unittest.TestCase):
+
+    def test_lazy(self):
+        manifest = get_manifest('memory')
+        self.assertTrue(manifest['lazy'])
+        from blacs.plugins.memory import Menu
+        with mock.patch('blacs.plugins.memory.memprof') as memprof:
+            menu = Menu(None)
+            # The profiler is only started once the menu is used:
+            self.assertFalse(memprof.start.called)
+            items = menu.get_menu_items()
+            # The menu matches the manifest the lazy menu is created from:
+            self.assertEqual([(item['name'], item['icon']) for item in items['menu_items']],
+                             [(item['name'], item['icon']) for item in manifest['menu']['menu_items']])
+            items['menu_items'][2]['action']()
+            self.assertTrue(memprof.start.called)
+            self.assertTrue(memprof.check.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
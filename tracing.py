@@ -0,0 +1,249 @@
+#####################################################################
+#                                                                   #
+# /tracing.py                                                       #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Records spans of time spent in the queue manager, tab state functions and
+worker jobs, in all processes, and exports them as Chrome trace event format
+files, which can be viewed in chrome://tracing or https://ui.perfetto.dev.
+
+Tracing is enabled by setting 'trace_dir' in the 'BLACS' section of the lab
+config, and a trace of each shot is then written to that directory. Traces of
+other time windows can be exported with tracer.export(). Worker processes
+send their spans to BLACS after each job. Times are from the performance
+counter, a monotonic clock with sub-microsecond resolution on all platforms,
+which all processes on the same computer share. Spans from other computers
+are shifted by the difference between their clock and ours when they were
+received, so are only accurate to within the network latency."""
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from collections import deque
+
+import zmq
+
+from blacs.worker_agent import bind_to_random_port, is_allowed_peer, LOCALHOST
+
+if PY2:
+    monotonic = time.time
+else:
+    # Not time.monotonic(), which has a resolution of 15.6ms on Windows:
+    monotonic = time.perf_counter
+
+# The maximum number of spans to keep:
+TRACE_BUFFER_LENGTH = 100000
+# The longest to wait for time.time() to tick when measuring the offset
+# between it and the monotonic clock, in seconds:
+WALL_CLOCK_TICK_TIMEOUT = 0.1
+# How far the wall clock can drift from the offset measured, in seconds,
+# before it is measured again, for example after the wall clock is set:
+WALL_CLOCK_MAX_DRIFT = 0.5
+
+
+def wall_clock_offset():
+    """Return time.time() - monotonic(). time.time() may have a much coarser
+    resolution than the monotonic clock, so both are read just after it ticks,
+    when the value it returns is most accurate"""
+    start = time.time()
+    deadline = monotonic() + WALL_CLOCK_TICK_TIMEOUT
+    while True:
+        wall_time = time.time()
+        now = monotonic()
+        if wall_time != start or now > deadline:
+            return wall_time - now
+
+logger = logging.getLogger('BLACS.tracing')
+
+
+class Span(object):
+    def __init__(self, tracer, name, cat, args, tid):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.tid = tid
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.complete(self.name, self.cat, self.start, monotonic(), self.args, self.tid)
+
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_null_span = NullSpan()
+
+
+class Tracer(object):
+    """Records spans as Chrome trace 'complete' events. Does nothing unless
+    enabled, which in BLACS is done by enable() and in worker processes by
+    connect(), which sends their spans to BLACS with each flush()."""
+    def __init__(self):
+        self.enabled = False
+        self.trace_dir = None
+        self.events = deque(maxlen=TRACE_BUFFER_LENGTH)
+        self.pid = os.getpid()
+        self.hostname = socket.gethostname()
+        # The addresses to listen on, and of the hosts whose spans are
+        # accepted, extended if there are workers on other computers (see
+        # worker_agent.get_listen_addresses). Must be set before the collector
+        # port is first accessed:
+        self.bind_addresses = [LOCALHOST]
+        self.allowed_addresses = set([LOCALHOST])
+        # Process and thread name metadata events, by (pid, tid), which are
+        # kept separately so they are never dropped from the buffer:
+        self._names = {}
+        # Track name: tid, for tracks that are not threads:
+        self._tracks = {}
+        self._lock = threading.Lock()
+        self._collector_sock = None
+        self._collector_port = None
+        self._sock = None
+        self._wall_clock_offset = None
+
+    def enable(self, process_name='BLACS'):
+        self.enabled = True
+        self._wall_clock_offset = wall_clock_offset()
+        self.set_process_name(process_name)
+
+    def span(self, name, cat='', args=None, tid=None):
+        """A context manager recording the time spent in it"""
+        if not self.enabled:
+            return _null_span
+        return Span(self, name, cat, args, tid)
+
+    def complete(self, name, cat, start, end, args=None, tid=None):
+        """Record a span from start to end, in seconds of the monotonic clock"""
+        if not self.enabled:
+            return
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': 1e6 * start, 'dur': 1e6 * (end - start),
+                 'pid': self.pid, 'tid': threading.current_thread().ident if tid is None else tid}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def from_wall_time(self, t):
+        """Convert a time.time() time to the monotonic clock"""
+        offset = self._wall_clock_offset
+        if offset is None or abs(time.time() - monotonic() - offset) > WALL_CLOCK_MAX_DRIFT:
+            offset = self._wall_clock_offset = wall_clock_offset()
+        return t - offset
+
+    def set_process_name(self, name):
+        with self._lock:
+            self._names[(self.pid, None)] = {'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'args': {'name': name}}
+
+    def set_thread_name(self, name, tid=None):
+        if tid is None:
+            tid = threading.current_thread().ident
+        with self._lock:
+            self._names[(self.pid, tid)] = {'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                                            'args': {'name': name}}
+
+    def track(self, name):
+        """The tid of a named track, for spans of something that is not a
+        thread, such as a tab's state machine"""
+        with self._lock:
+            if name not in self._tracks:
+                # Negative, so as not to clash with thread ids:
+                self._tracks[name] = -1 - len(self._tracks)
+            tid = self._tracks[name]
+        self.set_thread_name(name, tid)
+        return tid
+
+    @property
+    def collector_port(self):
+        """The port that worker processes send spans to. Listening starts the
+        first time this is accessed."""
+        with self._lock:
+            if self._collector_port is None:
+                self._collector_sock = zmq.Context.instance().socket(zmq.PULL)
+                self._collector_sock.setsockopt(zmq.LINGER, 0)
+                self._collector_port = bind_to_random_port(self._collector_sock, self.bind_addresses)
+                thread = threading.Thread(target=self._collect)
+                thread.daemon = True
+                thread.start()
+            return self._collector_port
+
+    def _collect(self):
+        while True:
+            try:
+                frame = self._collector_sock.recv(copy=False)
+                if not is_allowed_peer(frame, self.allowed_addresses):
+                    logger.warning('Ignoring spans from a host that is not running workers')
+                    continue
+                # JSON, so that nothing received is unpickled:
+                batch = json.loads(frame.bytes.decode('utf8'))
+                if batch['hostname'] != self.hostname:
+                    offset = 1e6 * (monotonic() - batch['now'])
+                    for event in batch['events']:
+                        event['ts'] += offset
+                self.events.extend(batch['events'])
+                with self._lock:
+                    for name in batch['names']:
+                        self._names[(name['pid'], name.get('tid'))] = name
+            except Exception:
+                logger.exception('Error receiving spans from worker')
+
+    def connect(self, host, port):
+        """Called in worker processes to enable tracing and send spans to the
+        BLACS at host:port"""
+        with self._lock:
+            if self._sock is None:
+                self._sock = zmq.Context.instance().socket(zmq.PUSH)
+                self._sock.setsockopt(zmq.LINGER, 1000)
+                self._sock.connect('tcp://%s:%d' % (host, port))
+                # Which devices' workers are in the process is shown by the
+                # names of their threads:
+                self._names[(self.pid, None)] = {'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                                                 'args': {'name': 'BLACS worker process'}}
+        self.enabled = True
+
+    def flush(self):
+        """Send spans recorded in this worker process to BLACS"""
+        if self._sock is None:
+            return
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        with self._lock:
+            names = list(self._names.values())
+            if not events:
+                return
+            self._sock.send_json({'hostname': self.hostname, 'now': monotonic(), 'events': events,
+                                  'names': names})
+
+    def export(self, path, start=None, end=None):
+        """Write the spans that overlap the time window from start to end, in
+        seconds of the monotonic clock, to a trace file"""
+        events = list(self.events)
+        if start is not None:
+            events = [event for event in events if event['ts'] + event['dur'] >= 1e6 * start]
+        if end is not None:
+            events = [event for event in events if event['ts'] <= 1e6 * end]
+        with self._lock:
+            names = list(self._names.values())
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': names + events, 'displayTimeUnit': 'ms'}, f)
+
+tracer = Tracer()
@@ -0,0 +1,424 @@
+#####################################################################
+#                                                                   #
+# /worker_agent.py                                                  #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Runs device workers on a computer other than the one running BLACS, for
+example one near the hardware, so that CPU heavy devices can be spread
+across computers. Run a worker agent on that computer with:
+
+    python -m blacs.worker_agent
+
+and in the lab config of the BLACS computer, list the devices whose workers
+should run there in the 'BLACS/remote_workers' section, one per line, as
+either 'device_name = host' or 'device_name = host:port'. The worker classes
+must be importable on the remote computer, and as workers are sent the
+same shot file paths as they would be on the BLACS computer, with no
+translation, shot files must be at the same paths on the remote computer,
+for example by mounting the shared drive at the same location. The agent
+starts each worker in
+its own process, which connects back to BLACS, and the tab then treats it
+like a local worker. A worker's output is printed by the agent rather than
+shown in its tab.
+
+The agent is configured in the 'BLACS/worker_agent' section of the lab config
+of the computer it runs on, for example:
+
+    [BLACS/worker_agent]
+    bind_address = 192.168.1.20
+    port = 7341
+    blacs_hosts = blacs-computer
+    allowed_workers = labscript_devices, user_devices
+
+bind_address is the address of the network interface to listen on, and
+blacs_hosts the computers running BLACS, whose requests are the only ones
+accepted. Both default to localhost, for testing. allowed_workers lists the
+worker classes the agent may start, or packages or modules containing them,
+and defaults to labscript_devices. Requests are JSON, so the agent never
+unpickles anything it is sent."""
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import os
+import sys
+import json
+import socket
+import logging
+import argparse
+import importlib
+import threading
+import traceback
+import subprocess
+import time
+
+import zmq
+import zmq.auth.thread
+from zprocess import zmq_get_string
+
+from blacs.worker_host import HostedQueue, SocketReadQueue, SocketWriteQueue
+
+DEFAULT_AGENT_PORT = 7341
+LOCALHOST = '127.0.0.1'
+DEFAULT_BIND_ADDRESS = LOCALHOST
+DEFAULT_BLACS_HOSTS = ['localhost']
+DEFAULT_ALLOWED_WORKERS = ['labscript_devices']
+# How long to wait for the agent to respond to a request, in seconds:
+AGENT_TIMEOUT = 10
+# The most often the agent is asked whether a remote worker has exited, in
+# seconds between requests:
+POLL_INTERVAL = 2
+
+
+class RequestRefused(Exception):
+    pass
+
+
+def worker_class_fullname(WorkerClass):
+    """The fully qualified name of a worker class, for importing it in
+    another process"""
+    if isinstance(WorkerClass, str):
+        return WorkerClass
+    if WorkerClass.__module__ == '__main__':
+        raise ValueError('Worker class %s cannot be run remotely, as it is defined in __main__. ' % WorkerClass.__name__ +
+                         'Pass its fully qualified import path instead')
+    return '%s.%s' % (WorkerClass.__module__, WorkerClass.__name__)
+
+
+def get_local_address(remote_host):
+    """The address of this computer on the network interface used to reach
+    remote_host. No packets are sent."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((socket.gethostbyname(remote_host), 9))
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+
+def get_addresses(hosts):
+    """The IPv4 addresses of a list of hostnames or addresses"""
+    addresses = set()
+    for host in hosts:
+        addresses.update(socket.gethostbyname_ex(host)[2])
+    return addresses
+
+
+def get_listen_addresses(agent_hosts):
+    """The addresses BLACS should listen on for messages from workers run by
+    agents on agent_hosts, being localhost and the interfaces facing them,
+    and the addresses of the hosts whose messages should be accepted"""
+    bind_addresses = [LOCALHOST]
+    for host in sorted(agent_hosts):
+        local_address = get_local_address(host)
+        if local_address not in bind_addresses:
+            bind_addresses.append(local_address)
+    allowed_addresses = get_addresses(agent_hosts)
+    allowed_addresses.add(LOCALHOST)
+    return bind_addresses, allowed_addresses
+
+
+def bind_to_random_port(sock, addresses):
+    """Bind sock to the same random port on each of a list of addresses,
+    returning the port"""
+    port = sock.bind_to_random_port('tcp://%s' % addresses[0])
+    for address in addresses[1:]:
+        sock.bind('tcp://%s:%d' % (address, port))
+    return port
+
+
+def get_peer_address(frame):
+    """The address of the peer that sent a message received with copy=False,
+    or None if this libzmq does not support finding it"""
+    try:
+        return frame.get('Peer-Address')
+    except Exception:
+        return None
+
+
+def is_allowed_peer(frame, allowed_addresses):
+    """Whether a message received with copy=False was sent from one of
+    allowed_addresses. If the sender cannot be found, the message is only
+    accepted if localhost is the only allowed address, as then the socket
+    is only listening on localhost"""
+    peer_address = get_peer_address(frame)
+    if peer_address is None:
+        return set(allowed_addresses) == set([LOCALHOST])
+    return peer_address in allowed_addresses
+
+
+def agent_request(host, port, command, **kwargs):
+    """Make a request of the worker agent at host:port, returning its
+    response"""
+    request = str(json.dumps([command, kwargs]))
+    response = json.loads(zmq_get_string(port, host, request, timeout=AGENT_TIMEOUT))
+    if 'error' in response:
+        raise RuntimeError('Worker agent at %s:%d: %s' % (host, port, response['error']))
+    return response['result']
+
+
+class WorkerAgent(object):
+    """Starts and stops worker processes at the request of BLACS. Only
+    accepts requests from blacs_hosts, and only starts the worker classes in
+    allowed_workers. Connections from other hosts are refused by ZMQ
+    authentication, and as that depends on the libzmq version, each request's
+    peer address is also checked."""
+    def __init__(self, port=DEFAULT_AGENT_PORT, bind_address=DEFAULT_BIND_ADDRESS,
+                 blacs_hosts=DEFAULT_BLACS_HOSTS, allowed_workers=DEFAULT_ALLOWED_WORKERS):
+        self.logger = logging.getLogger('BLACS.worker_agent')
+        self.port = port
+        self.bind_address = bind_address
+        self.blacs_addresses = get_addresses(blacs_hosts)
+        self.allowed_workers = list(allowed_workers)
+        # key: Popen object of the worker started for it
+        self.children = {}
+        self.lock = threading.Lock()
+        self.context = zmq.Context()
+        self.auth = zmq.auth.thread.ThreadAuthenticator(self.context)
+        self.auth.start()
+        self.auth.allow(*self.blacs_addresses)
+        self.sock = self.context.socket(zmq.REP)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        # Connections are only authenticated on sockets with a ZAP domain:
+        self.sock.setsockopt(zmq.ZAP_DOMAIN, b'blacs.worker_agent')
+        self.sock.bind('tcp://%s:%d' % (self.bind_address, self.port))
+        self.mainloop_thread = threading.Thread(target=self.mainloop)
+        self.mainloop_thread.daemon = True
+        self.mainloop_thread.start()
+
+    def mainloop(self):
+        while True:
+            try:
+                frame = self.sock.recv(copy=False)
+            except zmq.ContextTerminated:
+                self.sock.close(linger=0)
+                return
+            peer_address = get_peer_address(frame)
+            try:
+                if peer_address not in self.blacs_addresses:
+                    raise RequestRefused('Requests from %s are not accepted' % peer_address)
+                command, kwargs = json.loads(frame.bytes.decode('utf8'))
+                response = {'result': self.handler(command, kwargs)}
+            except Exception as e:
+                self.logger.error('Refused or failed request from %s:\n%s' % (peer_address, traceback.format_exc()))
+                response = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            self.sock.send(json.dumps(response).encode('utf8'))
+
+    def handler(self, command, kwargs):
+        if command == 'start':
+            return self.start(**kwargs)
+        elif command == 'terminate':
+            return self.terminate(**kwargs)
+        elif command == 'poll':
+            with self.lock:
+                child = self.children.get(kwargs['key'])
+            return None if child is None else child.poll()
+        raise RequestRefused('Unknown command %s' % command)
+
+    def is_allowed(self, fullname):
+        for allowed in self.allowed_workers:
+            if fullname == allowed or fullname.startswith(allowed + '.'):
+                return True
+        return False
+
+    def start(self, key, fullname, parent_host, to_worker_port, from_worker_port):
+        if not self.is_allowed(fullname):
+            raise RequestRefused('Worker class %s is not in allowed_workers' % fullname)
+        # The worker connects back to BLACS and unpickles the jobs it is sent,
+        # so must only connect to a BLACS host:
+        if parent_host not in self.blacs_addresses:
+            raise RequestRefused('%s is not a BLACS host' % parent_host)
+        # If BLACS restarted without terminating the worker, it is no longer
+        # of any use:
+        self.terminate(key)
+        spec = {'key': key, 'fullname': fullname, 'parent_host': parent_host,
+                'to_worker_port': int(to_worker_port), 'from_worker_port': int(from_worker_port)}
+        child = subprocess.Popen([sys.executable, '-m', 'blacs.worker_agent', '--run-worker', json.dumps(spec)])
+        with self.lock:
+            self.children[key] = child
+        self.logger.info('Started worker %s (pid %d)' % (key, child.pid))
+        return child.pid
+
+    def terminate(self, key):
+        with self.lock:
+            child = self.children.pop(key, None)
+        if child is not None and child.poll() is None:
+            self.logger.info('Terminating worker %s (pid %d)' % (key, child.pid))
+            child.terminate()
+            child.wait()
+
+    def shutdown(self):
+        self.auth.stop()
+        self.context.term()
+        self.mainloop_thread.join()
+
+    def shutdown_on_interrupt(self):
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            sys.stderr.write('Interrupted, shutting down\n')
+        finally:
+            self.shutdown()
+
+
+def run_worker(spec):
+    """Run in the worker process started by the agent"""
+    from labscript_utils.setup_logging import setup_logging
+    setup_logging('BLACS')
+    context = zmq.Context.instance()
+    sock = context.socket(zmq.PULL)
+    sock.connect('tcp://%s:%d' % (spec['parent_host'], spec['to_worker_port']))
+    from_parent = HostedQueue(sock)
+    sock = context.socket(zmq.PUSH)
+    sock.setsockopt(zmq.LINGER, 1000)
+    sock.connect('tcp://%s:%d' % (spec['parent_host'], spec['from_worker_port']))
+    to_parent = HostedQueue(sock)
+    try:
+        module_name, class_name = spec['fullname'].rsplit('.', 1)
+        WorkerClass = getattr(importlib.import_module(module_name), class_name)
+        worker = WorkerClass()
+    except Exception:
+        to_parent.put(('error', traceback.format_exc()))
+        raise
+    to_parent.put(('hello', os.getpid()))
+    worker.from_parent = from_parent
+    worker.to_parent = to_parent
+    worker_name, device_name, extraargs = from_parent.get()
+    worker.setup_worker(worker_name, device_name, extraargs)
+    import labscript_utils.excepthook
+    labscript_utils.excepthook.set_logger(worker.logger)
+    import zprocess.locking, labscript_utils.h5_lock
+    zprocess.locking.set_client_process_name(worker.logger.name)
+    worker.mainloop()
+
+
+class RemoteChild(object):
+    """Stands in for the child process of a remote worker"""
+    def __init__(self, agent_host, agent_port, key):
+        self.agent_host = agent_host
+        self.agent_port = agent_port
+        self.key = key
+        self.returncode = None
+        self._poll_lock = threading.Lock()
+        self._polling = False
+        self._last_poll = 0
+
+    def _request(self, command):
+        return agent_request(self.agent_host, self.agent_port, command, key=self.key)
+
+    def terminate(self):
+        self._request('terminate')
+
+    def wait(self):
+        pass
+
+    def poll(self):
+        """The worker's exit code, or None if it is still running, as of the
+        last time the agent was asked. Does not block, the agent being asked
+        again in a thread, at most once per POLL_INTERVAL"""
+        with self._poll_lock:
+            if not self._polling and time.time() - self._last_poll > POLL_INTERVAL:
+                self._polling = True
+                thread = threading.Thread(target=self._update_returncode)
+                thread.daemon = True
+                thread.start()
+        return self.returncode
+
+    def _update_returncode(self):
+        try:
+            self.returncode = self._request('poll')
+        except Exception:
+            logging.getLogger('BLACS.worker_agent').exception('Could not poll remote worker %s' % self.key)
+        finally:
+            with self._poll_lock:
+                self._polling = False
+                self._last_poll = time.time()
+
+
+class RemoteWorker(object):
+    """Used by Tab in place of a worker process, for workers run by a worker
+    agent on another computer. Has the parts of the zprocess.Process
+    interface that Tab uses."""
+    def __init__(self, fullname, agent_host, agent_port=DEFAULT_AGENT_PORT, startup_timeout=30):
+        self.fullname = fullname
+        self.agent_host = agent_host
+        self.agent_port = agent_port
+        self.startup_timeout = startup_timeout
+        self.child = None
+
+    def start(self, worker_name, device_name, extraargs):
+        local_address = get_local_address(self.agent_host)
+        context = zmq.Context.instance()
+        to_worker_sock = context.socket(zmq.PUSH)
+        to_worker_sock.setsockopt(zmq.LINGER, 0)
+        # Only on the interface facing the agent, as these carry pickles:
+        to_worker_port = to_worker_sock.bind_to_random_port('tcp://%s' % local_address)
+        from_worker_sock = context.socket(zmq.PULL)
+        from_worker_port = from_worker_sock.bind_to_random_port('tcp://%s' % local_address)
+        # For telling whatever is waiting on the worker to quit:
+        to_self_sock = context.socket(zmq.PUSH)
+        to_self_sock.setsockopt(zmq.LINGER, 0)
+        to_self_sock.connect('tcp://%s:%d' % (local_address, from_worker_port))
+        key = '%s.%s' % (device_name, worker_name)
+        try:
+            agent_request(self.agent_host, self.agent_port, 'start', key=key, fullname=self.fullname,
+                          parent_host=local_address, to_worker_port=to_worker_port,
+                          from_worker_port=from_worker_port)
+            self.child = RemoteChild(self.agent_host, self.agent_port, key)
+            if not from_worker_sock.poll(1000 * self.startup_timeout):
+                raise RuntimeError('Remote worker %s did not connect within the timeout' % key)
+            status, message = from_worker_sock.recv_pyobj()
+            if status != 'hello':
+                raise Exception('Error starting remote worker %s:\n%s' % (key, message))
+        except Exception:
+            for sock in (to_worker_sock, from_worker_sock, to_self_sock):
+                sock.close(linger=0)
+            raise
+        # Heartbeats also need to be sent to this computer:
+        extraargs = dict(extraargs, _heartbeat_host=local_address)
+        to_worker_sock.send_pyobj((worker_name, device_name, extraargs), protocol=2)
+        return SocketWriteQueue(to_worker_sock), SocketReadQueue(from_worker_sock, to_self_sock)
+
+    def terminate(self):
+        if self.child is not None:
+            self.child.terminate()
+
+
+def get_agent_config():
+    """The agent's settings from the 'BLACS/worker_agent' section of this
+    computer's lab config, as keyword arguments for WorkerAgent"""
+    from labscript_utils.labconfig import LabConfig
+    exp_config = LabConfig()
+    config = {}
+    section = 'BLACS/worker_agent'
+    if exp_config.has_option(section, 'port'):
+        config['port'] = exp_config.getint(section, 'port')
+    if exp_config.has_option(section, 'bind_address'):
+        config['bind_address'] = exp_config.get(section, 'bind_address').strip()
+    for option in ['blacs_hosts', 'allowed_workers']:
+        if exp_config.has_option(section, option):
+            config[option] = [value.strip() for value in exp_config.get(section, option).split(',') if value.strip()]
+    return config
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run BLACS device workers on this computer. ' +
+                                     'Configured in the BLACS/worker_agent section of the lab config.')
+    parser.add_argument('--run-worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_worker is not None:
+        run_worker(json.loads(args.run_worker))
+    else:
+        from labscript_utils.setup_logging import setup_logging
+        setup_logging('BLACS')
+        agent = WorkerAgent(**get_agent_config())
+        agent.logger.info('Worker agent listening on %s:%d for requests from %s' %
+                          (agent.bind_address, agent.port, ', '.join(sorted(agent.blacs_addresses))))
+        agent.shutdown_on_interrupt()
@@ -0,0 +1,359 @@
+#####################################################################
+#                                                                   #
+# /worker_host.py                                                   #
+#                                                                   #
+# This file is part of the program BLACS, in the labscript suite    #
+# (see http://labscriptsuite.org), and is licensed under the        #
+# Simplified BSD License. See the license.txt file in the root of   #
+# the project for the full license.                                 #
+#                                                                   #
+#####################################################################
+"""Runs the workers of several devices in one process, rather than one
+process each, to save the memory of a Python interpreter, labscript_utils,
+h5py and zprocess per device. Enabled by setting 'co_host_workers = True' in
+the 'BLACS' section of the lab config, and only used for Worker subclasses
+with co_hostable = True. Each co-hosted worker runs in its own thread, with
+its own job queues, so a worker that is busy or raises an exception does not
+affect the others. A worker that crashes the whole process, or hangs without
+releasing the GIL, does affect them, and this will be detected by the
+heartbeat monitor for all the tabs involved. A worker host that does not
+respond to a request is killed, its workers' tabs are told to restart, and a
+new worker host is started for the workers added after that."""
+from __future__ import division, unicode_literals, print_function, absolute_import
+from labscript_utils import PY2
+if PY2:
+    str = unicode
+
+import sys
+import itertools
+import threading
+import logging
+import traceback
+import importlib
+
+import zmq
+import zprocess
+from zprocess import Process
+
+# How long to wait for the worker host to respond to a request, in seconds. If
+# it does not respond it is assumed to be hung, and is killed and replaced:
+HOST_TIMEOUT = 30
+# The same, for requests to remove a worker, which are made when restarting a
+# tab, possibly because the worker host is hung:
+REMOVE_TIMEOUT = 5
+# Sent by the worker host on a co-hosted worker's job queue to tell it to exit:
+REMOVE_WORKER = '__remove_worker__'
+
+
+def co_hostable_name(WorkerClass):
+    """The fully qualified name of a worker class to be imported in a worker
+    host, or None if it cannot be co-hosted. Classes specified by import path
+    are imported only in the worker host, which checks whether they are
+    co-hostable then"""
+    if isinstance(WorkerClass, str):
+        return WorkerClass
+    if not getattr(WorkerClass, 'co_hostable', False) or WorkerClass.__module__ == '__main__':
+        return None
+    return '%s.%s' % (WorkerClass.__module__, WorkerClass.__name__)
+
+
+def get_memory_usage():
+    """The resident memory of this process in bytes, or None if unknown"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # The peak rather than the current usage, but close to it this early on:
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In kilobytes on Linux but bytes on macOS:
+    return maxrss if sys.platform == 'darwin' else 1024 * maxrss
+
+
+class WorkerRemoved(Exception):
+    pass
+
+
+class HostedQueue(object):
+    """The end of a co-hosted worker's job queue, or results queue, in the
+    worker host. Used as the worker's from_parent and to_parent"""
+    def __init__(self, sock):
+        self.sock = sock
+
+    def get(self):
+        obj = self.sock.recv_pyobj()
+        if obj == REMOVE_WORKER:
+            raise WorkerRemoved
+        return obj
+
+    def put(self, obj):
+        self.sock.send_pyobj(obj, protocol=2)
+
+
+class SocketReadQueue(object):
+    """BLACS's end of the results queue of a worker not started by zprocess,
+    with the same interface as the queues returned by Process.start(). put()
+    sends to the queue itself, to wake whatever is waiting on it"""
+    def __init__(self, sock, to_self_sock):
+        self.sock = sock
+        self.to_self_sock = to_self_sock
+        self.sock_lock = threading.Lock()
+        self.to_self_sock_lock = threading.Lock()
+
+    def get(self, timeout=None):
+        with self.sock_lock:
+            if timeout is not None and not self.sock.poll(1000 * timeout):
+                raise zprocess.TimeoutError('get() timed out')
+            return self.sock.recv_pyobj()
+
+    def put(self, obj):
+        with self.to_self_sock_lock:
+            self.to_self_sock.send_pyobj(obj, protocol=2)
+
+
+class SocketWriteQueue(object):
+    """BLACS's end of the job queue of a worker not started by zprocess"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def put(self, obj):
+        with self.lock:
+            self.sock.send_pyobj(obj, protocol=2)
+
+
+class WorkerHost(Process):
+    """The process that co-hosted workers run in"""
+    def run(self):
+        from labscript_utils.setup_logging import setup_logging
+        setup_logging('BLACS')
+        self.logger = logging.getLogger('BLACS.worker_host')
+        import labscript_utils.excepthook
+        labscript_utils.excepthook.set_logger(self.logger)
+        import zprocess.locking, labscript_utils.h5_lock, h5py
+        zprocess.locking.set_client_process_name('BLACS.worker_host')
+        self.context = zmq.Context.instance()
+        # key: (worker, control_sock), where control_sock is connected to the
+        # worker's job queue, for telling it to exit:
+        self.workers = {}
+        self.control_ids = itertools.count()
+        # Tell the parent how much memory a process like this uses before any
+        # workers are added:
+        self.to_parent.put(get_memory_usage())
+        while True:
+            command, args = self.from_parent.get()
+            try:
+                response = {'add': self.add, 'remove': self.remove}[command](*args)
+            except Exception:
+                self.logger.exception('Error in %s request' % command)
+                response = (False, traceback.format_exc())
+            self.to_parent.put(response)
+
+    def add(self, key, fullname, worker_args, to_worker_port, from_worker_port):
+        module_name, class_name = fullname.rsplit('.', 1)
+        WorkerClass = getattr(importlib.import_module(module_name), class_name)
+        if not getattr(WorkerClass, 'co_hostable', False):
+            return False, 'not co-hostable'
+        worker = WorkerClass()
+        control_sock = self.context.socket(zmq.PUSH)
+        control_sock.setsockopt(zmq.LINGER, 1000)
+        control_endpoint = 'inproc://worker-host-control-%d' % next(self.control_ids)
+        control_sock.bind(control_endpoint)
+        sock = self.context.socket(zmq.PULL)
+        sock.connect('tcp://127.0.0.1:%d' % to_worker_port)
+        sock.connect(control_endpoint)
+        worker.from_parent = HostedQueue(sock)
+        sock = self.context.socket(zmq.PUSH)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect('tcp://127.0.0.1:%d' % from_worker_port)
+        worker.to_parent = HostedQueue(sock)
+        self.workers[key] = (worker, control_sock)
+        thread = threading.Thread(target=self.run_worker, args=(key, worker, worker_args))
+        thread.daemon = True
+        thread.start()
+        self.logger.info('Added worker %s' % key)
+        return True, None
+
+    def run_worker(self, key, worker, worker_args):
+        try:
+            worker.setup_worker(*worker_args)
+            worker.mainloop()
+        except WorkerRemoved:
+            self.logger.info('Removed worker %s' % key)
+        except Exception:
+            message = traceback.format_exc()
+            self.logger.error('Worker %s exited with an exception:\n%s' % (key, message))
+            worker.to_parent.put((False, 'Co-hosted worker exited with an exception:\n' + message, None))
+        finally:
+            worker.from_parent.sock.close(linger=0)
+            worker.to_parent.sock.close(linger=0)
+
+    def remove(self, key):
+        # The worker's thread exits once it gets to this message in its job
+        # queue. If it is stuck in a job it cannot be stopped, but will never
+        # be sent another:
+        if key not in self.workers:
+            return False, 'no such worker'
+        worker, control_sock = self.workers.pop(key)
+        try:
+            control_sock.send_pyobj(REMOVE_WORKER, flags=zmq.NOBLOCK, protocol=2)
+        except zmq.Again:
+            # The worker has already exited:
+            pass
+        control_sock.close()
+        return True, None
+
+
+class WorkerHostManager(object):
+    """Starts the worker host process when the first co-hosted worker is
+    started, and sends it requests to add and remove workers. Starts a new
+    worker host if the previous one has exited."""
+    def __init__(self):
+        self.logger = logging.getLogger('BLACS.worker_host_manager')
+        self.lock = threading.Lock()
+        self.host = None
+        self.to_host = None
+        self.from_host = None
+        self.baseline_memory = None
+        self.n_workers = 0
+        # key: results queue of each co-hosted worker, for telling its tab if
+        # the worker host is lost:
+        self.read_queues = {}
+
+    def _ensure_started(self):
+        if self.host is not None and self.host.child.poll() is None:
+            return
+        if self.host is not None:
+            self._host_lost('Worker host exited')
+        self.host = WorkerHost(startup_timeout=HOST_TIMEOUT)
+        self.to_host, self.from_host = self.host.start()
+        self.baseline_memory = self.from_host.get(timeout=HOST_TIMEOUT)
+        self.n_workers = 0
+
+    def _host_lost(self, reason):
+        """Forget the worker host, telling the tabs of the workers that were
+        in it. A new one is started for the next worker added. Must be called
+        with the lock held."""
+        self.logger.error('%s. A new worker host will be started for subsequent workers' % reason)
+        for read_queue in self.read_queues.values():
+            read_queue.put((False, '%s. Restart the tab to start its worker again.' % reason, None))
+        self.read_queues = {}
+        self.host = None
+
+    def request(self, command, *args, **kwargs):
+        timeout = kwargs.pop('timeout', HOST_TIMEOUT)
+        with self.lock:
+            self._ensure_started()
+            self.to_host.put((command, args))
+            try:
+                success, message = self.from_host.get(timeout=timeout)
+            except zprocess.TimeoutError:
+                self.host.terminate()
+                self._host_lost('Worker host did not respond within %s seconds and was killed' % timeout)
+                raise
+            if success:
+                if command == 'add':
+                    self.n_workers += 1
+                    self.report_memory_saved()
+                elif command == 'remove':
+                    self.n_workers -= 1
+            return success, message
+
+    def report_memory_saved(self):
+        if self.baseline_memory is None:
+            self.logger.info('%d workers co-hosted in one process' % self.n_workers)
+        else:
+            saved = (self.n_workers - 1) * self.baseline_memory / 1024**2
+            self.logger.info('%d workers co-hosted in one process, saving about %.0f MB ' % (self.n_workers, saved) +
+                             'compared to a process each')
+
+    def register(self, key, read_queue):
+        with self.lock:
+            self.read_queues[key] = read_queue
+
+    def remove_if_running(self, key):
+        with self.lock:
+            self.read_queues.pop(key, None)
+            if self.host is None or self.host.child.poll() is not None:
+                return
+        try:
+            self.request('remove', key, timeout=REMOVE_TIMEOUT)
+        except zprocess.TimeoutError:
+            # The worker host has been killed, and the worker with it:
+            pass
+
+worker_host_manager = WorkerHostManager()
+
+
+class HostedChild(object):
+    """Stands in for the child process of a co-hosted worker"""
+    def __init__(self, key, pid):
+        self.key = key
+        # The pid of the worker host, which the worker shares:
+        self.pid = pid
+
+    def terminate(self):
+        worker_host_manager.remove_if_running(self.key)
+
+    def wait(self):
+        pass
+
+
+class HostedWorker(object):
+    """Used by Tab in place of a worker process, for workers that may be
+    co-hosted. Has the parts of the zprocess.Process interface that Tab uses.
+    If the worker class turns out not to be co-hostable, it is started in its
+    own process as usual."""
+    def __init__(self, fullname, output_redirection_port=None, startup_timeout=30):
+        self.fullname = fullname
+        self.output_redirection_port = output_redirection_port
+        self.startup_timeout = startup_timeout
+        self.child = None
+        self.process = None
+
+    def start(self, worker_name, device_name, extraargs):
+        context = zmq.Context.instance()
+        to_worker_sock = context.socket(zmq.PUSH)
+        to_worker_sock.setsockopt(zmq.LINGER, 0)
+        to_worker_port = to_worker_sock.bind_to_random_port('tcp://127.0.0.1')
+        from_worker_sock = context.socket(zmq.PULL)
+        from_worker_port = from_worker_sock.bind_to_random_port('tcp://127.0.0.1')
+        # For telling whatever is waiting on the worker to quit:
+        to_self_sock = context.socket(zmq.PUSH)
+        to_self_sock.setsockopt(zmq.LINGER, 0)
+        to_self_sock.connect('tcp://127.0.0.1:%d' % from_worker_port)
+        key = '%s.%s' % (device_name, worker_name)
+        try:
+            success, message = worker_host_manager.request('add', key, self.fullname,
+                                                            (worker_name, device_name, extraargs),
+                                                            to_worker_port, from_worker_port)
+        except Exception:
+            for sock in (to_worker_sock, from_worker_sock, to_self_sock):
+                sock.close(linger=0)
+            raise
+        if success:
+            self.child = HostedChild(key, worker_host_manager.host.child.pid)
+            to_worker = SocketWriteQueue(to_worker_sock)
+            from_worker = SocketReadQueue(from_worker_sock, to_self_sock)
+            worker_host_manager.register(key, from_worker)
+            return to_worker, from_worker
+        for sock in (to_worker_sock, from_worker_sock, to_self_sock):
+            sock.close(linger=0)
+        if message != 'not co-hostable':
+            raise Exception('Could not start co-hosted worker:\n%s' % message)
+        self.process = Process(output_redirection_port=self.output_redirection_port,
+                               startup_timeout=self.startup_timeout,
+                               subclass_fullname=self.fullname)
+        to_worker, from_worker = self.process.start(worker_name, device_name, extraargs)
+        self.child = self.process.child
+        return to_worker, from_worker
+
+    def terminate(self):
+        if self.process is not None:
+            self.process.terminate()
+        elif self.child is not None:
+            self.child.terminate()